@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Access logging off the request path.
+
+log() only puts a record on a queue. A background thread writes the
+records as JSON lines in batches, each batch with a single append (the
+file is opened with O_APPEND, so batches from different workers never
+overwrite each other). When the file gets bigger than max_bytes it is
+rotated to .1, .2, ... .backups, under a lock file so only one worker
+rotates, which bounds the disk space to about (backups + 1) * max_bytes.
+If the queue is full (the disk can't keep up) records are dropped and
+counted instead of slowing down requests.
+"""
+
+import atexit
+from datetime import datetime
+import json
+import os
+import queue
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # No locking (Windows); only matters with several workers
+    fcntl = None
+
+
+class AccessLog:
+    def __init__(self, path, max_bytes=10 * 2 ** 20, backups=5,
+                 flush_interval=1., batch_size=500, queue_size=10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def log(self, event, **fields):
+        # Never blocks
+        self._start()
+        record = dict(time=datetime.now().isoformat(timespec='milliseconds'),
+                      event=event, pid=os.getpid(), **fields)
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        # The writer thread doesn't survive a fork, every worker starts its
+        # own on first use
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._thread = threading.Thread(
+                        target=self._write_loop, name='access-log',
+                        daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is None:
+                return
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get(timeout=self.flush_interval))
+                    if batch[-1] is None:
+                        break
+            except queue.Empty:
+                pass
+            stop = batch[-1] is None
+            self.write([record for record in batch if record is not None])
+            for record in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def write(self, records):
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            records = records + [dict(
+                time=datetime.now().isoformat(timespec='milliseconds'),
+                event='dropped', pid=os.getpid(), count=dropped)]
+        data = ''.join(json.dumps(record, default=str) + '\n'
+                       for record in records).encode()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if (os.path.exists(self.path) and
+                        os.path.getsize(self.path) + len(data) >
+                        self.max_bytes):
+                    self.rotate()
+                descriptor = os.open(self.path,
+                                     os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                     0o644)
+                try:
+                    os.write(descriptor, data)
+                finally:
+                    os.close(descriptor)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def rotate(self):
+        # logfile -> logfile.1 -> ... -> logfile.backups (dropped)
+        for index in range(self.backups, 0, -1):
+            older = '{}.{}'.format(self.path, index)
+            newer = ('{}.{}'.format(self.path, index - 1) if index > 1
+                     else self.path)
+            if os.path.exists(newer):
+                os.replace(newer, older)
+        if self.backups == 0:
+            os.remove(self.path)
+
+    def flush(self):
+        # Waits until everything logged so far is written
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        if (self._pid == os.getpid() and self._thread is not None and
+                self._thread.is_alive()):
+            self._queue.put(None)
+            self._thread.join()
+            self._pid = None
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Reading requests to, and writing responses from, the HTTP API.
+
+POST /api/beam takes a JSON body
+    {"settings": {...}, "optics": <system>}
+or, for a batch,
+    {"settings": {...}, "systems": [<system>, ...]}
+where settings are like assets/default_settings.json (missing ones are
+taken from there) and a system is a CSV text as in the Load Optics box, a
+list of rows like {"Element": 1, "Position": -250, "Type": 1,
+"FocalLength": 75} or a dict of columns. A text/csv body is one system with
+the default settings. Bad systems or settings, and requests for more grid
+points than exva.api_max_points, are a 400 with {"error": ...}.
+
+The answer is w(z), the focus and the report of every system, as json,
+ndjson (one line per system, then its w(z) in chunks, written as it's
+computed) or npy (only w(z): one row per system after a first row of z).
+Pick one with ?format= or the Accept header. ?report=0 leaves the report
+out, ?dtype=float32 gives the npy in single precision (half the size).
+
+w(z) is never made whole for ndjson and npy, it's computed and written in
+blocks of the grid (beam.width_blocks), so long grids take no more memory
+than short ones. JSON needs the whole answer at once, so it's only given
+for up to exva.max_grid_points points in all.
+"""
+
+import io
+import json
+
+import numpy as np
+
+import beam
+import physics
+from optical_system import OpticalSystem, columns, record_dtype
+
+dtypes = {'float64': np.float64, 'float32': np.float32}
+
+formats = {'json': 'application/json',
+           'ndjson': 'application/x-ndjson',
+           'npy': 'application/octet-stream'}
+
+
+def read_system(data):
+    if isinstance(data, str):
+        system = OpticalSystem.from_csv(data)
+    else:
+        if isinstance(data, dict):
+            # Columns to rows
+            data = [dict(zip(data, row)) for row in zip(*data.values())]
+        try:
+            records = np.array([tuple(row[name] for name in columns)
+                                for row in data], dtype=record_dtype)
+        except (KeyError, TypeError, ValueError, OverflowError):
+            raise ValueError('Every element needs ' + ', '.join(columns))
+        system = OpticalSystem(records)
+    if not len(system) or system['Type'][0] != 0:
+        raise ValueError('The first element must be the origin (Type 0)')
+    if np.any(system['Type'][1:] != 1):
+        raise ValueError('All elements after the origin must be lenses '
+                         '(Type 1)')
+    if not (np.isfinite(system['Position']).all() and
+            np.isfinite(system['FocalLength']).all()):
+        raise ValueError('Positions and focal lengths must be numbers')
+    return(system)
+
+
+def check_settings(settings):
+    # Everything the physics reads, so that bad values are a 400 before
+    # the response starts
+    values = {}
+    for name in ('wavelength', 'waist', 'z_min', 'z_max', 'z_step'):
+        try:
+            values[name] = float(settings[name])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Setting {} must be a number'.format(name))
+        if not np.isfinite(values[name]):
+            raise ValueError('Setting {} must be finite'.format(name))
+    for name in ('wavelength', 'waist', 'z_step'):
+        if values[name] <= 0:
+            raise ValueError('Setting {} must be positive'.format(name))
+    if values['z_max'] <= values['z_min']:
+        raise ValueError('z_max must be above z_min')
+
+
+def read_request(body, content_type, default_settings, max_systems,
+                 max_points=None):
+    # Returns settings, the systems and whether it was a single system.
+    # max_points caps the grid points of all systems together.
+    if content_type.startswith('text/csv'):
+        settings = dict(default_settings)
+        systems = [read_system(body.decode())]
+        single = True
+    else:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise ValueError('The body is neither JSON nor CSV')
+        if not isinstance(data, dict):
+            raise ValueError('The body should be a JSON object')
+        if not isinstance(data.get('settings', {}), dict):
+            raise ValueError('"settings" should be a JSON object')
+        settings = dict(default_settings, **data.get('settings', {}))
+        single = 'systems' not in data
+        if single:
+            if 'optics' not in data:
+                raise ValueError('Give "optics" or "systems"')
+            systems = [data['optics']]
+        else:
+            systems = data['systems']
+            if not isinstance(systems, list):
+                raise ValueError('"systems" should be a list')
+        if len(systems) > max_systems:
+            raise ValueError('At most {} systems per request'.format(
+                max_systems))
+        systems = [read_system(system) for system in systems]
+    check_settings(settings)
+    points = grid_size(settings) * len(systems)
+    if max_points is not None and points > max_points:
+        raise ValueError('{} grid points asked for, at most {} per '
+                         'request'.format(points, max_points))
+    return(settings, systems, single)
+
+
+def check_json(settings, systems, max_points):
+    # A JSON answer is made whole, unlike ndjson and npy
+    points = grid_size(settings) * len(systems)
+    if points > max_points:
+        raise ValueError('{} grid points are too many for a JSON answer (at '
+                         'most {}), ask for ndjson or npy'.format(
+                             points, max_points))
+
+
+def grid_size(settings):
+    return(beam.grid_size(physics.settings_grid(settings)))
+
+
+def choose_format(name, accept):
+    if name is None:
+        name = 'json'
+        for option, mimetype in formats.items():
+            if mimetype in accept:
+                name = option
+                break
+    if name not in formats:
+        raise ValueError('Unknown format ' + name)
+    return(name)
+
+
+def read_dtype(name):
+    if name not in dtypes:
+        raise ValueError('Unknown dtype ' + name)
+    return(dtypes[name])
+
+
+def summary(result):
+    # Everything but the w(z) curve, JSON-ready
+    return({'focus': {'z': float(result['focus'].z),
+                      'width': float(result['focus'].width)},
+            'segments': {name: values.tolist()
+                         for name, values in result['segments'].items()},
+            'report': result.get('report')})
+
+
+def width_blocks(result, block_size=None, dtype=np.float64):
+    segments = beam.Segments(**result['segments'])
+    return(beam.width_blocks(result['grid'], segments, block_size, dtype))
+
+
+def write_json(results, single):
+    answer = []
+    for result in results:
+        z = beam.grid_points(result['grid'])
+        w = np.concatenate([np.empty(0)] + [
+            w for start, block, w in width_blocks(result)])
+        answer.append(dict(summary(result), z=z.tolist(), w=w.tolist()))
+    return(json.dumps(answer[0] if single else {'systems': answer}))
+
+
+def write_ndjson(results, chunk_size):
+    # A generator, so the response streams
+    for index, result in enumerate(results):
+        yield json.dumps(dict(summary(result), system=index)) + '\n'
+        for start, z, w in width_blocks(result, chunk_size):
+            yield json.dumps({'system': index, 'z': z.tolist(),
+                              'w': w.tolist()}) + '\n'
+
+
+def write_npy(results, count, dtype=np.float64):
+    # A generator as well: the .npy header for count systems, then z and
+    # every w(z), block by block
+    for index, result in enumerate(results):
+        grid = result['grid']
+        if not index:
+            header = {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                      'fortran_order': False,
+                      'shape': (count + 1, beam.grid_size(grid))}
+            data = io.BytesIO()
+            np.lib.format.write_array_header_1_0(data, header)
+            yield data.getvalue()
+            for start, z in beam.grid_blocks(grid):
+                yield z.astype(dtype).tobytes()
+        for start, z, w in width_blocks(result, dtype=dtype):
+            yield w.tobytes()
@@ -3,24 +3,50 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-import dash_auth
-from dash.dependencies import Input, Output, State
-import plotly.express as px
+from dash.dependencies import Input, Output, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 import numpy as np
-import pandas as pd
-from io import StringIO
 import extra_vars as exva
+import beam
+import sampling
+import cache
+import codec
+import dispersion
+import coalesce
+import sessions
+import api
+import metrics
+import accesslog
+import workers
+import tolerance
+from optical_system import OpticalSystem, record_dtype
+from physics import (set_origin, settings_grid, calc_segments, calc_focus,
+                     calc_spectrum, sweep_element, optimize_optics,
+                     tolerance_analysis, get_catalog, match_stock_lenses,
+                     search_stock_designs, lens_marks, match_columns)
 import json
-from flask import request
+import functools
+import importlib
+from flask import request, Response, g, has_request_context
 from datetime import datetime
-import os
+import uuid
+import threading
+import time
 
 # Functions
 
 
-def check_index(position, z_grid):
-    p_index = np.where(z_grid >= position)[0][0]
-    return(p_index)
+def timed(stage):
+    # Time every call as a stage in the metrics (see metrics.py)
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            if not use_metrics:
+                return(func(*args, **kwargs))
+            with app_metrics.timer(stage):
+                return(func(*args, **kwargs))
+        return(timed_func)
+    return(decorator)
 
 
 def characterize(teh_type: int, short=False):
@@ -57,103 +83,489 @@ def scale_text(factor):
     return(text)
 
 
-def calc_gaussian(settings, optical_elements):
+def read_plot_points(points):
+    # An empty box means the default; fewer than 3 can't keep both ends
+    # and a bucket
+    try:
+        points = int(points)
+    except (TypeError, ValueError):
+        points = exva.default_plot_points
+    return(max(points, 3))
+
+
+def read_diameter(diameter):
+    # An empty box means any diameter
+    if diameter is None or diameter == '':
+        return(None)
+    diameter = float(diameter)
+    if not (np.isfinite(diameter) and diameter >= 0):
+        raise ValueError('The diameter has to be a positive number')
+    return(diameter)
+
+
+@timed('build_figure')
+def build_figure(settings, w_z, show_lenses, segments, spectrum=None):
     z_max = float(settings['z_max'])
     z_min = float(settings['z_min'])
     z_step = float(settings['z_step'])
+    double_sided = int(settings['double_sided'])
+    x_scaling_factor = float(settings['x_scale'])
+    y_scaling_factor = float(settings['y_scale'])
+
+    xlabel = 'z' + scale_text(x_scaling_factor)
+    ylabel = 'Width' + scale_text(y_scaling_factor)
+
+    # The full w_z stays as it is, only the plotted traces are thinned out.
+    # Without w_z (a long grid) it's thinned out block by block.
+    plot_points = read_plot_points(settings.get('plot_points'))
+    if int(settings.get('adaptive', 0)):
+        z_plot = sampling.adaptive_grid(segments, z_min, z_max, plot_points)
+        w_plot = beam.beam_width(z_plot, segments)
+        z_plot, w_plot = sampling.decimate(z_plot, w_plot, plot_points)
+    elif w_z is None:
+        grid = beam.Grid(z_min, z_max, z_step)
+        z_plot, w_plot = sampling.decimate_blocks(
+            beam.width_blocks(grid, segments), beam.grid_size(grid),
+            plot_points)
+    else:
+        z_plot, w_plot = sampling.decimate(
+            beam.make_grid(z_min, z_max, z_step), w_z, plot_points)
+
+    # The figure plotly.express would make, but as plain dicts: px.line
+    # takes longer than all the physics. The second trace is the mirror
+    # image of the first. Lots of points are drawn with WebGL, like px does.
+    hover = '{}=%{{x}}<br>{}=%{{y}}<extra></extra>'.format(xlabel, ylabel)
+    trace = {'hovertemplate': hover,
+             'legendgroup': '', 'line': {'color': '#636efa', 'dash': 'solid'},
+             'marker': {'symbol': 'circle'}, 'mode': 'lines', 'name': '',
+             'showlegend': False, 'xaxis': 'x', 'yaxis': 'y',
+             'type': 'scattergl' if len(z_plot) > 1000 else 'scatter',
+             'x': z_plot / x_scaling_factor, 'y': w_plot / y_scaling_factor}
+    data = [trace]
+    if double_sided:
+        data.append(dict(trace, y=-w_plot / y_scaling_factor))
+    if spectrum is not None:
+        data += spectrum_traces(settings, trace, z_plot, spectrum)
+    annotations = []
+    for element_name, element_position in zip(show_lenses[0], show_lenses[1]):
+        if double_sided:
+            annotation = dict(
+                x=element_position[0] / x_scaling_factor,
+                y=-element_position[1] / y_scaling_factor,
+                ay=element_position[1] / (y_scaling_factor * 1.5))
+        else:
+            annotation = dict(
+                x=element_position[0] / x_scaling_factor,
+                y=element_position[1] / y_scaling_factor,
+                ay=element_position[1] / (y_scaling_factor * 2))
+        annotation.update(text=element_name, ayref='y', xref='x', yref='y',
+                          showarrow=True, arrowhead=7, ax=0)
+        annotations.append(annotation)
+    fig = {'data': data,
+           'layout': {'xaxis': {'anchor': 'y', 'domain': [0.0, 1.0],
+                                'title': {'text': xlabel}},
+                      'yaxis': {'anchor': 'x', 'domain': [0.0, 1.0],
+                                'title': {'text': ylabel}},
+                      'legend': {'tracegroupgap': 0}, 'margin': {'t': 60},
+                      'annotations': annotations}}
+    return(fig)
+
+
+def spectrum_traces(settings, trace, z_plot, spectrum):
+    # The beam at all wavelengths, after the main trace (and its mirror):
+    # the band it covers, or a few of the wavelengths as lines
+    y_scaling_factor = float(settings['y_scale'])
+    widths = beam.beam_widths(z_plot, spectrum.segments) / y_scaling_factor
+    if settings.get('spectrum', 'envelope') == 'lines':
+        picks = np.unique(np.linspace(0, len(widths) - 1, min(
+            len(widths), exva.spectrum_lines)).round().astype(int))
+        lines = [dict(trace, y=widths[pick], showlegend=True,
+                      name='{:g} nm'.format(spectrum.wavelengths[pick]),
+                      line={'color': exva.spectrum_colors[
+                          number % len(exva.spectrum_colors)], 'width': 1})
+                 for number, pick in enumerate(picks)]
+        if int(settings['double_sided']):
+            lines += [dict(line, y=-line['y'], showlegend=False)
+                      for line in lines]
+        return(lines)
+    band = dict(trace, line={'width': 0}, hoverinfo='skip')
+    band.pop('hovertemplate')
+    edges = [widths.min(axis=0), widths.max(axis=0)]
+    if int(settings['double_sided']):
+        edges += [-edges[0], -edges[1]]
+    # Every second one fills down to the one before it
+    return([dict(band, y=edge, **({'fill': 'tonexty',
+                                   'fillcolor': exva.spectrum_fill}
+                                  if number % 2 else {}))
+            for number, edge in enumerate(edges)])
+
+
+@timed('figure_payload')
+def figure_payload(fig, settings, optical_elements, show_lenses):
+    # The figure plus what assets/beam_preview.js needs to redraw it in the
+    # browser while elements are being moved. The browser puts the traces
+    # and the template (from the layout) back into the figure.
+    preview = {
+        'optics': {
+            'elements': optical_elements['Element'].tolist(),
+            'positions': optical_elements['Position'].tolist(),
+            'types': optical_elements['Type'].tolist(),
+            'focal_lengths': optical_elements['FocalLength'].tolist()},
+        'annotated': [int(element) for element in show_lenses[0]],
+        'waist': float(settings['waist']),
+        'wavelength': float(settings['wavelength']) * 1e-6,
+        'z_min': float(settings['z_min']),
+        'z_max': float(settings['z_max']),
+        'x_scale': float(settings['x_scale']),
+        'y_scale': float(settings['y_scale']),
+        'double_sided': int(settings['double_sided']),
+        'points': read_plot_points(settings.get('plot_points')),
+        'drag': int(settings.get('drag', 0))}
+    # Only the first trace is sent, the second one is its mirror image.
+    # The traces of the other wavelengths after them share its x.
+    traces = {axis: codec.encode_trace(fig['data'][0][axis],
+                                       exva.trace_encoding, exva.trace_digits)
+              for axis in ('x', 'y')}
+    mirrored = 1 + int(settings['double_sided'])
+    data = [{name: value for name, value in trace.items()
+             if name not in ('x', 'y')} for trace in fig['data']]
+    for trace, sent in zip(data[mirrored:], fig['data'][mirrored:]):
+        trace['y'] = codec.encode_trace(sent['y'], exva.trace_encoding,
+                                        exva.trace_digits)
+    figure = {'data': data, 'layout': fig['layout']}
+    return(json.dumps({'figure': figure, 'traces': traces,
+                       'preview': preview}, separators=(',', ':')))
+
+
+def figure_key(compressed_optics, settings):
+    # Everything update_figure sends back depends on just these
+    return(cache.make_key('figure', compressed_optics, settings,
+                          exva.trace_encoding, exva.trace_digits))
+
+
+@functools.lru_cache(maxsize=None)
+def plot_template():
+    # The look of plotly.express figures. It's the same for every figure, so
+    # it's only sent once, with the layout.
+    import plotly.io as pio
+    from plotly.utils import PlotlyJSONEncoder
+    return(json.dumps(pio.templates['plotly'].to_plotly_json(),
+                      cls=PlotlyJSONEncoder))
+
+
+def session_state(session):
+    # The handle of a session's server-side state, None if there's none
+    if not (use_sessions and session):
+        return(None)
+    return(sessions.Session(session_store, session))
+
+
+def take_ticket(session, kind):
+    # Waits a moment for newer requests from the same session and gives up
+    # (PreventUpdate sends nothing back) if there were any
+    if not (use_coalescing and session):
+        return(None)
+    ticket = tickets.take(session, kind)
+    if not tickets.settle(session, kind, ticket, exva.coalesce_delay):
+        raise PreventUpdate
+    return(ticket)
+
+
+def check_latest(session, kind, ticket):
+    # Gives up if a newer request came in while this one was working
+    if ticket is not None and tickets.is_stale(session, kind, ticket):
+        raise PreventUpdate
+
+
+def offload(func, *args):
+    # func(*args) in the compute pool. Raises workers.Busy if too many jobs
+    # are waiting already and workers.Timeout if it takes too long.
+    if not use_pool:
+        return(func(*args))
+    try:
+        return(compute_pool.run(func, *args))
+    except (workers.Busy, workers.Timeout) as error:
+        if use_metrics:
+            app_metrics.count('compute_rejected_total',
+                              {'reason': type(error).__name__.lower()})
+        raise
+
+
+def refusal_text(error):
+    # What the page shows instead of a result the pool didn't deliver
+    if isinstance(error, workers.Busy):
+        return(exva.compute_busy_text)
+    return(exva.compute_timeout_text)
+
+
+@timed('calc_trace')
+def calc_trace(settings, optical_elements):
+    # Starts from whichever recent trace shares the most elements with this
+    # system, so editing one element only recomputes the beam from there on
+    optical_elements = set_origin(settings, optical_elements)
+    grid = settings_grid(settings)
     waist = float(settings['waist'])
     wavelength = float(settings['wavelength']) * 1e-6
-    rayleigh = waist ** 2 * np.pi / wavelength
-    z_origin = z_min
-    z_grid = np.arange(z_min, z_max, z_step)
-    report_text = ''
-    optical_elements.at[0, 'Position'] = z_min
-    optical_elements['z grid index'] = [check_index(
-        pos, z_grid)-1 for pos in optical_elements['Position']]
-    optical_elements.at[0, 'z grid index'] = 0
-    w_z = waist + 0 * z_grid
-    show_lenses = [[], []]
-    num_elements = len(optical_elements)
-    for o_index in range(num_elements):
-        o_type = optical_elements.at[o_index, 'Type']
-        el_number = optical_elements.at[o_index, 'Element']
-        start_index = optical_elements.at[o_index, 'z grid index']
-        report_text += (exva.elem_title.format(el_number,
-                                               characterize(o_type)))
-        if o_index == num_elements - 1:
-            end_index = -1
-        else:
-            end_index = optical_elements.at[o_index + 1, 'z grid index']
-        if o_type == 0:
-            pass
-        elif o_type == 1:
-            f = optical_elements.at[o_index, 'FocalLength']
-            z_temp = (z_grid[start_index] - z_origin)
-            r = rayleigh / (z_temp - f)
-            Mr = np.abs(f / (z_temp - f))
-            M = Mr / (np.sqrt(1 + r ** 2))
-            waist = waist * M
-            z_origin = M ** 2 * ((z_temp) - f) + f + z_grid[start_index]
-            rayleigh = M ** 2 * rayleigh
-            show_lenses[0].append(str(el_number))
-            show_lenses[1].append([z_grid[start_index], w_z[start_index - 1]])
-        report_text += exva.report_entry.format(z_origin, z_origin -
-                                                z_grid[start_index],
-                                                'after' if z_origin -
-                                                z_grid[start_index] > 0 else
-                                                'before', waist)
-        if rayleigh < 10000:
-            # Let's say it's collimated if R0 is over 10 m (kind of arbitrary)
-            report_text += exva.report_rayleigh.format(
-                2 * rayleigh)
-        else:
-            report_text += exva.collimated_text.format(2 * rayleigh)
-        w_z[start_index:end_index] = waist * np.sqrt(1 + ((z_grid[
-            start_index:end_index] - z_origin) / rayleigh) ** 2)
-        if end_index == -1:
-            w_z[end_index] = waist * \
-                np.sqrt(1 + ((z_grid[end_index] - z_origin) / rayleigh) ** 2)
-    return(w_z, show_lenses, report_text)
+    positions = optical_elements['Position']
+    types = optical_elements['Type']
+    focal_lengths = optical_elements['FocalLength']
+    closest = None
+    most_shared = -1
+    with traces_lock:
+        candidates = list(recent_traces)
+    for old in candidates:
+        if (old.grid, old.waist, old.wavelength) == (grid, waist, wavelength):
+            shared = beam.first_change(old, positions, types, focal_lengths)
+            if shared > most_shared:
+                closest, most_shared = old, shared
+    trace = beam.retrace(closest, grid, positions, types, focal_lengths,
+                         waist, wavelength)
+    # By identity, traces hold arrays so == doesn't work on them
+    with traces_lock:
+        recent_traces[:] = [old for old in recent_traces if old is not trace]
+        recent_traces.insert(0, trace)
+        del recent_traces[exva.trace_cache_size:]
+    return(trace)
+
+
+@timed('calc_results')
+def calc_results(settings, optical_elements):
+    # Everything the plot needs from the physics. Comes from the shared
+    # cache if any worker has already seen this system with these settings.
+    optical_elements = set_origin(settings, optical_elements)
+    key = cache.physics_key(settings, optical_elements['Position'],
+                            optical_elements['Type'],
+                            optical_elements['FocalLength'],
+                            optical_elements['Element'])
+    if use_cache:
+        blob = result_cache.get(key)
+        if blob is not None:
+            arrays, meta = cache.unpack(blob)
+            segments = beam.Segments(*(arrays[name]
+                                       for name in beam.Segments._fields))
+            return(arrays.get('w_z'), meta['show_lenses'], segments)
+    if beam.grid_size(settings_grid(settings)) > exva.max_grid_points:
+        # Too long to keep whole: w_z is None, and whoever needs w(z) goes
+        # through the grid in blocks (beam.width_blocks)
+        segments = calc_segments(settings, optical_elements)
+        w_z = None
+    else:
+        trace = calc_trace(settings, optical_elements)
+        segments, w_z = trace.segments, trace.w_z
+    show_lenses = lens_marks(optical_elements, segments)
+    if use_cache:
+        arrays = segments._asdict()
+        if w_z is not None:
+            arrays['w_z'] = w_z
+        result_cache.put(key, cache.pack(arrays, {
+            'show_lenses': show_lenses}))
+    return(w_z, show_lenses, segments)
+
+
+@functools.lru_cache(maxsize=exva.report_cache_size)
+def element_report(el_number, o_type, position, z_origin, waist, rayleigh):
+    # The report of one element. Cached, so after an edit only the elements
+    # whose beam changed are written again.
+    report_text = (exva.elem_title.format(el_number, characterize(o_type)))
+    report_text += exva.report_entry.format(z_origin, z_origin -
+                                            position,
+                                            'after' if z_origin -
+                                            position > 0 else
+                                            'before',
+                                            waist)
+    if rayleigh < 10000:
+        # Let's say it's collimated if R0 is over 10 m (kind of arbitrary)
+        report_text += exva.report_rayleigh.format(
+            2 * rayleigh)
+    else:
+        report_text += exva.collimated_text.format(2 * rayleigh)
+    return(report_text)
+
+
+def calc_report_text(optical_elements, segments):
+    return(''.join(
+        element_report(int(el_number), int(o_type), float(position),
+                       float(z_origin), float(waist), float(rayleigh))
+        for el_number, o_type, position, z_origin, waist, rayleigh in zip(
+            optical_elements['Element'], optical_elements['Type'],
+            segments.start, segments.z_origin, segments.waist,
+            segments.rayleigh)))
+
+
+def plain_number(value):
+    # All the digits that are stored, but -250 rather than -250.0
+    text = repr(float(value))
+    return(text[:-2] if text.endswith('.0') else text)
+
+
+@functools.lru_cache(maxsize=exva.report_cache_size)
+def table_row(el_number, o_type, position, focal_length):
+    return(exva.table_row.format(el_number, characterize(o_type, short=True),
+                                 plain_number(position),
+                                 plain_number(focal_length)))
+
+
+@timed('calc_report')
+def calc_report(settings, optical_elements, segments):
+    # The whole Report tab: smallest spot, optics table and the element
+    # breakdown, as markdown texts
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    focus = calc_focus(settings, segments)
+    minspot_text = exva.minspot.format(focus.width, focus.z)
+    table = exva.table_header + ''.join(
+        table_row(int(el_number), int(o_type), float(position),
+                  float(focal_length))
+        for el_number, o_type, position, focal_length in zip(
+            optical_elements['Element'], optical_elements['Type'],
+            optical_elements['Position'], optical_elements['FocalLength']))
+    return(minspot_text, table, calc_report_text(optical_elements, segments))
+
+
+@timed('calc_chromatic_report')
+def calc_chromatic_report(settings, optical_elements):
+    # How far the focus behind every lens moves over the spectrum of the
+    # settings, as markdown (nothing without a spectrum)
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    spectrum = calc_spectrum(settings, optical_elements)
+    if spectrum is None:
+        return('')
+    wavelengths = spectrum.wavelengths
+    z_origin = spectrum.segments.z_origin
+    text = exva.chromatic_headline.format(wavelengths[0], wavelengths[-1])
+    text += exva.chromatic_minspot.format(
+        spectrum.focus.z.min(), spectrum.focus.z.max(),
+        spectrum.focus.width.min(), spectrum.focus.width.max())
+    text += exva.chromatic_header
+    for column in np.flatnonzero(optical_elements['Type'] == 1):
+        text += exva.chromatic_row.format(
+            int(optical_elements['Element'][column]),
+            spectrum.focal_lengths[0, column],
+            spectrum.focal_lengths[-1, column], z_origin[0, column],
+            z_origin[-1, column], np.ptp(z_origin[:, column]))
+    return(text)
+
+
+def beam_result(settings, optical_elements, report=True):
+    # What the API gives for one system. Only the segments: w(z) is left to
+    # the writers in api.py, which go through the grid in blocks, so the
+    # whole trace that calc_results caches for the plot isn't needed.
+    optical_elements = set_origin(settings, optical_elements)
+    segments = calc_segments(settings, optical_elements)
+    result = {'grid': settings_grid(settings),
+              'focus': calc_focus(settings, segments),
+              'segments': segments._asdict()}
+    if report:
+        result['report'] = calc_report_text(optical_elements, segments)
+    return(result)
+
+
+@timed('calc_gaussian')
+def calc_gaussian(settings, optical_elements, trace=None):
+    optical_elements = set_origin(settings, optical_elements)
+    if trace is None:
+        trace = calc_trace(settings, optical_elements)
+    show_lenses = lens_marks(optical_elements, trace.segments)
+    report_text = calc_report_text(optical_elements, trace.segments)
+    return(trace.w_z, show_lenses, report_text)
 
 
 input_file = 'assets/initial_lens.csv'
 settings_loc = 'assets/default_settings.json'
 
-# Settings loading goes here
 
-with open(settings_loc, 'r') as settings_file:
-    default_settings = json.loads(settings_file.read())
-init_z_max = float(default_settings['z_max'])
-init_z_min = float(default_settings['z_min'])
-init_z_step = float(default_settings['z_step'])
-init_z_grid = np.arange(init_z_min, init_z_max, init_z_step)
-init_wavelength = float(default_settings['wavelength'])
-init_waist = float(default_settings['waist'])
+@functools.lru_cache(maxsize=None)
+def read_default_settings():
+    # Read when first needed, importing the app doesn't touch any files
+    with open(settings_loc, 'r') as settings_file:
+        return(json.loads(settings_file.read()))
+
+
+@functools.lru_cache(maxsize=None)
+def initial_optics():
+    # The origin at z min and the lenses of the initial file, numbered in z
+    # order. Shared, so don't change it.
+    lenses = np.atleast_1d(np.genfromtxt(input_file, delimiter=',',
+                                         names=True))
+    records = np.zeros(len(lenses) + 1, dtype=record_dtype)
+    records['Position'][0] = float(read_default_settings()['z_min'])
+    for name in ('Position', 'Type', 'FocalLength'):
+        records[name][1:] = lenses[name]
+    optics = OpticalSystem(records)
+    optics.renumber()
+    return(optics)
+
+
+# Recently computed beams, most recent first (see calc_trace)
+
+recent_traces = []
+traces_lock = threading.Lock()
+
+# Results are cached in a file all workers share
+
+use_cache = True
+
+if use_cache:
+    result_cache = cache.SharedCache(exva.cache_file, exva.cache_max_bytes)
+
+# Callbacks, stages and requests are timed and counted, see /metrics.
+# The sampling profiler at /metrics/profile has to be allowed explicitly.
 
-# Remake logfile on app startup... ?
+use_metrics = True
+allow_profiler = False
+
+if use_metrics:
+    app_metrics = metrics.Metrics(exva.metrics_file)
+    profiler = metrics.Profiler(exva.profile_interval)
+
+# Only the latest figure update of every session is computed, see coalesce.py
+
+use_coalescing = True
+
+if use_coalescing:
+    tickets = coalesce.Tickets(exva.tickets_file)
+
+# Every session's optics, settings and results are kept on the server, so
+# that any worker can take any request, see sessions.py
+
+use_sessions = True
+
+if use_sessions:
+    session_store = sessions.open_store(exva.session_store,
+                                        exva.session_max_age)
+
+# The physics, figures and reports are computed in a bounded pool, so that
+# slow updates don't hold up the request threads, see workers.py
+
+use_pool = True
+
+if use_pool:
+    compute_pool = workers.Pool(exva.compute_workers, exva.compute_queue,
+                                exva.compute_timeout, exva.compute_kind)
+    # Tolerance analyses run for a long time, they don't take the figures'
+    # places
+    tolerance_pool = workers.Pool(exva.tolerance_runs, exva.tolerance_queue)
+
+# Background runs (the tolerance analysis) leave their progress with the
+# sessions, so that any worker can answer the page's polls for it
+
+run_store = (session_store if use_sessions else
+             sessions.MemoryStore(exva.session_max_age))
+
+# Responses (callback outputs above all) are compressed with Flask-Compress
+
+use_compression = True
+
+# Access log, JSON lines written in the background, see accesslog.py
 
 use_logfile = True
 
 if use_logfile:
-    os.makedirs('aux', exist_ok=True)
-    logfile_name = 'aux/logfile.txt'
-    logfile = open(logfile_name, 'w')
-    nowstr = datetime.now().isoformat(timespec='seconds', sep=' ')
-    logstr = nowstr + ' Server restarted\n'
-    logfile.write(logstr)
-    logfile.close()
-
-# Initial loading of optics (could probably be better tbh)
-
-optical_elements = pd.read_csv(input_file)
-optical_elements['z grid index'] = [
-    check_index(pos, init_z_grid)
-    for pos in optical_elements['Position']]
-optical_elements.loc[-1] = [init_z_min, 0, 0, 0]
-optical_elements = update_optics(optical_elements)
-optical_elements['Element'] = optical_elements.index
-optical_elements = optical_elements[
-    ['Element', 'Position', 'Type', 'FocalLength']]
+    access_logger = accesslog.AccessLog(
+        exva.logfile, exva.log_max_bytes, exva.log_backups,
+        exva.log_flush_interval, exva.log_batch_size, exva.log_queue_size)
+
+# Imported on first use, or by create_app(preload=True)
+preload_modules = ['pandas', 'plotly.express', 'plotly.utils']
 
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 
@@ -175,11 +587,109 @@ tab_selected_style = {
     'padding': '2px'
 }
 
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# Callbacks and routes are only collected here, create_app registers them
+# with the app it makes
+
+callbacks = []
+routes = []
+
+
+def callback(*args, **kwargs):
+    # Takes what app.callback takes
+    def decorator(func):
+        callbacks.append((args, kwargs, func))
+        return(func)
+    return(decorator)
+
+
+def route(rule, **options):
+    # Takes what server.route takes
+    def decorator(func):
+        routes.append((rule, options, func))
+        return(func)
+    return(decorator)
+
+
+def note_callback(name):
+    # Which callback a request is for, to label its sizes
+    if has_request_context():
+        g.callback = name
+
+
+def start_request_timer():
+    g.started = time.perf_counter()
 
-server = app.server
 
-app.title = 'beampage'
+def request_user():
+    if use_password and request.authorization:
+        return(request.authorization['username'])
+    return('anonymous')
+
+
+def request_session():
+    # The session ID of a Dash request, if its callback has it as State
+    if request.path != '/_dash-update-component':
+        return(None)
+    body = request.get_json(silent=True) or {}
+    for item in body.get('state', []):
+        if item.get('id') == 'session-id':
+            return(item.get('value'))
+    return(None)
+
+
+def count_request(response):
+    if use_logfile:
+        access_logger.log(
+            'request', user=request_user(), session=request_session(),
+            path=request.path, callback=g.get('callback'),
+            status=response.status_code,
+            seconds=round(time.perf_counter() - g.started, 6))
+    if use_metrics:
+        path = request.url_rule.rule if request.url_rule else 'other'
+        app_metrics.count('requests_total', {
+            'path': path, 'status': response.status_code})
+        app_metrics.observe('request_seconds',
+                            time.perf_counter() - g.started, {'path': path})
+        if path == '/_dash-update-component':
+            labels = {'callback': g.get('callback', 'unknown')}
+            app_metrics.observe('callback_request_bytes',
+                                request.content_length or 0, labels)
+            if not response.is_streamed:
+                app_metrics.observe('callback_response_bytes',
+                                    len(response.get_data()), labels)
+    return(response)
+
+
+@route('/metrics')
+def metrics_page():
+    # Added up over all worker processes
+    if not use_metrics:
+        return(Response('Metrics are off\n', status=404,
+                        mimetype='text/plain'))
+    return(Response(app_metrics.render(),
+                    mimetype='text/plain; version=0.0.4'))
+
+
+@route('/metrics/profile', methods=['GET', 'POST'])
+def profile_page():
+    # POST ?action=start, stop or clear; GET gives the collapsed stacks.
+    # The profiler only sees the worker that gets the request.
+    if not (use_metrics and allow_profiler):
+        return(Response('Profiling is not allowed\n', status=403,
+                        mimetype='text/plain'))
+    if request.method == 'POST':
+        action = request.args.get('action')
+        if action == 'start':
+            profiler.start()
+        elif action == 'stop':
+            profiler.stop()
+        elif action == 'clear':
+            profiler.stacks.clear()
+        else:
+            return(Response('Unknown action\n', status=400,
+                            mimetype='text/plain'))
+    return(Response(profiler.collapsed(), mimetype='text/plain'))
+
 
 # Optional: set password protection, in which case usr/pwd pairs are loaded
 # from here
@@ -190,240 +700,485 @@ VALID_USERNAME_PASSWORD_PAIRS = {
 
 use_password = False
 
-if use_password:
-    auth = dash_auth.BasicAuth(
-        app,
-        VALID_USERNAME_PASSWORD_PAIRS
-    )
-
 # Layout should maybe be broken out to its own file for clarity
 
-app.layout = html.Div([
-    dcc.Tabs(id="all-tabs-inline", value='tab-1', children=[
-        dcc.Tab(label='Main', value='tab-1', style=tab_style,
-                selected_style=tab_selected_style, children=[
-                    dcc.Graph(id='main-graph'),
-                    html.Div([
-                        dcc.Dropdown(
-                            id='element_select',
-                            options=[{'label': i, 'value': i}
-                                     for i in optical_elements.index[1:]],
-                            value='1',
-                            style={'min-width': '100px',
-                                   'display': 'inline-block'},
-                            clearable=False
-                        ),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        html.Div(id='Infobox',
-                                 style={'width': '120px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        html.Label(dcc.Markdown('**Position:** '),
-                                   style={'display': 'inline-block',
-                                          'position': 'relative',
-                                          'vertical-align': 'top'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        dcc.Input(type='number', id='position', style={
-                            'width': '90px', 'display': 'inline-block',
-                            'position': 'relative',
-                            'vertical-align': 'top'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        html.Label(dcc.Markdown('**Focal length:** '), style={
-                            'display': 'inline-block', 'position': 'relative',
-                            'vertical-align': 'top'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        dcc.Input(type='number', id='focal_length', style={
-                            'width': '100px', 'display': 'inline-block',
-                            'position': 'relative', 'vertical-align': 'top'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        html.Button(id='make-button', n_clicks=0,
-                                    children='Create Element',
-                                    style={'display': 'inline-block',
-                                           'vertical-align': 'top'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        dcc.Textarea(
-                            id='output_text',
-                            placeholder='Enter a value...',
-                            value='Element,Position,Type,FocalLength',
-                            style={'min-width': '270px',
-                                   'display': 'inline-block',
-                                   'vertical-align': 'top'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block',
-                                        'position': 'relative'}),
-                        html.Button(id='load-button', n_clicks=0,
-                                    children='Load Optics',
-                                    style={'display': 'inline-block',
-                                           'vertical-align': 'top'})
-                    ], style={'columns': 1, 'display': 'table',
-                              'overflow-x': 'auto', 'margin-left': 'auto',
-                              'margin-right': 'auto'})
-                ]),
-        dcc.Tab(label='Report', value='report', style=tab_style,
-                selected_style=tab_selected_style, children=[
-                    html.Div(children=[
-                        dcc.Markdown(exva.report_headline),
-                        html.Div(id='report-body')
-                    ], style={'max-width': '750px', 'margin-left': 'auto',
-                              'margin-right': 'auto'})]),
-        dcc.Tab(label='Settings', value='tab-2', style=tab_style,
-                selected_style=tab_selected_style, children=[
-                    html.Div(style={'min-height': '20px'}),
-                    html.Div(children=[
-                        html.Label('x plot scale: ',
-                                   style={'width': '100px',
-                                          'display': 'inline-block'}),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block'}),
-                        html.Label('y plot scale: ',
-                                   style={'width': '100px',
-                                          'display': 'inline-block'}),
-                        html.Div(),
-                        dcc.Dropdown(
-                            id='xscale-drop',
-                            options=[{'label': 'Micrometers', 'value': 0.001},
-                                     {'label': 'Millimeters', 'value': 1},
-                                     {'label': 'Meters', 'value': 1000}, ],
-                            value='1',
-                            style={
-                                'width': '100px',
-                                'display': 'inline-block'},
-                            clearable=False
-                        ),
-                        html.Div(style={'width': '10px',
-                                        'display': 'inline-block'}),
-                        dcc.Dropdown(
-                            id='yscale-drop',
-                            options=[{'label': 'Micrometers', 'value': 0.001},
-                                     {'label': 'Millimeters', 'value': 1},
-                                     {'label': 'Meters', 'value': 1000}, ],
-                            value='1',
-                            style={
-                                'width': '100px',
-                                'display': 'inline-block'},
-                            clearable=False
-                        ),
-                        html.Label('Wavelength (nm): ', style={
-                            'width': 'one-column'}),
-                        dcc.Input(type='number', id='wavelength-box',
-                                  value=init_wavelength, style={}),
-                        html.Label('Starting waist (mm): ', style={
-                            'width': 'one-column'}),
-                        dcc.Input(type='number', id='waist-box',
-                                  value=init_waist, style={}),
-                        html.Div(),
-                        html.Div(dcc.Markdown(exva.checkbox_labels), style={
-                            'display': 'inline-block'}),
-                        html.Div(style={'width': '20px',
-                                        'display': 'inline-block'}),
-                        dcc.Checklist(id='more-options', options=[
-                            {'label': '', 'value': 'double_sided'},
-                            {'label': '', 'value': 'reset_index'}],
-                            style={'display': 'inline-block'},
-                            value=['double_sided']),
-                        html.Label(
-                            'z min (mm): ', style={
+@functools.lru_cache(maxsize=None)
+def make_layout():
+    # Built once, the first time a page is served
+    default_settings = read_default_settings()
+    init_z_max = float(default_settings['z_max'])
+    init_z_min = float(default_settings['z_min'])
+    init_z_step = float(default_settings['z_step'])
+    init_wavelength = float(default_settings['wavelength'])
+    init_waist = float(default_settings['waist'])
+    init_plot_points = int(default_settings['plot_points'])
+    init_wavelengths = default_settings.get('wavelengths', '')
+    init_glass = default_settings.get('glass', '')
+    init_spectrum = default_settings.get('spectrum', 'envelope')
+    init_options = ['double_sided']
+    if int(default_settings['adaptive']):
+        init_options.append('adaptive')
+    if int(default_settings['drag']):
+        init_options.append('drag')
+    optical_elements = initial_optics()
+    element_options = [{'label': i, 'value': i}
+                       for i in optical_elements['Element'][1:].tolist()]
+    scale_options = [{'label': 'Micrometers', 'value': 0.001},
+                     {'label': 'Millimeters', 'value': 1},
+                     {'label': 'Meters', 'value': 1000}, ]
+    main_layout = html.Div([
+        dcc.Tabs(id="all-tabs-inline", value='tab-1', children=[
+            dcc.Tab(label='Main', value='tab-1', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        dcc.Graph(id='main-graph'),
+                        # Says "Computing..." while the figure is being
+                        # updated (see assets/status.css), or why it wasn't
+                        html.Div(id='figure-status', children=''),
+                        html.Div([
+                            dcc.Dropdown(
+                                id='element_select',
+                                options=element_options,
+                                value='1',
+                                style={'min-width': '100px',
+                                       'display': 'inline-block'},
+                                clearable=False
+                            ),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            html.Div(id='Infobox',
+                                     style={'width': '120px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            html.Label(dcc.Markdown('**Position:** '),
+                                       style={'display': 'inline-block',
+                                              'position': 'relative',
+                                              'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            dcc.Input(type='number', id='position', style={
+                                'width': '90px', 'display': 'inline-block',
+                                'position': 'relative',
+                                'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            html.Label(dcc.Markdown('**Focal length:** '),
+                                       style={'display': 'inline-block',
+                                              'position': 'relative',
+                                              'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            dcc.Input(type='number', id='focal_length', style={
+                                'width': '100px', 'display': 'inline-block',
+                                'position': 'relative',
+                                'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            html.Button(id='make-button', n_clicks=0,
+                                        children='Create Element',
+                                        style={'display': 'inline-block',
+                                               'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            dcc.Textarea(
+                                id='output_text',
+                                placeholder='Enter a value...',
+                                value='Element,Position,Type,FocalLength',
+                                style={'min-width': '270px',
+                                       'display': 'inline-block',
+                                       'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block',
+                                            'position': 'relative'}),
+                            html.Button(id='load-button', n_clicks=0,
+                                        children='Load Optics',
+                                        style={'display': 'inline-block',
+                                               'vertical-align': 'top'})
+                        ], style={'columns': 1, 'display': 'table',
+                                  'overflow-x': 'auto', 'margin-left': 'auto',
+                                  'margin-right': 'auto'})
+                    ]),
+            dcc.Tab(label='Report', value='report', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        html.Div(children=[
+                            dcc.Markdown(exva.report_headline),
+                            html.Div(id='report-body')
+                        ], style={'max-width': '750px', 'margin-left': 'auto',
+                                  'margin-right': 'auto'})]),
+            dcc.Tab(label='Sweep', value='sweep', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        dcc.Graph(id='sweep-graph'),
+                        html.Div([
+                            dcc.Dropdown(
+                                id='sweep-element',
+                                options=element_options,
+                                value=1,
+                                style={'min-width': '100px',
+                                       'display': 'inline-block'},
+                                clearable=False
+                            ),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            dcc.RadioItems(
+                                id='sweep-parameter',
+                                options=[{'label': 'Position',
+                                          'value': 'Position'},
+                                         {'label': 'Focal length',
+                                          'value': 'FocalLength'}],
+                                value='Position',
+                                style={'display': 'inline-block',
+                                       'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            html.Label(dcc.Markdown('**From:** '),
+                                       style={'display': 'inline-block',
+                                              'vertical-align': 'top'}),
+                            dcc.Input(type='number', id='sweep-from',
+                                      value=-300, style={'width': '90px',
+                                             'display': 'inline-block',
+                                             'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            html.Label(dcc.Markdown('**To:** '),
+                                       style={'display': 'inline-block',
+                                              'vertical-align': 'top'}),
+                            dcc.Input(type='number', id='sweep-to', value=-100,
+                                      style={'width': '90px',
+                                             'display': 'inline-block',
+                                             'vertical-align': 'top'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            html.Button(id='sweep-button', n_clicks=0,
+                                        children='Sweep',
+                                        style={'display': 'inline-block',
+                                               'vertical-align': 'top'})
+                        ], style={'columns': 1, 'display': 'table',
+                                  'margin-left': 'auto',
+                                  'margin-right': 'auto'})
+                    ]),
+            dcc.Tab(label='Optimize', value='optimize', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        html.Div(children=[
+                            dcc.Markdown(exva.optimize_headline),
+                            html.Label('Target waist (mm): ', style={
+                                'width': 'one-column'}),
+                            dcc.Input(type='number', id='target-waist-box',
+                                      value=0.05, style={}),
+                            html.Label('Target focus position (mm): ', style={
                                 'width': 'one-column'}),
-                        dcc.Input(type='number', id='zmin-box',
-                                  value=init_z_min,
-                                  style={}),
-                        html.Label(
-                            'z max (mm): ', style={
+                            dcc.Input(type='number', id='target-z-box',
+                                      value=500, style={}),
+                            html.Label('Fixed elements: ', style={
                                 'width': 'one-column'}),
-                        dcc.Input(type='number', id='zmax-box',
-                                  value=init_z_max,
-                                  style={}),
-                        html.Label(
-                            'z step (mm): ', style={
+                            dcc.Dropdown(
+                                id='fixed-elements',
+                                options=element_options,
+                                value=[], multi=True),
+                            html.Label('Stock focal lengths (mm, optional): ',
+                                       style={'width': 'one-column'}),
+                            dcc.Input(type='text', id='focal-set-box',
+                                      placeholder='e.g. -50, 50, 100, 200',
+                                      value='', style={}),
+                            html.Div(style={'height': '10px'}),
+                            html.Button(id='optimize-button', n_clicks=0,
+                                        children='Optimize',
+                                        style={'display': 'inline-block'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            html.Button(id='apply-button', n_clicks=0,
+                                        children='Use result',
+                                        style={'display': 'inline-block'}),
+                            html.Div(id='optimize-body')
+                        ], style={'max-width': '750px', 'margin-left': 'auto',
+                                  'margin-right': 'auto'})]),
+            dcc.Tab(label='Tolerances', value='tolerance', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        html.Div(children=[
+                            dcc.Markdown(exva.tolerance_headline),
+                            html.Label('Position tolerance (mm): ', style={
                                 'width': 'one-column'}),
-                        dcc.Input(type='number', id='zstep-box',
-                                  value=init_z_step,
-                                  style={}),
-                        html.Div(style={'height': '10px'})
-                    ], style={'max-width': '750px', 'margin-left': 'auto',
-                              'margin-right': 'auto', 'columns': 2,
-                              'content-justification': 'center'}),
-                    html.Div(style={'min-height': '20px'}),
-                    html.Button(id='load-settings-button', n_clicks=0,
-                                children='Save settings',
-                                style={'width': '200px',
-                                       'transform': ' translate(-70%, -0%)',
-                                       'margin': 0, 'position': 'absolute',
-                                       'left': '50%'})]),
-        dcc.Tab(label='About', value='tab-3', style=tab_style,
-                selected_style=tab_selected_style, children=[
-                    html.Div(children=[
-                        dcc.Markdown(exva.about_text)
-                    ], style={'max-width': '750px', 'margin-left': 'auto',
-                              'margin-right': 'auto'})]),
-    ], style=tabs_styles,
-        colors={
-        "border": "#ccccff",
-            "primary": "red",
-            "background": "white"
-    }),
-    html.Div(id='optics-store', style={'display': 'none'},
-             children=optical_elements.to_json()),
-    html.Div(id='persistent-settings', style={'display': 'none'}, children=''),
-    html.Div(id='load-butt-clicks', style={'display': 'none'}, children='0'),
-    html.Div(id='make-butt-clicks', style={'display': 'none'}, children='0'),
-    html.Div(id='auth', style={'display': 'none'}),
-    html.Div(id='auth2', style={'display': 'none'}, children='')
-])
-
-
-@app.callback(
-    [Output('auth', 'children')], [Input('auth2', 'children')])
-def access_log(children):
+                            dcc.Input(type='number', id='tol-position-box',
+                                      value=0.5, min=0, style={}),
+                            html.Label('Focal length tolerance (%): ',
+                                       style={'width': 'one-column'}),
+                            dcc.Input(type='number', id='tol-focal-box',
+                                      value=1, min=0, style={}),
+                            dcc.RadioItems(id='tol-distribution', options=[
+                                {'label': 'Normal', 'value': 'normal'},
+                                {'label': 'Uniform', 'value': 'uniform'}],
+                                value='normal',
+                                labelStyle={'display': 'inline-block'}),
+                            html.Label('Samples: ', style={
+                                'width': 'one-column'}),
+                            dcc.Input(type='number', id='tol-samples-box',
+                                      value=exva.tolerance_samples, min=1,
+                                      step=1, style={}),
+                            html.Div(style={'height': '10px'}),
+                            html.Button(id='tolerance-button', n_clicks=0,
+                                        children='Analyze'),
+                            html.Div(id='tolerance-status', children=''),
+                            html.Div(id='tolerance-body'),
+                            dcc.Graph(id='tolerance-graph'),
+                            dcc.Interval(
+                                id='tolerance-interval',
+                                interval=exva.tolerance_poll_interval,
+                                disabled=True)
+                        ], style={'max-width': '750px', 'margin-left': 'auto',
+                                  'margin-right': 'auto'})]),
+            dcc.Tab(label='Catalog', value='catalog', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        html.Div(children=[
+                            dcc.Markdown(exva.catalog_headline),
+                            html.Label('Minimum diameter (mm): ', style={
+                                'width': 'one-column'}),
+                            dcc.Input(type='number', id='catalog-diameter-box',
+                                      value=None, style={}),
+                            html.Div(style={'height': '10px'}),
+                            html.Button(id='match-button', n_clicks=0,
+                                        children='Match stock lenses',
+                                        style={'display': 'inline-block'}),
+                            html.Div(id='catalog-matches'),
+                            html.Label('Target waist (mm): ', style={
+                                'width': 'one-column'}),
+                            dcc.Input(type='number', id='catalog-waist-box',
+                                      value=0.05, style={}),
+                            html.Label(
+                                'Target focus position (mm, optional): ',
+                                style={'width': 'one-column'}),
+                            dcc.Input(type='number', id='catalog-z-box',
+                                      value=None, style={}),
+                            html.Div(style={'height': '10px'}),
+                            html.Button(id='design-button', n_clicks=0,
+                                        children='Search designs',
+                                        style={'display': 'inline-block'}),
+                            html.Div(id='catalog-designs')
+                        ], style={'max-width': '750px', 'margin-left': 'auto',
+                                  'margin-right': 'auto'})]),
+            dcc.Tab(label='Settings', value='tab-2', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        html.Div(style={'min-height': '20px'}),
+                        html.Div(children=[
+                            html.Label('x plot scale: ',
+                                       style={'width': '100px',
+                                              'display': 'inline-block'}),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            html.Label('y plot scale: ',
+                                       style={'width': '100px',
+                                              'display': 'inline-block'}),
+                            html.Div(),
+                            dcc.Dropdown(
+                                id='xscale-drop',
+                                options=scale_options,
+                                value='1',
+                                style={
+                                    'width': '100px',
+                                    'display': 'inline-block'},
+                                clearable=False
+                            ),
+                            html.Div(style={'width': '10px',
+                                            'display': 'inline-block'}),
+                            dcc.Dropdown(
+                                id='yscale-drop',
+                                options=scale_options,
+                                value='1',
+                                style={
+                                    'width': '100px',
+                                    'display': 'inline-block'},
+                                clearable=False
+                            ),
+                            html.Label('Wavelength (nm): ', style={
+                                'width': 'one-column'}),
+                            dcc.Input(type='number', id='wavelength-box',
+                                      value=init_wavelength, style={}),
+                            html.Label('Starting waist (mm): ', style={
+                                'width': 'one-column'}),
+                            dcc.Input(type='number', id='waist-box',
+                                      value=init_waist, style={}),
+                            html.Div(),
+                            html.Div(dcc.Markdown(exva.checkbox_labels),
+                                     style={'display': 'inline-block'}),
+                            html.Div(style={'width': '20px',
+                                            'display': 'inline-block'}),
+                            dcc.Checklist(id='more-options', options=[
+                                {'label': '', 'value': 'double_sided'},
+                                {'label': '', 'value': 'reset_index'},
+                                {'label': '', 'value': 'adaptive'},
+                                {'label': '', 'value': 'drag'}],
+                                style={'display': 'inline-block'},
+                                value=init_options),
+                            html.Label(
+                                'z min (mm): ', style={
+                                    'width': 'one-column'}),
+                            dcc.Input(type='number', id='zmin-box',
+                                      value=init_z_min,
+                                      style={}),
+                            html.Label(
+                                'z max (mm): ', style={
+                                    'width': 'one-column'}),
+                            dcc.Input(type='number', id='zmax-box',
+                                      value=init_z_max,
+                                      style={}),
+                            html.Label(
+                                'z step (mm): ', style={
+                                    'width': 'one-column'}),
+                            dcc.Input(type='number', id='zstep-box',
+                                      value=init_z_step,
+                                      style={}),
+                            html.Label(
+                                'Plotted points: ', style={
+                                    'width': 'one-column'}),
+                            dcc.Input(type='number', id='points-box',
+                                      value=init_plot_points, min=3, step=1,
+                                      style={}),
+                            html.Label(
+                                'Spectrum (nm): ', style={
+                                    'width': 'one-column'}),
+                            dcc.Input(type='text', id='wavelengths-box',
+                                      value=init_wavelengths,
+                                      placeholder='e.g. 780:820:41',
+                                      style={}),
+                            html.Label(
+                                'Lens glass: ', style={
+                                    'width': 'one-column'}),
+                            dcc.Input(type='text', id='glass-box',
+                                      value=init_glass,
+                                      placeholder='e.g. N-BK7, 3: CaF2',
+                                      style={}),
+                            dcc.RadioItems(id='spectrum-radio', options=[
+                                {'label': 'Envelope', 'value': 'envelope'},
+                                {'label': 'Lines', 'value': 'lines'}],
+                                value=init_spectrum,
+                                labelStyle={'display': 'inline-block'}),
+                            html.Div(id='settings-status', children=''),
+                            html.Div(style={'height': '10px'})
+                        ], style={'max-width': '750px', 'margin-left': 'auto',
+                                  'margin-right': 'auto', 'columns': 2,
+                                  'content-justification': 'center'}),
+                        html.Div(style={'min-height': '20px'}),
+                        html.Button(id='load-settings-button', n_clicks=0,
+                                    children='Save settings',
+                                    style={'width': '200px',
+                                           'transform':
+                                               ' translate(-70%, -0%)',
+                                           'margin': 0, 'position': 'absolute',
+                                           'left': '50%'})]),
+            dcc.Tab(label='About', value='tab-3', style=tab_style,
+                    selected_style=tab_selected_style, children=[
+                        html.Div(children=[
+                            dcc.Markdown(exva.about_text)
+                        ], style={'max-width': '750px', 'margin-left': 'auto',
+                                  'margin-right': 'auto'})]),
+        ], style=tabs_styles,
+            colors={
+            "border": "#ccccff",
+                "primary": "red",
+                "background": "white"
+        }),
+        html.Div(id='optics-store', style={'display': 'none'},
+                 children=optical_elements.encode()),
+        html.Div(id='persistent-settings', style={'display': 'none'},
+                 children=''),
+        html.Div(id='load-butt-clicks', style={'display': 'none'},
+                 children='0'),
+        html.Div(id='make-butt-clicks', style={'display': 'none'},
+                 children='0'),
+        html.Div(id='apply-butt-clicks', style={'display': 'none'},
+                 children='0'),
+        html.Div(id='optimize-result', style={'display': 'none'}, children=''),
+        html.Div(id='tolerance-run', style={'display': 'none'}, children=''),
+        html.Div(id='figure-store', style={'display': 'none'}, children=''),
+        html.Div(id='figure-key', style={'display': 'none'}, children=''),
+        html.Div(id='figure-template', style={'display': 'none'},
+                 children=plot_template()),
+        html.Div(id='drag-commit', style={'display': 'none'}, children=''),
+        html.Div(id='drag-count', style={'display': 'none'}, children='0'),
+        html.Div(id='auth', style={'display': 'none'}),
+        html.Div(id='auth2', style={'display': 'none'}, children='')
+    ])
+    return(main_layout)
+
+
+def serve_layout():
+    # Every page load gets its own session ID
+    return(html.Div([
+        make_layout(),
+        html.Div(id='session-id', style={'display': 'none'},
+                 children=uuid.uuid4().hex)]))
+
+
+
+@route('/api/beam', methods=['POST'])
+def api_beam():
+    # The physics without the UI, see api.py for the format
+    try:
+        name = api.choose_format(request.args.get('format'),
+                                 request.headers.get('Accept', ''))
+        settings, systems, single = api.read_request(
+            request.get_data(), request.content_type or '',
+            read_default_settings(),
+            exva.api_max_systems, exva.api_max_points)
+        dtype = api.read_dtype(request.args.get('dtype', 'float64'))
+        if name == 'json':
+            api.check_json(settings, systems, exva.max_grid_points)
+    except ValueError as error:
+        return(Response(json.dumps({'error': str(error)}), status=400,
+                        mimetype='application/json'))
+    report = request.args.get('report', '1') != '0'
+    # Computed one at a time as the response is written
+    results = (beam_result(settings, system, report) for system in systems)
+    if name == 'ndjson':
+        return(Response(api.write_ndjson(results, exva.api_chunk_points),
+                        mimetype=api.formats[name]))
+    elif name == 'npy':
+        return(Response(api.write_npy(results, len(systems), dtype),
+                        mimetype=api.formats[name]))
+    return(Response(api.write_json(results, single),
+                    mimetype=api.formats[name]))
+
+
+@callback(
+    [Output('auth', 'children')], [Input('auth2', 'children')],
+    [State('session-id', 'children')])
+def access_log(children, session=None):
     if use_logfile:
-        if use_password:
-            usr = request.authorization['username']
-        else:
-            usr = 'anonymous'
-        nowstr = datetime.now().isoformat(timespec='seconds', sep=' ')
-        logstr = nowstr + ' Connection by ' + usr + '\n'
-        with open(logfile_name, 'a') as logfile:
-            logfile.write(logstr)
+        access_logger.log('connection', user=request_user(), session=session)
     return([None])
 
 
-@app.callback(
+@callback(
     [Output('Infobox', 'children'), Output('position', 'value'),
      Output('focal_length', 'value')],
     [Input('element_select', 'value')], [State('optics-store', 'children')])
 def update_output_div(input_value, compressed_optics):
     chosen = int(input_value)
-    optics = pd.read_json(compressed_optics)
-    chosen_index = optics.loc[optics['Element'] == chosen].index[0]
-    teh_type = optics.at[chosen_index, 'Type']
-    teh_position = optics.at[chosen_index, 'Position']
-    focal = optics.at[chosen_index, 'FocalLength']
+    optics = OpticalSystem.decode(compressed_optics).record(chosen)
+    teh_type = int(optics['Type'])
+    teh_position = float(optics['Position'])
+    focal = float(optics['FocalLength'])
     return ['Element {} is {}. '.format(input_value, characterize(teh_type)),
             teh_position, focal]
 
 
-@app.callback(
-    [Output('persistent-settings', 'children')],
+@callback(
+    [Output('persistent-settings', 'children'),
+        Output('settings-status', 'children')],
     [Input('load-settings-button', 'n_clicks')],
     [State('xscale-drop', 'value'),
         State('yscale-drop', 'value'), State('wavelength-box', 'value'),
         State('waist-box', 'value'), State('zmin-box', 'value'),
         State('zmax-box', 'value'), State('zstep-box', 'value'),
-        State('more-options', 'value')])
+        State('points-box', 'value'), State('more-options', 'value'),
+        State('wavelengths-box', 'value'), State('glass-box', 'value'),
+        State('spectrum-radio', 'value'), State('session-id', 'children')])
 def update_settings(clicks, xscale, yscale, wl, waist, zmin, zmax, zstep,
-                    options):
+                    points, options, wavelengths='', glass='',
+                    spectrum='envelope', session=None):
     # One thing to consider here is adding a "load/save settings" box
     # similar to that for the data.
     # In that case I'll add the same outputs as states.
@@ -435,6 +1190,7 @@ def update_settings(clicks, xscale, yscale, wl, waist, zmin, zmax, zstep,
     settings['z_min'] = zmin
     settings['z_max'] = zmax
     settings['z_step'] = zstep
+    settings['plot_points'] = read_plot_points(points)
     settings['double_sided'] = 1
     if 'double_sided' in options:
         settings['double_sided'] = 1
@@ -444,149 +1200,524 @@ def update_settings(clicks, xscale, yscale, wl, waist, zmin, zmax, zstep,
         settings['reset_index'] = 1
     else:
         settings['reset_index'] = 0
-    return([json.dumps(settings)])
+    if 'adaptive' in options:
+        settings['adaptive'] = 1
+    else:
+        settings['adaptive'] = 0
+    if 'drag' in options:
+        settings['drag'] = 1
+    else:
+        settings['drag'] = 0
+    settings['wavelengths'] = wavelengths or ''
+    settings['glass'] = glass or ''
+    settings['spectrum'] = spectrum
+    try:
+        dispersion.parse_wavelengths(settings['wavelengths'],
+                                     exva.max_wavelengths)
+        dispersion.parse_glasses(settings['glass'])
+    except ValueError as error:
+        # The settings in use stay as they are
+        return([dash.no_update, str(error)])
+    state = session_state(session)
+    if state is not None:
+        state.put('settings', json.dumps(settings))
+    return([json.dumps(settings), ''])
 
 
-@app.callback(
+@callback(
     [Output('optics-store', 'children'),
         Output('load-butt-clicks', 'children'),
-        Output('make-butt-clicks', 'children')],
-    [Input('position', 'value'),
-     Input('focal_length', 'value'), Input('load-button', 'n_clicks'),
-     Input('make-button', 'n_clicks')],
-    [State('optics-store', 'children'),
+        Output('make-butt-clicks', 'children'),
+        Output('apply-butt-clicks', 'children'),
+        Output('drag-count', 'children')],
+    [Input('position', 'n_submit'), Input('position', 'n_blur'),
+     Input('focal_length', 'n_submit'), Input('focal_length', 'n_blur'),
+     Input('load-button', 'n_clicks'),
+     Input('make-button', 'n_clicks'), Input('apply-button', 'n_clicks'),
+     Input('drag-commit', 'children')],
+    [State('position', 'value'), State('focal_length', 'value'),
+     State('optics-store', 'children'),
      State('load-butt-clicks', 'children'),
      State('make-butt-clicks', 'children'),
+     State('apply-butt-clicks', 'children'),
+     State('drag-count', 'children'),
      State('output_text', 'value'),
      State('element_select', 'value'),
-     State('persistent-settings', 'children')])
-def move_lenses(posvalue, focal, load_clicks, make_clicks, compressed_optics,
-                load_numclicks, make_numclicks, load_text, which_one,
-                compressed_settings):
+     State('persistent-settings', 'children'),
+     State('optimize-result', 'children'), State('session-id', 'children')])
+def move_lenses(pos_submit, pos_blur, focal_submit, focal_blur, load_clicks,
+                make_clicks, apply_clicks, drag_commit, posvalue, focal,
+                compressed_optics, load_numclicks, make_numclicks,
+                apply_numclicks, drag_numcommits, load_text, which_one,
+                compressed_settings, optimized_optics, session=None):
     # There's a lot of acrobatics around the "clicks" and "numclicks"
     # which just keeps track of whether a button has been pressed
-    # since last time we ran this.
+    # since last time we ran this. The position and focal length boxes
+    # only count when committed (Enter or leaving the box); while typing
+    # (or dragging) the plot is updated in the browser, see
+    # assets/beam_preview.js.
+    # The optics (and settings) kept for the session win over the ones the
+    # page sends: two quick edits are both sent with the optics from before
+    # the first one.
 
-    optics = pd.read_json(compressed_optics)
+    state = session_state(session)
+    if state is not None:
+        compressed_optics = state.get('optics', compressed_optics)
+        compressed_settings = state.get('settings', compressed_settings)
+    optics = OpticalSystem.decode(compressed_optics)
     settings = json.loads(compressed_settings)
     l_clicks = int(load_numclicks)
     m_clicks = int(make_numclicks)
+    a_clicks = int(apply_numclicks)
     old_load_clicks = int(load_clicks)
     old_make_clicks = int(make_clicks)
-    last_optic = optics.tail(1)
+    old_apply_clicks = int(apply_clicks)
+    drag = json.loads(drag_commit) if drag_commit else {'count': 0}
+    d_commits = int(drag_numcommits)
     chosen = int(which_one)
-    chosen_index = optics.loc[optics['Element'] == chosen].index[0]
     if l_clicks != old_load_clicks:
         try:
-            optics = pd.read_csv(StringIO(load_text), dtype=exva.optics_dtypes)
+            optics = OpticalSystem.from_csv(load_text)
         except ValueError:
             # If the user puts some useless data here we'll just reset the box
             pass
         if settings['reset_index']:
-            optics['Element'] = optics.index
+            optics.renumber()
     elif m_clicks != old_make_clicks:
-        last_place = float(last_optic['Position'])
-        new_optic = pd.DataFrame({
-            'Type': [1],
-            'Position': [last_place+10],
-            'FocalLength': [100],
-            'Element': len(optical_elements)})
-        optics = optics.append(new_optic)
+        last_place = float(optics['Position'][-1])
+        # A new ID, whatever the IDs of the others are
+        optics.insert(int(optics['Element'].max()) + 1, last_place+10, 1,
+                      100)
+    elif a_clicks != old_apply_clicks:
+        if optimized_optics:
+            optics = OpticalSystem.decode(optimized_optics)
+    elif drag['count'] != d_commits:
+        try:
+            optics.move(drag['element'], float(drag['position']))
+        except KeyError:
+            # Dragged something that was removed in the meantime
+            pass
     else:
         try:
-            optics.at[chosen_index, 'Position'] = float(posvalue)
-            optics.at[chosen_index, 'FocalLength'] = float(focal)
+            optics.set_focal_length(chosen, float(focal))
+            optics.move(chosen, float(posvalue))
         except TypeError:
             pass
-    optics = update_optics(optics)
-    return([optics.to_json(), load_clicks, make_clicks])
+    compressed_optics = optics.encode()
+    if state is not None:
+        state.put('optics', compressed_optics)
+    return([compressed_optics, load_clicks, make_clicks, apply_clicks,
+            str(drag['count'])])
+
 
+# The main plot is drawn in the browser, from the server's figure or from a
+# local preview while elements are being moved
 
-@app.callback(
-    [Output('main-graph', 'figure'), Output('output_text', 'value'),
-     Output('element_select', 'options'), Output('report-body', 'children')],
+preview_callback = (
+    ClientsideFunction(namespace='beampage', function_name='preview'),
+    [Output('main-graph', 'figure'), Output('main-graph', 'config'),
+     Output('drag-commit', 'children')],
+    [Input('figure-store', 'children'), Input('main-graph', 'relayoutData'),
+     Input('position', 'value'), Input('focal_length', 'value')],
+    [State('element_select', 'value'), State('drag-commit', 'children'),
+     State('figure-template', 'children')])
+
+
+def compute_figure(settings, compressed_optics, session=None, ticket=None):
+    # Everything update_figure sends back but the key, run in the pool. The
+    # table shows the origin at z min, as the physics uses it.
+    optical_elements = set_origin(settings,
+                                  OpticalSystem.decode(compressed_optics))
+    w_z, show_lenses, segments = calc_results(settings, optical_elements)
+    spectrum = calc_spectrum(settings, optical_elements)
+    check_latest(session, 'figure', ticket)
+    fig = build_figure(settings, w_z, show_lenses, segments, spectrum)
+    options = [{'label': i, 'value': i}
+               for i in optical_elements['Element'][1:].tolist()]
+    check_latest(session, 'figure', ticket)
+    return([figure_payload(fig, settings, optical_elements, show_lenses),
+            optical_elements.to_csv(), options, options, options])
+
+
+@callback(
+    [Output('figure-store', 'children'), Output('output_text', 'value'),
+     Output('element_select', 'options'), Output('sweep-element', 'options'),
+     Output('fixed-elements', 'options'), Output('figure-status', 'children'),
+     Output('figure-key', 'children')],
     [Input('optics-store', 'children'),
-     Input('persistent-settings', 'children')])
-def update_figure(compressed_optics, compressed_settings):
+     Input('persistent-settings', 'children')],
+    [State('session-id', 'children'), State('figure-key', 'children')])
+def update_figure(compressed_optics, compressed_settings, session=None,
+                  shown_key=None):
+    # figure-key works like an ETag: the page sends back the key of what it
+    # shows, and gets nothing (204) if that's still up to date
     settings = json.loads(compressed_settings)
-    optical_elements = pd.read_json(compressed_optics)
-    w_z, show_lenses, report_text = calc_gaussian(settings, optical_elements)
-    z_max = float(settings['z_max'])
-    z_min = float(settings['z_min'])
-    z_step = float(settings['z_step'])
-    z_grid = np.arange(z_min, z_max, z_step)
-    double_sided = int(settings['double_sided'])
-    x_scaling_factor = float(settings['x_scale'])
-    y_scaling_factor = float(settings['y_scale'])
+    key = figure_key(compressed_optics, settings)
+    if key == shown_key:
+        raise PreventUpdate
+    if use_cache:
+        blob = result_cache.get(key)
+        if blob is not None:
+            return(json.loads(blob) + ['', key])
+    # Quick edits queue up figure updates that are outdated before they are
+    # done, so only the newest one of the session is finished
+    ticket = take_ticket(session, 'figure')
+    try:
+        outputs = offload(compute_figure, settings, compressed_optics,
+                          session, ticket)
+    except (workers.Busy, workers.Timeout) as error:
+        # The plot stays as it is, and the old key lets a retry through
+        return([dash.no_update] * 5 + [refusal_text(error), dash.no_update])
+    if use_cache:
+        result_cache.put(key, json.dumps(outputs).encode())
+    return(outputs + ['', key])
 
-    xlabel = 'z' + scale_text(x_scaling_factor)
-    ylabel = 'Width' + scale_text(y_scaling_factor)
 
-    fig = px.line(x=z_grid / x_scaling_factor, y=w_z / y_scaling_factor,
-                  labels={'x': xlabel, 'y': ylabel})
-    if double_sided:
-        fig2 = px.line(x=z_grid / x_scaling_factor, y=-w_z / y_scaling_factor,
-                       labels={'x': xlabel, 'y': ylabel})
-        fig.add_trace(fig2.data[0])
-    for element_name, element_position in zip(show_lenses[0], show_lenses[1]):
-        if double_sided:
-            fig.add_annotation(
-                x=element_position[0] / x_scaling_factor,
-                y=-element_position[1] / y_scaling_factor,
-                text=element_name,
-                ayref='y',
-                ay=element_position[1] / (y_scaling_factor * 1.5))
-        else:
-            fig.add_annotation(
-                x=element_position[0] / x_scaling_factor,
-                y=element_position[1] / y_scaling_factor,
-                text=element_name,
-                ayref='y',
-                ay=element_position[1] / (y_scaling_factor * 2))
-    fig.update_annotations(dict(
-        xref="x",
-        yref="y",
-        showarrow=True,
-        arrowhead=7,
-        ax=0,
-    ))
-    wherefocus = np.where(w_z == min(w_z))[0][0]
-    minspot_text = exva.minspot.format(w_z[wherefocus],
-                                       z_grid[wherefocus])
-    options = [{'label': i, 'value': i}
-               for i in optical_elements['Element'][1:]]
-    nice_optics = optical_elements.loc[:, ['Element',
-                                           'Type',
-                                           'Position',
-                                           'FocalLength']]
-    nice_optics['Type'] = nice_optics.loc[:, 'Type'].apply(characterize,
-                                                           short=True)
-    i_am_the_table = nice_optics.to_markdown(
-        index=False,
-        headers=[
-            'Element',
-            'Type',
-            'Position (mm)',
-            'Focal length (mm)']) + '\n'
+def compute_report(settings, compressed_optics):
+    optical_elements = set_origin(settings,
+                                  OpticalSystem.decode(compressed_optics))
+    w_z, show_lenses, segments = calc_results(settings, optical_elements)
+    return(calc_report(settings, optical_elements, segments) +
+           (calc_chromatic_report(settings, optical_elements),))
+
 
-    total_report = html.Div(children=[
+@callback(
+    [Output('report-body', 'children')],
+    [Input('all-tabs-inline', 'value'), Input('optics-store', 'children'),
+     Input('persistent-settings', 'children')])
+def update_report(tab, compressed_optics, compressed_settings):
+    # Only written while the Report tab is open; switching to the tab
+    # brings it up to date
+    if tab != 'report':
+        raise PreventUpdate
+    settings = json.loads(compressed_settings)
+    try:
+        minspot_text, table, report_text, chromatic_text = offload(
+            compute_report, settings, compressed_optics)
+    except (workers.Busy, workers.Timeout) as error:
+        return([dcc.Markdown(refusal_text(error))])
+    return([html.Div(children=[
         dcc.Markdown(minspot_text),
         dcc.Markdown(exva.table_headline),
-        dcc.Markdown(i_am_the_table),
-        dcc.Markdown(report_text)
-    ])
-    return [
-        fig,
-        optical_elements.to_csv(
-            columns=[
-                'Element',
-                'Position',
-                'Type',
-                'FocalLength'],
-            index=False),
-        options,
-        total_report]
+        dcc.Markdown(table),
+        dcc.Markdown(report_text),
+        dcc.Markdown(chromatic_text)
+    ])])
+
+
+@callback(
+    [Output('sweep-graph', 'figure')],
+    [Input('sweep-button', 'n_clicks')],
+    [State('sweep-element', 'value'), State('sweep-parameter', 'value'),
+     State('sweep-from', 'value'), State('sweep-to', 'value'),
+     State('optics-store', 'children'),
+     State('persistent-settings', 'children')])
+def update_sweep(clicks, element, parameter, sweep_from, sweep_to,
+                 compressed_optics, compressed_settings):
+    # Also called on page load, before there are any settings
+    if not clicks or not compressed_settings:
+        raise PreventUpdate
+    settings = json.loads(compressed_settings)
+    optical_elements = OpticalSystem.decode(compressed_optics)
+    values = np.linspace(float(sweep_from), float(sweep_to),
+                         exva.sweep_points)
+    result = sweep_element(settings, optical_elements, int(element),
+                           parameter, values)
+    xlabel = ('Position' if parameter == 'Position' else
+              'Focal length') + ' of element {} (mm)'.format(element)
+    import plotly.express as px
+    fig = px.line(x=values, y=result.waist,
+                  labels={'x': xlabel, 'y': 'Final waist (mm)'})
+    fig.update_traces(customdata=result.z_origin,
+                      hovertemplate=exva.sweep_hover)
+    return([fig])
+
+
+@callback(
+    [Output('optimize-body', 'children'),
+     Output('optimize-result', 'children')],
+    [Input('optimize-button', 'n_clicks')],
+    [State('target-waist-box', 'value'), State('target-z-box', 'value'),
+     State('fixed-elements', 'value'), State('focal-set-box', 'value'),
+     State('optics-store', 'children'),
+     State('persistent-settings', 'children')])
+def update_optimize(clicks, target_waist, target_z, fixed, focal_text,
+                    compressed_optics, compressed_settings):
+    if not clicks:
+        return(['', ''])
+    settings = json.loads(compressed_settings)
+    try:
+        focal_set = [float(f) for f in focal_text.split(',') if f.strip()]
+    except ValueError:
+        return([dcc.Markdown(exva.optimize_bad_set), ''])
+    try:
+        target_waist, target_z = float(target_waist), float(target_z)
+        history, waist, z_origin, compressed_optics = offload(
+            compute_optimize, settings, compressed_optics, target_waist,
+            target_z, fixed or [], focal_set)
+    except (TypeError, ValueError):
+        return([dcc.Markdown(exva.optimize_bad_target), ''])
+    except (workers.Busy, workers.Timeout) as error:
+        return([dcc.Markdown(refusal_text(error)), dash.no_update])
+    optics = OpticalSystem.decode(compressed_optics)
+    table = optics.to_frame().loc[:, ['Element', 'Position',
+                                      'FocalLength']].to_markdown(
+        index=False,
+        headers=['Element', 'Position (mm)', 'Focal length (mm)']) + '\n'
+    return([html.Div(children=[
+        dcc.Markdown(exva.optimize_result.format(waist, z_origin)),
+        dcc.Markdown(table),
+        dcc.Markdown(exva.optimize_history_headline),
+        dcc.Markdown(history)]), compressed_optics])
+
+
+def compute_optimize(settings, compressed_optics, target_waist, target_z,
+                     fixed, focal_set):
+    # The optimizer run of update_optimize, in the compute pool. Returns
+    # the improvements as text, the best waist and focus and the system.
+    runs = optimize_optics(
+        settings, OpticalSystem.decode(compressed_optics), target_waist,
+        target_z, fixed=fixed, focal_set=focal_set or None,
+        time_limit=exva.optimize_time_limit)
+    history = ''
+    started = datetime.now()
+    # make_problem checks the targets before the first candidate
+    for best, optics in runs:
+        elapsed = (datetime.now() - started).total_seconds()
+        history += exva.optimize_entry.format(elapsed, best.waist,
+                                              best.z_origin, best.cost)
+    return(history, float(best.waist), float(best.z_origin),
+           optics.encode())
+
+
+def run_tolerance(run, settings, compressed_optics, samples,
+                  position_spread, focal_spread, distribution):
+    # In the background: leaves a summary of the statistics so far in the
+    # run store every now and then, for poll_tolerance
+    state = sessions.Session(run_store, run)
+    optical_elements = OpticalSystem.decode(compressed_optics)
+    written = 0.
+    try:
+        for done, stats in tolerance_analysis(
+                settings, optical_elements, samples, position_spread,
+                focal_spread, distribution,
+                workers=exva.tolerance_workers):
+            if (done == samples or time.monotonic() - written >
+                    exva.tolerance_update_interval):
+                progress = {name: tolerance.summarize(
+                    stats[name], exva.tolerance_percentiles)
+                    for name in tolerance.quantities}
+                progress.update(done=done, samples=samples)
+                state.put('tolerance', json.dumps(progress))
+                written = time.monotonic()
+    except Exception as error:
+        # Or else the page would wait for it forever
+        state.put('tolerance', json.dumps({'error': str(error)}))
+
+
+def tolerance_text(progress):
+    text = exva.tolerance_progress.format(progress['done'],
+                                          progress['samples'])
+    text += ('| | Mean (mm) | Std. dev. (mm) | ' +
+             ' | '.join('{} %'.format(q) for q in exva.tolerance_percentiles) +
+             ' | Min (mm) | Max (mm) |\n' +
+             '|:--|' + '--:|' * (len(exva.tolerance_percentiles) + 4) + '\n')
+    for name, label in (('waist', 'Final waist'),
+                        ('z_origin', 'Focus position')):
+        summary = progress[name]
+        text += exva.tolerance_row.format(
+            label, summary['mean'], summary['std'],
+            ' | '.join('{:.4f}'.format(value)
+                       for value in summary['percentiles']),
+            summary['minimum'], summary['maximum'])
+    for name, label in (('waist', 'waist'), ('z_origin', 'focus position')):
+        if progress[name]['outside']:
+            text += exva.tolerance_outside.format(progress[name]['outside'],
+                                                  label)
+    return(text)
+
+
+def tolerance_figure(progress):
+    # Histograms of the final waist and focus position, side by side
+    from plotly.subplots import make_subplots
+    import plotly.graph_objects as go
+    fig = make_subplots(rows=1, cols=2)
+    for column, name, label in ((1, 'waist', 'Final waist (mm)'),
+                                (2, 'z_origin', 'Focus position (mm)')):
+        edges = np.array(progress[name]['edges'])
+        fig.add_trace(go.Bar(x=(edges[1:] + edges[:-1]) / 2,
+                             y=progress[name]['counts'],
+                             width=np.diff(edges), marker_color='#636efa',
+                             name=label), row=1, col=column)
+        fig.update_xaxes(title_text=label, row=1, col=column)
+    fig.update_yaxes(title_text='Samples', row=1, col=1)
+    fig.update_layout(showlegend=False, bargap=0)
+    return(fig)
+
+
+@callback(
+    [Output('tolerance-run', 'children'),
+     Output('tolerance-status', 'children')],
+    [Input('tolerance-button', 'n_clicks')],
+    [State('tol-position-box', 'value'), State('tol-focal-box', 'value'),
+     State('tol-distribution', 'value'), State('tol-samples-box', 'value'),
+     State('optics-store', 'children'),
+     State('persistent-settings', 'children')])
+def start_tolerance(clicks, position_spread, focal_percent, distribution,
+                    samples, compressed_optics, compressed_settings):
+    # Starts an analysis in the background, poll_tolerance follows it
+    if not clicks:
+        raise PreventUpdate
+    samples = int(samples or 0)
+    if not 0 < samples <= exva.tolerance_max_samples:
+        return([dash.no_update, exva.tolerance_bad_samples.format(
+            exva.tolerance_max_samples)])
+    run = uuid.uuid4().hex
+    args = (run, json.loads(compressed_settings), compressed_optics, samples,
+            float(position_spread or 0), float(focal_percent or 0) / 100,
+            distribution)
+    if use_pool:
+        try:
+            tolerance_pool.submit(run_tolerance, *args)
+        except workers.Busy as error:
+            return([dash.no_update, refusal_text(error)])
+    else:
+        threading.Thread(target=run_tolerance, args=args,
+                         daemon=True).start()
+    return([run, ''])
+
+
+@callback(
+    [Output('tolerance-body', 'children'),
+     Output('tolerance-graph', 'figure'),
+     Output('tolerance-interval', 'disabled')],
+    [Input('tolerance-run', 'children'),
+     Input('tolerance-interval', 'n_intervals')])
+def poll_tolerance(run, intervals):
+    # Shows how far the analysis has got, and stops polling when it's done
+    if not run:
+        raise PreventUpdate
+    progress = sessions.Session(run_store, run).get('tolerance')
+    if progress is None:
+        return([dash.no_update, dash.no_update, False])
+    progress = json.loads(progress)
+    if 'error' in progress:
+        return([dcc.Markdown(exva.tolerance_failed.format(
+            progress['error'])), dash.no_update, True])
+    return([dcc.Markdown(tolerance_text(progress)),
+            tolerance_figure(progress),
+            progress['done'] == progress['samples']])
+
+
+@callback(
+    [Output('catalog-matches', 'children')],
+    [Input('match-button', 'n_clicks')],
+    [State('catalog-diameter-box', 'value'),
+     State('optics-store', 'children'),
+     State('persistent-settings', 'children')])
+def update_matches(clicks, diameter, compressed_optics, compressed_settings):
+    if not clicks:
+        return([''])
+    try:
+        diameter = read_diameter(diameter)
+    except (TypeError, ValueError):
+        return([dcc.Markdown(exva.catalog_bad_diameter)])
+    settings = json.loads(compressed_settings)
+    optical_elements = OpticalSystem.decode(compressed_optics)
+    matches = match_stock_lenses(settings, optical_elements, get_catalog(),
+                                 diameter=diameter)
+    import pandas as pd
+    table = pd.DataFrame(matches, columns=match_columns).to_markdown(
+        index=False, headers=[
+            'Element', 'Focal length (mm)', 'Vendor', 'Part',
+            'Stock focal length (mm)', 'Diameter (mm)']) + '\n'
+    return([dcc.Markdown(table)])
+
+
+@callback(
+    [Output('catalog-designs', 'children')],
+    [Input('design-button', 'n_clicks')],
+    [State('catalog-diameter-box', 'value'),
+     State('catalog-waist-box', 'value'), State('catalog-z-box', 'value'),
+     State('optics-store', 'children'),
+     State('persistent-settings', 'children')])
+def update_designs(clicks, diameter, target_waist, target_z,
+                   compressed_optics, compressed_settings):
+    if not clicks:
+        return([''])
+    try:
+        diameter = read_diameter(diameter)
+    except (TypeError, ValueError):
+        return([dcc.Markdown(exva.catalog_bad_diameter)])
+    try:
+        target_waist = float(target_waist)
+        target_z = None if target_z in (None, '') else float(target_z)
+    except (TypeError, ValueError):
+        return([dcc.Markdown(exva.catalog_bad_target)])
+    if not (np.isfinite(target_waist) and target_waist > 0) or (
+            target_z is not None and not np.isfinite(target_z)):
+        return([dcc.Markdown(exva.catalog_bad_target)])
+    settings = json.loads(compressed_settings)
+    optical_elements = OpticalSystem.decode(compressed_optics)
+    designs = search_stock_designs(
+        settings, optical_elements, get_catalog(), target_waist, target_z,
+        diameter)
+    if not designs:
+        return([dcc.Markdown(exva.catalog_nothing)])
+    text = ''
+    for design in designs:
+        text += exva.catalog_design.format(
+            ', '.join(part['Part'] for part in design.parts),
+            ', '.join('{:g}'.format(f) for f in design.focal_lengths),
+            design.waist, design.z_origin, design.error)
+    return([dcc.Markdown(text)])
+
+
+def create_app(preload=False):
+    # A new app with the layout, callbacks and routes above. preload also
+    # imports what is otherwise imported on first use, for gunicorn
+    # --preload: the workers then share one copy of it.
+    # Compression is set up here, not by Dash, to choose the algorithms
+    app = dash.Dash(__name__, external_stylesheets=external_stylesheets,
+                    compress=False)
+    app.title = 'beampage'
+    server = app.server
+    if use_password:
+        import dash_auth
+        dash_auth.BasicAuth(app, VALID_USERNAME_PASSWORD_PAIRS)
+    server.before_request(start_request_timer)
+    server.after_request(count_request)
+    if use_compression:
+        # After count_request, so that it runs first (Flask runs them in
+        # reverse) and the metrics see the compressed sizes
+        from flask_compress import Compress
+        server.config['COMPRESS_ALGORITHM'] = exva.compress_algorithms
+        Compress(server)
+    for rule, options, func in routes:
+        server.route(rule, **options)(func)
+    register = app.callback
+    if use_metrics:
+        # Rows of earlier runs and their dead workers
+        app_metrics.forget_processes()
+        register = metrics.instrument(register, app_metrics,
+                                      note=note_callback)
+    for args, kwargs, func in callbacks:
+        register(*args, **kwargs)(func)
+    app.clientside_callback(*preview_callback)
+    app.layout = serve_layout
+    if preload:
+        for name in preload_modules:
+            importlib.import_module(name)
+        make_layout()
+    if use_logfile:
+        access_logger.log('restart')
+    return(app)
+
+
+def create_server(preload=True):
+    # For gunicorn: gunicorn --preload 'app:create_server()'
+    return(create_app(preload).server)
 
 
 if __name__ == '__main__':
-    app.run_server(debug=True)
+    create_app().run_server(debug=True)
@@ -0,0 +1,195 @@
+// Beam evaluation in the browser, so the main plot can follow the position
+// and focal length boxes (and lens annotations dragged in the plot) without
+// asking the server. Same physics as beam.py: the beam starts with its waist
+// at z min and every lens transforms q as 1/q' = 1/q - 1/f.
+// The server only hears about the final state: Enter or leaving the boxes,
+// or the end of a drag (through drag-commit).
+// The server sends the plotted trace separately (see codec.encode_trace) and
+// the mirrored trace and the template not at all, they are put back here.
+
+(function() {
+    // What the last call saw, to tell which input fired, and the optics as
+    // edited since the server last sent a figure
+    var last = {store: null, relayout: null, position: null, focal: null,
+                payload: null, optics: null};
+
+    function segments(optics, waist, wavelength) {
+        // Sorted copy of the system with the beam after every element
+        var order = optics.elements.map(function(e, i) { return i; });
+        order.sort(function(a, b) {
+            return optics.positions[a] - optics.positions[b] || a - b;
+        });
+        var out = [];
+        // q = re + i im, at the first element
+        var re = 0;
+        var im = Math.PI * waist * waist / wavelength;
+        var z = optics.positions[order[0]];
+        order.forEach(function(i) {
+            var position = optics.positions[i];
+            re += position - z;
+            z = position;
+            if (optics.types[i] === 1) {
+                // q / (1 - q / f)
+                var f = optics.focal_lengths[i];
+                var dre = 1 - re / f;
+                var dim = -im / f;
+                var norm = dre * dre + dim * dim;
+                var newre = (re * dre + im * dim) / norm;
+                im = (im * dre - re * dim) / norm;
+                re = newre;
+            }
+            out.push({element: optics.elements[i], start: position,
+                      z_origin: position - re, rayleigh: im,
+                      waist: Math.sqrt(im * wavelength / Math.PI)});
+        });
+        return out;
+    }
+
+    function width(z, segs) {
+        // Points before the first element belong to the first segment
+        var s = segs[0];
+        for (var i = 1; i < segs.length && segs[i].start <= z; i++) {
+            s = segs[i];
+        }
+        var x = (z - s.z_origin) / s.rayleigh;
+        return s.waist * Math.sqrt(1 + x * x);
+    }
+
+    function decode(data) {
+        // Lists come as they are, typed arrays as base64
+        if (!data.bdata) {
+            return data;
+        }
+        var text = atob(data.bdata);
+        var bytes = new Uint8Array(text.length);
+        for (var i = 0; i < text.length; i++) {
+            bytes[i] = text.charCodeAt(i);
+        }
+        var values = data.dtype === 'f4' ? new Float32Array(bytes.buffer)
+                                         : new Float64Array(bytes.buffer);
+        return Array.prototype.slice.call(values);
+    }
+
+    function expand(payload, template) {
+        // The whole figure, from what the server sent
+        var figure = payload.figure;
+        var x = decode(payload.traces.x);
+        var y = decode(payload.traces.y);
+        var mirrored = payload.preview.double_sided ? 2 : 1;
+        figure.data[0].x = x;
+        figure.data[0].y = y;
+        if (mirrored > 1) {
+            figure.data[1].x = x;
+            figure.data[1].y = y.map(function(v) { return -v; });
+        }
+        // The other wavelengths, if any, come with their own y
+        figure.data.slice(mirrored).forEach(function(trace) {
+            trace.x = x;
+            trace.y = decode(trace.y);
+        });
+        if (template) {
+            figure.layout.template = JSON.parse(template);
+        }
+        return payload;
+    }
+
+    function draw(payload, optics) {
+        var p = payload.preview;
+        var segs = segments(optics, p.waist, p.wavelength);
+        var figure = JSON.parse(JSON.stringify(payload.figure));
+        // The other wavelengths aren't followed, they'd only be misleading
+        figure.data = figure.data.slice(0, p.double_sided ? 2 : 1);
+        var x = [];
+        var y = [];
+        var step = (p.z_max - p.z_min) / Math.max(p.points - 1, 1);
+        for (var k = 0; k < p.points; k++) {
+            var z = p.z_min + k * step;
+            x.push(z / p.x_scale);
+            y.push(width(z, segs) / p.y_scale);
+        }
+        figure.data[0].x = x;
+        figure.data[0].y = y;
+        if (p.double_sided) {
+            figure.data[1].x = x;
+            figure.data[1].y = y.map(function(v) { return -v; });
+        }
+        (figure.layout.annotations || []).forEach(function(note, i) {
+            var element = p.annotated[i];
+            var s = segs.filter(function(s) {
+                return s.element === element;
+            })[0];
+            var w = width(s.start, segs) / p.y_scale;
+            note.x = s.start / p.x_scale;
+            note.y = p.double_sided ? -w : w;
+            note.ay = p.double_sided ? w / 1.5 : w / 2;
+        });
+        return figure;
+    }
+
+    function edit(optics, element, position, focal) {
+        // The origin always stays at z min
+        var i = optics.elements.indexOf(element);
+        if (i < 0 || optics.types[i] === 0) {
+            return;
+        }
+        if (position !== null) {
+            optics.positions[i] = position;
+        }
+        if (focal !== null) {
+            optics.focal_lengths[i] = focal;
+        }
+    }
+
+    function preview(store, relayout, position, focal, chosen, commit,
+                     template) {
+        var no_update = window.dash_clientside.no_update;
+        if (!store) {
+            return [no_update, no_update, no_update];
+        }
+        if (store !== last.store) {
+            last.payload = expand(JSON.parse(store), template);
+        }
+        var payload = last.payload;
+        var p = payload.preview;
+        var config = {edits: {annotationPosition: Boolean(p.drag)}};
+        var fired = {store: store !== last.store,
+                     relayout: relayout !== last.relayout,
+                     boxes: position !== last.position ||
+                            focal !== last.focal};
+        last.store = store;
+        last.relayout = relayout;
+        last.position = position;
+        last.focal = focal;
+        if (fired.store || last.optics === null) {
+            // A new figure from the server wins over any local edits
+            last.optics = JSON.parse(JSON.stringify(p.optics));
+            return [payload.figure, config, no_update];
+        }
+        if (fired.relayout && relayout) {
+            // A dragged annotation shows up as 'annotations[i].x'
+            for (var key in relayout) {
+                var match = /^annotations\[(\d+)\]\.x$/.exec(key);
+                if (match && p.drag) {
+                    var element = p.annotated[Number(match[1])];
+                    var z = relayout[key] * p.x_scale;
+                    edit(last.optics, element, z, null);
+                    var count = commit ? JSON.parse(commit).count : 0;
+                    return [draw(payload, last.optics), config,
+                            JSON.stringify({element: element, position: z,
+                                            count: count + 1})];
+                }
+            }
+            return [no_update, no_update, no_update];
+        }
+        if (fired.boxes && typeof position === 'number' &&
+                typeof focal === 'number') {
+            edit(last.optics, Number(chosen), position, focal);
+            return [draw(payload, last.optics), config, no_update];
+        }
+        return [no_update, no_update, no_update];
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        beampage: {preview: preview}
+    });
+})();
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Evaluating many saved systems at once, from the command line.
+
+    python batch.py 'systems/*.csv' -o summary.csv --curves curves.npy
+
+reads optics CSVs (as written by the Optics box of the app) from
+directories or globs, and evaluates them in a process pool. The summary
+gets one row per element, with the focus and Rayleigh range after it and
+the smallest spot of its system. Rows are written as the workers finish.
+The optional curves file is .npy, holding z in the first row and then w(z)
+of every system, in the order of the Row column of the summary (rows of
+files that couldn't be read are left at zero). The workers write their
+rows into it themselves, block by block (beam.width_blocks), so neither
+they nor the main process hold whole curves; --float32 halves the file.
+"""
+
+import argparse
+import csv
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+
+import api
+import beam
+import physics
+
+summary_columns = ['Row', 'File', 'Element', 'Position', 'Type',
+                   'FocalLength', 'FocusZ', 'Waist', 'Rayleigh',
+                   'MinSpot', 'MinSpotZ']
+
+
+def find_files(patterns):
+    # Directories mean every CSV in them
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.csv')
+        paths.extend(sorted(glob.glob(pattern)))
+    return(paths)
+
+
+def evaluate_file(row, path, settings, curves_path=None):
+    # Summary rows of one system, the same physics as the app. Its w(z)
+    # goes to row + 1 of the curves file, if there is one. Files are checked
+    # like systems sent to the API.
+    with open(path) as optics_file:
+        system = api.read_system(optics_file.read())
+    segments = physics.calc_segments(settings, system)
+    focus = physics.calc_focus(settings, segments)
+    rows = []
+    for index, record in enumerate(system.records):
+        rows.append([row, path, int(record['Element']),
+                     float(record['Position']), int(record['Type']),
+                     float(record['FocalLength']),
+                     float(segments.z_origin[index]),
+                     float(segments.waist[index]),
+                     float(segments.rayleigh[index]),
+                     float(focus.width), float(focus.z)])
+    if curves_path:
+        curves = np.load(curves_path, mmap_mode='r+')
+        grid = physics.settings_grid(settings)
+        for start, z, w in beam.width_blocks(grid, segments):
+            curves[row + 1, start:start + len(w)] = w
+        curves.flush()
+    return(row, rows)
+
+
+def evaluate_files(jobs, settings, curves_path=None):
+    # One task for a whole chunk of files, one file takes too little time
+    # to be worth a trip to a worker. Errors come back as text.
+    results = []
+    for row, path in jobs:
+        try:
+            results.append(evaluate_file(row, path, settings, curves_path) +
+                           (None,))
+        except (OSError, ValueError) as error:
+            results.append((row, None, '{}: {}'.format(path, error)))
+    return(results)
+
+
+def run(paths, settings, summary, curves_path=None, workers=None,
+        dtype=np.float64):
+    # Returns the paths that could not be evaluated
+    failed = []
+    writer = csv.writer(summary)
+    writer.writerow(summary_columns)
+    if curves_path:
+        grid = physics.settings_grid(settings)
+        # Written in place, never all in memory
+        curves = np.lib.format.open_memmap(
+            curves_path, mode='w+', dtype=dtype,
+            shape=(len(paths) + 1, beam.grid_size(grid)))
+        for start, z in beam.grid_blocks(grid):
+            curves[0, start:start + len(z)] = z
+        curves.flush()
+        del curves
+    workers = workers or os.cpu_count() or 1
+    jobs = list(enumerate(paths))
+    # A few chunks per worker, so they all finish at about the same time
+    chunk_size = max(len(jobs) // (4 * workers), 1)
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(evaluate_files, jobs[start:start + chunk_size],
+                               settings, curves_path)
+                   for start in range(0, len(jobs), chunk_size)]
+        for future in as_completed(futures):
+            for row, rows, error in future.result():
+                if error:
+                    failed.append(paths[row])
+                    print(error, file=sys.stderr)
+                    continue
+                writer.writerows(rows)
+            summary.flush()
+    return(failed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Evaluate saved beampage systems.')
+    parser.add_argument('inputs', nargs='+',
+                        help='optics CSV files, globs or directories')
+    parser.add_argument('-s', '--settings',
+                        default='assets/default_settings.json',
+                        help='settings JSON, as saved by the app')
+    parser.add_argument('-o', '--output', default='-',
+                        help='summary CSV (default: standard output)')
+    parser.add_argument('-c', '--curves',
+                        help='also write all w(z) to this .npy file')
+    parser.add_argument('--float32', action='store_true',
+                        help='write the curves in single precision')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='worker processes (default: one per core)')
+    args = parser.parse_args(argv)
+    with open(args.settings) as settings_file:
+        settings = json.load(settings_file)
+    paths = find_files(args.inputs)
+    if not paths:
+        parser.error('no optics files found')
+    dtype = np.float32 if args.float32 else np.float64
+    if args.output == '-':
+        failed = run(paths, settings, sys.stdout, args.curves, args.workers,
+                     dtype)
+    else:
+        with open(args.output, 'w', newline='') as summary:
+            failed = run(paths, settings, summary, args.curves,
+                         args.workers, dtype)
+    return(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""Gaussian beam propagation using complex q-parameters and ABCD matrices.
+
+All lengths are in mm (that includes the wavelength). The beam starts with
+its waist at the first element, which is normally the origin (type 0).
+Every function broadcasts over leading "batch" axes, so the last axis of
+the element arrays always runs over the elements of one system.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+# Beam parameters of each segment, i.e. the stretch of z from an element up
+# to the next one (the last segment goes on forever).
+Segments = namedtuple('Segments', ['start', 'z_origin', 'waist', 'rayleigh'])
+
+
+def element_matrices(types, focal_lengths):
+    # Ray transfer matrices of the elements themselves, shape (..., n, 2, 2).
+    # Type 0 (the origin) does nothing to the beam, type 1 is a thin lens.
+    types = np.asarray(types)
+    focal_lengths = np.asarray(focal_lengths, dtype=float)
+    if not np.isin(types, (0, 1)).all():
+        raise ValueError('Unknown optics type!')
+    types, focal_lengths = np.broadcast_arrays(types, focal_lengths)
+    is_lens = types == 1
+    matrices = np.zeros(types.shape + (2, 2))
+    matrices[..., 0, 0] = 1
+    matrices[..., 1, 1] = 1
+    matrices[..., 1, 0] = np.where(
+        is_lens, -1 / np.where(is_lens, focal_lengths, 1), 0)
+    return(matrices)
+
+
+def compose(left, right):
+    # left @ right for stacks of 2x2 matrices, written out since np.matmul
+    # is slow for lots of tiny matrices
+    out = np.empty(np.broadcast_shapes(left.shape, right.shape))
+    for i in range(2):
+        for j in range(2):
+            out[..., i, j] = (left[..., i, 0] * right[..., 0, j] +
+                              left[..., i, 1] * right[..., 1, j])
+    return(out)
+
+
+def system_matrices(positions, matrices):
+    # Cumulative ABCD matrix from the first element to just after each
+    # element. The products are formed with a log-depth prefix scan, so the
+    # number of NumPy calls grows with log2(n) rather than n.
+    positions = np.asarray(positions, dtype=float)
+    shape = np.broadcast_shapes(positions.shape, matrices.shape[:-2])
+    steps = np.broadcast_to(matrices, shape + (2, 2)).copy()
+    gaps = np.diff(positions, axis=-1)
+    # E_k @ [[1, d], [0, 1]] only changes the right column
+    steps[..., 1:, 0, 1] += steps[..., 1:, 0, 0] * gaps
+    steps[..., 1:, 1, 1] += steps[..., 1:, 1, 0] * gaps
+    n = shape[-1]
+    span = 1
+    while span < n:
+        steps[..., span:, :, :] = compose(steps[..., span:, :, :],
+                                          steps[..., :-span, :, :])
+        span *= 2
+    return(steps)
+
+
+def input_q(waist, wavelength):
+    return(1j * np.pi * np.asarray(waist, dtype=float) ** 2 /
+           np.asarray(wavelength, dtype=float))
+
+
+def transform_q(q, matrices):
+    a = matrices[..., 0, 0]
+    b = matrices[..., 0, 1]
+    c = matrices[..., 1, 0]
+    d = matrices[..., 1, 1]
+    return((a * q + b) / (c * q + d))
+
+
+def propagate(positions, types, focal_lengths, waist, wavelength):
+    # Beam parameters after every element. positions, types and
+    # focal_lengths have shape (..., n) and must be sorted along z;
+    # waist and wavelength broadcast against the batch shape (...).
+    return(propagate_q(positions, types, focal_lengths,
+                       input_q(waist, wavelength), wavelength))
+
+
+def propagate_q(positions, types, focal_lengths, q, wavelength):
+    # Same as propagate, but starting from any beam q at the first element
+    # (just before it acts on the beam)
+    positions = np.asarray(positions, dtype=float)
+    matrices = system_matrices(positions,
+                               element_matrices(types, focal_lengths))
+    q = transform_q(np.asarray(q)[..., np.newaxis], matrices)
+    wavelength = np.asarray(wavelength, dtype=float)[..., np.newaxis]
+    rayleigh = q.imag
+    start = np.broadcast_to(positions, rayleigh.shape)
+    return(Segments(start=start,
+                    z_origin=start - q.real,
+                    waist=np.sqrt(rayleigh * wavelength / np.pi),
+                    rayleigh=rayleigh))
+
+
+def segment_index(z, segments):
+    # Which segment every z belongs to. Points before the first element are
+    # counted to the first segment.
+    index = np.searchsorted(segments.start, z, side='right') - 1
+    return(np.clip(index, 0, None))
+
+
+def beam_width(z, segments):
+    # w(z) over an arbitrary array of z for a single system
+    z = np.asarray(z, dtype=float)
+    index = segment_index(z, segments)
+    return(segments.waist[index] * np.sqrt(
+        1 + ((z - segments.z_origin[index]) / segments.rayleigh[index]) ** 2))
+
+
+def beam_widths(z, segments):
+    # w(z) of a batch of systems that have their elements at the same
+    # positions (one system at many wavelengths, say), shape (..., len(z)).
+    # z has to be sorted; every segment is then a slice of it, worked out
+    # for the whole batch at once and in place.
+    z = np.asarray(z, dtype=float)
+    start = segments.start.reshape(-1, segments.start.shape[-1])[0]
+    bounds = np.concatenate([[0], np.searchsorted(z, start[1:]), [len(z)]])
+    widths = np.empty(segments.waist.shape[:-1] + z.shape)
+    for index in range(len(start)):
+        part = widths[..., bounds[index]:bounds[index + 1]]
+        np.subtract(z[bounds[index]:bounds[index + 1]],
+                    segments.z_origin[..., index, np.newaxis], out=part)
+        part /= segments.rayleigh[..., index, np.newaxis]
+        np.square(part, out=part)
+        part += 1
+        np.sqrt(part, out=part)
+        part *= segments.waist[..., index, np.newaxis]
+    return(widths)
+
+
+# A system together with its widths on a z grid. Kept so that after an edit
+# only the part of the system after the first changed element has to be
+# recomputed, see retrace.
+Trace = namedtuple('Trace', ['grid', 'z_grid', 'waist', 'wavelength',
+                             'positions', 'types', 'focal_lengths',
+                             'segments', 'w_z'])
+
+
+# The z grid of the settings: the points z_min + i z_step below z_max. Kept
+# as a description, so that long grids can be gone through in blocks
+# (see width_blocks) instead of being made all at once.
+Grid = namedtuple('Grid', ['z_min', 'z_max', 'z_step'])
+
+# Points per block of width_blocks
+block_points = 2 ** 16
+
+
+def grid_size(grid):
+    # Same count as np.arange(z_min, z_max, z_step)
+    return(max(int(np.ceil((grid.z_max - grid.z_min) / grid.z_step)), 0))
+
+
+def grid_points(grid, start=0, stop=None):
+    if stop is None:
+        stop = grid_size(grid)
+    return(grid.z_min + np.arange(start, stop) * grid.z_step)
+
+
+def make_grid(z_min, z_max, z_step):
+    return(grid_points(Grid(z_min, z_max, z_step)))
+
+
+def grid_blocks(grid, block_size=None):
+    # Yields (start, z) for block_size points of the grid at a time
+    if block_size is None:
+        block_size = block_points
+    size = grid_size(grid)
+    for start in range(0, size, block_size):
+        yield start, grid_points(grid, start, min(start + block_size, size))
+
+
+def width_blocks(grid, segments, block_size=None, dtype=np.float64):
+    # Yields (start, z, w), w as dtype (np.float32 halves what has to be
+    # kept or sent). Computed in float64 either way, a float32 z loses the
+    # step on long grids.
+    for start, z in grid_blocks(grid, block_size):
+        yield start, z, beam_width(z, segments).astype(dtype, copy=False)
+
+
+# The smallest width on the grid and where it is, and the smallest and
+# largest width of every segment on the grid (inf and -inf for segments
+# without grid points)
+GridExtrema = namedtuple('GridExtrema', ['z', 'width', 'segment_min',
+                                         'segment_max'])
+
+
+def grid_extrema(grid, segments, block_size=None):
+    # Running reductions over the blocks, so memory doesn't grow with the
+    # grid
+    segment_min = np.full(len(segments.start), np.inf)
+    segment_max = np.full(len(segments.start), -np.inf)
+    best = GridExtrema(np.nan, np.inf, segment_min, segment_max)
+    for start, z, w in width_blocks(grid, segments, block_size):
+        index = segment_index(z, segments)
+        # z is sorted, so every segment is one run of the block
+        runs = np.concatenate([[0], np.flatnonzero(np.diff(index)) + 1])
+        present = index[runs]
+        segment_min[present] = np.minimum(segment_min[present],
+                                          np.minimum.reduceat(w, runs))
+        segment_max[present] = np.maximum(segment_max[present],
+                                          np.maximum.reduceat(w, runs))
+        smallest = np.argmin(w)
+        if w[smallest] < best.width:
+            best = best._replace(z=z[smallest], width=w[smallest])
+    return(best)
+
+
+def make_trace(grid, positions, types, focal_lengths, waist, wavelength,
+               z_grid=None):
+    # grid is (z_min, z_max, z_step)
+    if z_grid is None:
+        z_grid = make_grid(*grid)
+    positions = np.array(positions, dtype=float)
+    types = np.array(types)
+    focal_lengths = np.array(focal_lengths, dtype=float)
+    segments = propagate(positions, types, focal_lengths, waist, wavelength)
+    return(Trace(grid=grid, z_grid=z_grid, waist=waist,
+                 wavelength=wavelength, positions=positions, types=types,
+                 focal_lengths=focal_lengths, segments=segments,
+                 w_z=beam_width(z_grid, segments)))
+
+
+def first_change(trace, positions, types, focal_lengths):
+    # Index of the first element that differs from the trace. Equal to the
+    # number of elements if all of them are the same (which still means a
+    # change if the trace had more elements).
+    common = min(len(positions), len(trace.positions))
+    changed = np.flatnonzero(
+        (positions[:common] != trace.positions[:common]) |
+        (types[:common] != trace.types[:common]) |
+        (focal_lengths[:common] != trace.focal_lengths[:common]))
+    if len(changed):
+        return(int(changed[0]))
+    return(common)
+
+
+def retrace(trace, grid, positions, types, focal_lengths, waist, wavelength):
+    # Like make_trace, but everything before the first changed element is
+    # reused from an earlier trace: the beam parameters up to there and w(z)
+    # up to where that element is (or was). The old trace is left as it is.
+    positions = np.array(positions, dtype=float)
+    types = np.array(types)
+    focal_lengths = np.array(focal_lengths, dtype=float)
+    if (trace is None or trace.grid != grid or trace.waist != waist or
+            trace.wavelength != wavelength):
+        return(make_trace(grid, positions, types, focal_lengths, waist,
+                          wavelength))
+    first = first_change(trace, positions, types, focal_lengths)
+    num_elements = len(positions)
+    if first == num_elements == len(trace.positions):
+        return(trace)
+    if first == 0:
+        return(make_trace(grid, positions, types, focal_lengths, waist,
+                          wavelength, trace.z_grid))
+    segments = Segments(*(values[:first] for values in trace.segments))
+    if first < num_elements:
+        # The beam just before the first changed element
+        q = (positions[first] - segments.z_origin[-1] +
+             1j * segments.rayleigh[-1])
+        tail = propagate_q(positions[first:], types[first:],
+                           focal_lengths[first:], q, wavelength)
+        segments = Segments(*(np.concatenate([head, rest]) for head, rest
+                              in zip(segments, tail)))
+    changed_from = min(positions[first] if first < num_elements else np.inf,
+                       trace.positions[first] if first < len(trace.positions)
+                       else np.inf)
+    start = np.searchsorted(trace.z_grid, changed_from, side='left')
+    # A copy costs far less than evaluating the widths again, and keeps
+    # arrays handed out from earlier traces intact
+    w_z = trace.w_z.copy()
+    w_z[start:] = beam_width(trace.z_grid[start:], segments)
+    return(Trace(grid=grid, z_grid=trace.z_grid, waist=waist,
+                 wavelength=wavelength, positions=positions, types=types,
+                 focal_lengths=focal_lengths, segments=segments, w_z=w_z))
+
+
+# Where and how small the beam is at its narrowest point within some range
+Focus = namedtuple('Focus', ['z', 'width', 'segment'])
+
+
+def segment_ends(segments, z_max=np.inf):
+    ends = np.empty_like(segments.start)
+    ends[..., :-1] = segments.start[..., 1:]
+    ends[..., -1] = np.inf
+    return(np.minimum(ends, z_max))
+
+
+def min_spot(segments, z_min=-np.inf, z_max=np.inf):
+    # Smallest width within [z_min, z_max], found without any grid. Inside a
+    # segment w(z) only grows away from the waist, so the minimum is either
+    # the waist itself or the end of the segment closest to it.
+    lower = np.maximum(segments.start, z_min)
+    lower[..., 0] = z_min
+    upper = segment_ends(segments, z_max)
+    z = np.clip(segments.z_origin, lower, upper)
+    width = segments.waist * np.sqrt(
+        1 + ((z - segments.z_origin) / segments.rayleigh) ** 2)
+    width = np.where(lower <= upper, width, np.inf)
+    index = np.argmin(width, axis=-1)[..., np.newaxis]
+    return(Focus(z=np.take_along_axis(z, index, -1)[..., 0],
+                 width=np.take_along_axis(width, index, -1)[..., 0],
+                 segment=index[..., 0]))
+
+
+# Output beam (after the last lens) of every configuration in a sweep
+SweepResult = namedtuple('SweepResult', ['waist', 'z_origin', 'rayleigh'])
+
+# Number of elements (configurations times lenses) propagated per chunk
+sweep_chunk_elements = 2 ** 18
+
+
+def sweep(positions, focal_lengths, waist, wavelength, z_waist=0.,
+          chunk_size=None):
+    # Propagate a whole batch of lens systems in one go. positions and
+    # focal_lengths have shape (..., n) for n lenses, while waist,
+    # wavelength and z_waist (where the input waist is) broadcast against
+    # the batch shape (...). The lenses don't have to be sorted along z.
+    # Configurations are handled chunk_size at a time to bound memory.
+    positions = np.asarray(positions, dtype=float)
+    focal_lengths = np.asarray(focal_lengths, dtype=float)
+    num_lenses = max(positions.shape[-1], focal_lengths.shape[-1])
+    batch = np.broadcast_shapes(positions.shape[:-1],
+                                focal_lengths.shape[:-1], np.shape(waist),
+                                np.shape(wavelength), np.shape(z_waist))
+    size = int(np.prod(batch))
+
+    def flat(values, per_config=()):
+        return(np.broadcast_to(values, batch + per_config).reshape(
+            (size,) + per_config))
+
+    positions = flat(positions, (num_lenses,))
+    focal_lengths = flat(focal_lengths, (num_lenses,))
+    waist = flat(waist)
+    wavelength = flat(wavelength)
+    z_waist = flat(z_waist)
+    if chunk_size is None:
+        chunk_size = max(sweep_chunk_elements // (num_lenses + 1), 1)
+    types = np.ones(num_lenses + 1, dtype=int)
+    types[0] = 0
+    result = SweepResult(np.empty(size), np.empty(size), np.empty(size))
+    for start in range(0, size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        order = np.argsort(positions[chunk], axis=-1)
+        lens_positions = np.take_along_axis(positions[chunk], order, -1)
+        lens_focals = np.take_along_axis(focal_lengths[chunk], order, -1)
+        segments = propagate(
+            np.concatenate([z_waist[chunk, np.newaxis], lens_positions], -1),
+            types,
+            np.concatenate([np.zeros((len(order), 1)), lens_focals], -1),
+            waist[chunk], wavelength[chunk])
+        result.waist[chunk] = segments.waist[:, -1]
+        result.z_origin[chunk] = segments.z_origin[:, -1]
+        result.rayleigh[chunk] = segments.rayleigh[:, -1]
+    return(SweepResult(*(values.reshape(batch) for values in result)))
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""Timing the physics, the encodings and the callbacks.
+
+    python bench.py [--quick] [--filter calc_gaussian] [--threshold 0.2]
+
+runs every benchmark, appends the results to a history file (JSON lines,
+one run per line) and compares them with the median of the last few runs
+in it. Benchmarks that got slower by more than the threshold are flagged,
+and the exit status is 1 if there were any, so it can gate a deployment.
+Timings are the median (and min) over a number of repeats, in seconds per
+call.
+"""
+
+import argparse
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# number is how many calls are timed together (None: enough for about
+# min_sample seconds). setup runs before every sample, untimed.
+Benchmark = namedtuple('Benchmark', ['name', 'run', 'setup', 'number'])
+
+min_sample = 0.005
+
+history_file = 'aux/bench_history.jsonl'
+
+
+def random_system(num_elements, seed=0):
+    # The origin and num_elements - 1 lenses spread over the z range
+    from optical_system import OpticalSystem, record_dtype
+    rng = np.random.default_rng(seed)
+    num_lenses = num_elements - 1
+    rows = [(0, -1000., 0, 0.)]
+    rows += [(index + 1, position, 1, focal) for index, (position, focal)
+             in enumerate(zip(np.sort(rng.uniform(-900, 1900, num_lenses)),
+                              rng.choice([-100., -50., 50., 100., 200.],
+                                         num_lenses)))]
+    return(OpticalSystem(np.array(rows, dtype=record_dtype)))
+
+
+@contextmanager
+def scratch_cache():
+    # The benchmarks turn the app's cache off and on, and whatever they put
+    # in it goes to a file of their own, not the one the app serves from
+    import app
+    import cache
+    import extra_vars as exva
+    saved = app.use_cache, getattr(app, 'result_cache', None)
+    with tempfile.TemporaryDirectory() as directory:
+        app.result_cache = cache.SharedCache(
+            os.path.join(directory, 'cache.sqlite'), exva.cache_max_bytes)
+        try:
+            yield
+        finally:
+            app.use_cache, app.result_cache = saved
+
+
+def make_benchmarks(quick=False):
+    # The app is only imported here, it's slow to import
+    import app
+    import codec
+
+    settings = {'x_scale': '1', 'y_scale': '1', 'wavelength': 800,
+                'waist': 5, 'z_min': -1000, 'z_max': 2000, 'z_step': 0.05,
+                'double_sided': 1, 'adaptive': 1, 'plot_points': 2000,
+                'reset_index': 0, 'drag': 1}
+    element_counts = (2, 50) if quick else (2, 10, 50, 100, 500)
+    z_steps = (1, 0.01) if quick else (1, 0.1, 0.01, 0.001)
+    benchmarks = []
+
+    def forget():
+        # Nothing from earlier runs may be reused
+        app.recent_traces.clear()
+        app.element_report.cache_clear()
+        app.table_row.cache_clear()
+        app.use_cache = False
+
+    for count in element_counts:
+        system = random_system(count)
+        for z_step in z_steps:
+            step_settings = dict(settings, z_step=z_step)
+            benchmarks.append(Benchmark(
+                'calc_gaussian[n={},z_step={:g}]'.format(count, z_step),
+                lambda s=step_settings, o=system: app.calc_gaussian(s, o),
+                forget, 1))
+
+    system = random_system(50)
+    frame = system.to_frame().sample(frac=1, random_state=0)
+    benchmarks.append(Benchmark(
+        'update_optics[n=50]',
+        lambda: app.update_optics(frame.copy()), None, None))
+    benchmarks.append(Benchmark(
+        'OpticalSystem.move[n=50]',
+        lambda: system.copy().move(10, 1500.), None, None))
+    store = system.encode()
+    benchmarks.append(Benchmark(
+        'codec round trip[n=50]',
+        lambda: codec.encode_optics(codec.decode_optics(store)), None, None))
+    benchmarks.append(Benchmark(
+        'move_lenses[n=50]',
+        lambda: app.move_lenses(1, None, None, None, 0, 0, 0, '', 123., 75.,
+                                store, '0', '0', '0', '0', '', '10',
+                                json.dumps(settings), ''),
+        None, None))
+
+    small = random_system(10).encode()
+    for cached in (False, True):
+        def setup(cached=cached):
+            forget()
+            app.use_cache = cached
+        benchmarks.append(Benchmark(
+            'update_figure[n=10,{}]'.format('cached' if cached else 'cold'),
+            lambda: app.update_figure(small, json.dumps(settings)), setup,
+            1))
+
+    client = app.create_app().server.test_client()
+    figure_request = {
+        'output': '..figure-store.children...output_text.value...'
+                  'element_select.options...sweep-element.options...'
+                  'fixed-elements.options...figure-status.children...'
+                  'figure-key.children..',
+        'outputs': [{'id': 'figure-store', 'property': 'children'},
+                    {'id': 'output_text', 'property': 'value'},
+                    {'id': 'element_select', 'property': 'options'},
+                    {'id': 'sweep-element', 'property': 'options'},
+                    {'id': 'fixed-elements', 'property': 'options'},
+                    {'id': 'figure-status', 'property': 'children'},
+                    {'id': 'figure-key', 'property': 'children'}],
+        'inputs': [{'id': 'optics-store', 'property': 'children',
+                    'value': small},
+                   {'id': 'persistent-settings', 'property': 'children',
+                    'value': json.dumps(settings)}],
+        'state': [{'id': 'session-id', 'property': 'children',
+                   'value': None},
+                  {'id': 'figure-key', 'property': 'children',
+                   'value': ''}],
+        'changedPropIds': ['optics-store.children']}
+
+    def post_figure():
+        answer = client.post('/_dash-update-component', json=figure_request)
+        if answer.status_code != 200:
+            raise RuntimeError('update_figure request failed')
+    benchmarks.append(Benchmark('dash update_figure[n=10]', post_figure,
+                                forget, 1))
+
+    api_request = {'settings': settings,
+                   'systems': [random_system(10, seed).to_csv()
+                               for seed in range(20)]}
+
+    def post_api():
+        answer = client.post('/api/beam?format=npy&report=0',
+                             json=api_request)
+        if answer.status_code != 200:
+            raise RuntimeError('API request failed')
+    benchmarks.append(Benchmark('api batch[20 systems,n=10]', post_api,
+                                forget, 1))
+    return(benchmarks)
+
+
+def measure(benchmark, repeat):
+    # Seconds per call of every sample
+    number = benchmark.number
+    if number is None:
+        started = time.perf_counter()
+        benchmark.run()
+        once = time.perf_counter() - started
+        number = max(int(min_sample / max(once, 1e-9)), 1)
+    samples = []
+    for index in range(repeat):
+        if benchmark.setup is not None:
+            benchmark.setup()
+        started = time.perf_counter()
+        for call in range(number):
+            benchmark.run()
+        samples.append((time.perf_counter() - started) / number)
+    return(samples)
+
+
+def read_history(path):
+    runs = []
+    if os.path.exists(path):
+        with open(path) as history:
+            for line in history:
+                if line.strip():
+                    runs.append(json.loads(line))
+    return(runs)
+
+
+def baseline(runs, name, depth=5):
+    # Median of the last depth runs that have this benchmark
+    medians = [run['results'][name]['median'] for run in runs
+               if name in run['results']][-depth:]
+    return(statistics.median(medians) if medians else None)
+
+
+def regressions(results, runs, threshold):
+    # name: (median now, baseline) of everything slower than threshold
+    slower = {}
+    for name, result in results.items():
+        base = baseline(runs, name)
+        if base is not None and result['median'] > base * (1 + threshold):
+            slower[name] = (result['median'], base)
+    return(slower)
+
+
+def git_commit():
+    try:
+        return(subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time beampage.')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer element counts and z steps')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only benchmarks whose name contains this')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown that counts as a regression')
+    parser.add_argument('--history', default=history_file)
+    parser.add_argument('--no-save', action='store_true',
+                        help="don't add this run to the history")
+    args = parser.parse_args(argv)
+    runs = read_history(args.history)
+    results = {}
+    with scratch_cache():
+        for benchmark in make_benchmarks(args.quick):
+            if args.filter not in benchmark.name:
+                continue
+            samples = measure(benchmark, args.repeat)
+            results[benchmark.name] = {'median': statistics.median(samples),
+                                       'min': min(samples),
+                                       'repeat': len(samples)}
+            base = baseline(runs, benchmark.name)
+            print('{:<40} {:12.6f} s{}'.format(
+                benchmark.name, results[benchmark.name]['median'],
+                '' if base is None else ' ({:+.0%})'.format(
+                    results[benchmark.name]['median'] / base - 1)))
+    slower = regressions(results, runs, args.threshold)
+    for name, (now, base) in slower.items():
+        print('REGRESSION {}: {:.6f} s, was {:.6f} s'.format(name, now, base))
+    if not args.no_save:
+        directory = os.path.dirname(args.history)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(args.history, 'a') as history:
+            history.write(json.dumps({
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'results': results}) + '\n')
+    return(1 if slower else 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed result cache shared by all worker processes.
+
+Entries live in one SQLite file (in WAL mode, so readers and a writer don't
+block each other) and are evicted least recently used first once the total
+size goes over a limit. Hits and misses are counted in the same file, so
+the numbers cover every worker.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+import numpy as np
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL);
+CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, count INTEGER);
+'''
+
+# The settings that change the physics; the rest (scales, plotting) doesn't
+physics_settings = ('z_min', 'z_max', 'z_step', 'waist', 'wavelength')
+
+
+# Part of every key. The file outlives restarts and deploys, so bump this
+# whenever pack() or anything cached under a key changes format.
+key_version = 1
+
+
+def make_key(*parts):
+    # Hash of anything JSON can represent, with dict order not mattering
+    text = json.dumps((key_version,) + parts, sort_keys=True,
+                      separators=(',', ':'), default=float)
+    return(hashlib.sha256(text.encode()).hexdigest())
+
+
+def physics_key(settings, positions, types, focal_lengths, elements=()):
+    return(make_key('physics',
+                    {name: float(settings[name])
+                     for name in physics_settings},
+                    [float(p) for p in positions], [int(t) for t in types],
+                    [float(f) for f in focal_lengths],
+                    [int(e) for e in elements]))
+
+
+def pack(arrays, meta=None):
+    # arrays (a dict of NumPy arrays) and meta (anything JSON) as bytes: a
+    # length-prefixed JSON header followed by the raw array data
+    header = {'meta': meta, 'arrays': []}
+    chunks = []
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        header['arrays'].append([name, values.dtype.str, values.shape])
+        chunks.append(values.tobytes())
+    text = json.dumps(header).encode()
+    return(b''.join([struct.pack('<I', len(text)), text] + chunks))
+
+
+def unpack(blob):
+    # The arrays come back read-only, as views of blob
+    length = struct.unpack_from('<I', blob)[0]
+    header = json.loads(bytes(blob[4:4 + length]))
+    offset = 4 + length
+    arrays = {}
+    for name, dtype, shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(blob, dtype, count, offset).reshape(
+            shape)
+        offset += count * dtype.itemsize
+    return(arrays, header['meta'])
+
+
+class SharedCache:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    def connection(self):
+        # One connection per process and thread; a connection must not
+        # cross a fork, and sqlite3 won't share one between threads
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            local.connection = sqlite3.connect(self.path, timeout=10,
+                                               isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection.executescript(_schema)
+            local.pid = os.getpid()
+        return(local.connection)
+
+    def count(self, name):
+        # Not an upsert, ON CONFLICT needs SQLite 3.24
+        db = self.connection()
+        db.execute('INSERT OR IGNORE INTO counters VALUES (?, 0)', (name,))
+        db.execute('UPDATE counters SET count = count + 1 WHERE name = ?',
+                   (name,))
+
+    def get(self, key):
+        db = self.connection()
+        row = db.execute('SELECT value FROM entries WHERE key = ?',
+                         (key,)).fetchone()
+        if row is None:
+            self.count('misses')
+            return(None)
+        db.execute('UPDATE entries SET used = ? WHERE key = ?',
+                   (time.time(), key))
+        self.count('hits')
+        return(row[0])
+
+    def put(self, key, value):
+        # A value over the limit would only evict everything else
+        if len(value) > self.max_bytes:
+            return
+        db = self.connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                       (key, value, len(value), time.time()))
+            total = db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            while total > self.max_bytes:
+                row = db.execute(
+                    'SELECT key, size FROM entries ORDER BY used '
+                    'LIMIT 1').fetchone()
+                if row is None:
+                    break
+                key, size = row
+                db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                total -= size
+                self.count('evictions')
+
+    def stats(self):
+        db = self.connection()
+        stats = dict(db.execute('SELECT name, count FROM counters'))
+        entries, size = db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        stats.update(entries=entries, bytes=size)
+        return(stats)
+
+    def clear(self):
+        db = self.connection()
+        db.execute('DELETE FROM entries')
+        db.execute('DELETE FROM counters')
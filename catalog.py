@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Stock lens catalogs.
+
+Catalogs are CSV files with the columns Vendor, Part, FocalLength and
+Diameter (mm) plus CoatingMin and CoatingMax (the AR coating range in nm).
+They are kept as one NumPy structured array sorted by focal length, so
+lookups are binary searches on focal length. Diameter and coating are only
+checked within the window around the wanted focal length, which widens
+until it holds enough parts.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+import beam
+
+part_dtype = np.dtype([('Vendor', 'U32'), ('Part', 'U48'),
+                       ('FocalLength', np.float64), ('Diameter', np.float64),
+                       ('CoatingMin', np.float64),
+                       ('CoatingMax', np.float64)])
+
+# parts is sorted by focal length
+Catalog = namedtuple('Catalog', ['parts'])
+
+# A stock design: one part per lens position, ranked by error
+Design = namedtuple('Design', ['parts', 'focal_lengths', 'waist', 'z_origin',
+                               'error'])
+
+
+def make_catalog(parts):
+    parts = np.sort(np.asarray(parts, dtype=part_dtype),
+                    order=['FocalLength', 'Diameter', 'Part'])
+    return(Catalog(parts=parts))
+
+
+def load_catalogs(paths):
+    # pandas is only needed to read the files
+    import pandas as pd
+    frames = [pd.read_csv(path) for path in paths]
+    frame = pd.concat(frames, ignore_index=True)
+    parts = np.empty(len(frame), dtype=part_dtype)
+    for name in part_dtype.names:
+        parts[name] = frame[name].to_numpy()
+    return(make_catalog(parts))
+
+
+def focal_range(catalog, lower, upper):
+    # Indices of all parts with lower <= f <= upper
+    focal = catalog.parts['FocalLength']
+    return(np.arange(np.searchsorted(focal, lower, side='left'),
+                     np.searchsorted(focal, upper, side='right')))
+
+
+def fits(parts, diameter=None, wavelength=None):
+    ok = np.ones(len(parts), dtype=bool)
+    if diameter is not None:
+        ok &= parts['Diameter'] >= diameter
+    if wavelength is not None:
+        ok &= ((parts['CoatingMin'] <= wavelength) &
+               (parts['CoatingMax'] >= wavelength))
+    return(ok)
+
+
+def closest(catalog, focal_length, count, diameter=None, wavelength=None,
+            distinct=False):
+    # Binary search for focal_length, then widen the window around it until
+    # it holds count fitting parts (or distinct focal lengths) and nothing
+    # outside can be closer. Only the window is checked for diameter and
+    # coating.
+    focal = catalog.parts['FocalLength']
+    center = np.searchsorted(focal, focal_length)
+    width = max(count, 1)
+    while True:
+        lower = max(center - width, 0)
+        upper = min(center + width, len(focal))
+        found = np.arange(lower, upper)
+        found = found[fits(catalog.parts[lower:upper], diameter, wavelength)]
+        if distinct:
+            found = np.unique(focal[found])
+            distance = np.abs(found - focal_length)
+        else:
+            distance = np.abs(focal[found] - focal_length)
+        order = np.argsort(distance, kind='stable')[:count]
+        reach = min(focal_length - focal[lower - 1] if lower > 0 else np.inf,
+                    focal[upper] - focal_length if upper < len(focal)
+                    else np.inf)
+        if len(order) == count and distance[order[-1]] <= reach or (
+                lower == 0 and upper == len(focal)):
+            return(found[order])
+        width *= 2
+
+
+def nearest(catalog, focal_length, count=3, diameter=None, wavelength=None):
+    # Indices of the count parts closest in focal length that are at least
+    # diameter wide and coated for wavelength
+    return(closest(catalog, focal_length, count, diameter, wavelength))
+
+
+def candidate_focals(catalog, focal_length=None, count=None, diameter=None,
+                     wavelength=None):
+    # Distinct focal lengths available, at most count of them: the closest
+    # to focal_length or, without one, the closest to count values spread
+    # over the whole range. Many parts share focal lengths, so this keeps
+    # the number of combinations down.
+    focal = catalog.parts['FocalLength']
+    if count is None:
+        return(np.unique(focal[fits(catalog.parts, diameter, wavelength)]))
+    if focal_length is not None:
+        return(np.sort(closest(catalog, focal_length, count, diameter,
+                               wavelength, distinct=True)))
+    if len(focal) == 0:
+        return(np.empty(0))
+    wanted = np.linspace(focal[0], focal[-1], count)
+    return(np.unique(np.concatenate(
+        [closest(catalog, value, 1, diameter, wavelength, distinct=True)
+         for value in wanted])))
+
+
+def search_designs(catalog, positions, waist, wavelength, target_waist,
+                   z_waist=0., target_z=None, z_tolerance=1.,
+                   focal_lengths=None, candidates=40, top=10, diameter=None,
+                   coating_wavelength=None):
+    # Try every combination of stock focal lengths for lenses at the given
+    # positions and rank them by the error in output waist (and in focus
+    # position, when target_z is given). focal_lengths are the wanted
+    # values, around which candidates stock values per lens are picked.
+    positions = np.asarray(positions, dtype=float)
+    if focal_lengths is None:
+        focal_lengths = [None] * len(positions)
+    choices = [candidate_focals(catalog, focal, candidates, diameter,
+                                coating_wavelength)
+               for focal in focal_lengths]
+    grid = np.stack(np.meshgrid(*choices, indexing='ij'), -1).reshape(
+        -1, len(positions))
+    result = beam.sweep(positions, grid, waist, wavelength, z_waist)
+    error = ((result.waist - target_waist) / target_waist) ** 2
+    if target_z is not None:
+        error = error + ((result.z_origin - target_z) / z_tolerance) ** 2
+    error = np.sqrt(error)
+    best = np.argsort(error, kind='stable')[:top]
+    designs = []
+    for index in best:
+        parts = [catalog.parts[nearest(catalog, focal, 1, diameter,
+                                       coating_wavelength)[0]]
+                 for focal in grid[index]]
+        designs.append(Design(parts=parts, focal_lengths=grid[index],
+                              waist=result.waist[index],
+                              z_origin=result.z_origin[index],
+                              error=error[index]))
+    return(designs)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""Keeping only the latest update of every browser session.
+
+Each request of some kind (say 'figure') from a session takes a ticket,
+a number that goes up with every request. A request whose ticket isn't the
+newest any more is stale: the browser is already waiting for a newer one,
+so it should stop working and not send anything back. The tickets are kept
+in a SQLite file so that this works across worker processes.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS tickets (
+    session TEXT, kind TEXT, ticket INTEGER, used REAL,
+    PRIMARY KEY (session, kind));
+CREATE INDEX IF NOT EXISTS tickets_used ON tickets (used);
+'''
+
+
+class Tickets:
+    def __init__(self, path, max_age=24 * 3600):
+        # Sessions not heard from in max_age seconds are forgotten
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def connection(self):
+        # One connection per process and thread, as in cache.SharedCache
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            local.connection = sqlite3.connect(self.path, timeout=10,
+                                               isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection.executescript(_schema)
+            local.pid = os.getpid()
+        return(local.connection)
+
+    def take(self, session, kind):
+        now = time.time()
+        db = self.connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM tickets WHERE used < ?',
+                       (now - self.max_age,))
+            # Plain statements in the transaction, upserts and RETURNING
+            # need a newer SQLite (3.24, 3.35) than some Pythons come with
+            db.execute('INSERT OR IGNORE INTO tickets VALUES (?, ?, 0, ?)',
+                       (session, kind, now))
+            db.execute('UPDATE tickets SET ticket = ticket + 1, used = ? '
+                       'WHERE session = ? AND kind = ?',
+                       (now, session, kind))
+            return(db.execute(
+                'SELECT ticket FROM tickets WHERE session = ? AND kind = ?',
+                (session, kind)).fetchone()[0])
+
+    def latest(self, session, kind):
+        row = self.connection().execute(
+            'SELECT ticket FROM tickets WHERE session = ? AND kind = ?',
+            (session, kind)).fetchone()
+        return(0 if row is None else row[0])
+
+    def is_stale(self, session, kind, ticket):
+        return(self.latest(session, kind) > ticket)
+
+    def settle(self, session, kind, ticket, delay):
+        # Debounce: wait a little for newer requests, True if there were
+        # none and this one should go ahead
+        time.sleep(delay)
+        return(not self.is_stale(session, kind, ticket))
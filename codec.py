@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Compact text encodings for the hidden store Divs.
+
+An encoded table looks like 'bpo2:<base64>', where the number is the
+format version. The base64 part is a small header (flags and number of
+rows) followed by the rows as a packed little-endian struct array,
+zlib-compressed when that makes it smaller. Decoding is a base64 decode
+and np.frombuffer, no pandas or JSON involved.
+
+The plotted traces in the figure store are encoded with encode_trace:
+'json' is a list of numbers rounded to a number of significant digits,
+'f4' and 'f8' are {"dtype": "f4", "bdata": <base64>} of little-endian
+floats (the typed array format of plotly.js, assets/beam_preview.js
+decodes them too, for older plotly.js versions).
+"""
+
+import base64
+import struct
+import zlib
+
+import numpy as np
+
+# Row layout of every format version. Never change an existing version,
+# add a new one instead (decode_optics converts old ones to the current).
+optics_versions = {
+    1: np.dtype([('Element', '<i2'), ('Position', '<f8'), ('Type', '<i2'),
+                 ('FocalLength', '<f8')]),
+    # Element numbers above 32767 wrapped around in version 1
+    2: np.dtype([('Element', '<i4'), ('Position', '<f8'), ('Type', '<i2'),
+                 ('FocalLength', '<f8')]),
+}
+
+current_version = 2
+
+optics_dtype = optics_versions[current_version]
+
+_prefix = 'bpo'
+_header = struct.Struct('<BI')
+_compressed = 1
+
+
+def encode_optics(optics, version=current_version):
+    # optics is anything indexable by column name: a structured array, a
+    # DataFrame or a dict of columns
+    dtype = optics_versions[version]
+    records = np.empty(len(optics['Element']), dtype)
+    for name in dtype.names:
+        values = np.asarray(optics[name])
+        records[name] = values.astype(dtype[name])
+        if dtype[name].kind == 'i' and np.any(records[name] != values):
+            raise ValueError('{} out of range for version {}'.format(
+                name, version))
+    raw = records.tobytes()
+    flags = 0
+    packed = zlib.compress(raw)
+    if len(packed) < len(raw):
+        raw = packed
+        flags |= _compressed
+    body = base64.b64encode(_header.pack(flags, len(records)) + raw)
+    return('{}{}:{}'.format(_prefix, version, body.decode('ascii')))
+
+
+def decode_optics(text):
+    # Returns a (writable) structured array of optics_dtype
+    prefix, _, body = text.partition(':')
+    try:
+        version = int(prefix[len(_prefix):])
+        dtype = optics_versions[version]
+    except (ValueError, KeyError):
+        raise ValueError('Not an encoded optics table!')
+    if not prefix.startswith(_prefix):
+        raise ValueError('Not an encoded optics table!')
+    blob = base64.b64decode(body)
+    flags, count = _header.unpack_from(blob)
+    raw = blob[_header.size:]
+    if flags & _compressed:
+        raw = zlib.decompress(raw)
+    records = np.frombuffer(raw, dtype, count)
+    return(records.astype(optics_dtype))
+
+
+trace_encodings = ('json', 'f4', 'f8')
+
+
+def encode_trace(values, encoding='f4', digits=6):
+    values = np.asarray(values, dtype=np.float64)
+    if encoding == 'json':
+        round_text = '{{:.{}g}}'.format(digits).format
+        return([float(round_text(value)) for value in values.tolist()])
+    if encoding not in trace_encodings:
+        raise ValueError('Unknown trace encoding ' + str(encoding))
+    raw = values.astype('<' + encoding).tobytes()
+    return({'dtype': encoding,
+            'bdata': base64.b64encode(raw).decode('ascii')})
+
+
+def decode_trace(data):
+    if isinstance(data, dict):
+        return(np.frombuffer(base64.b64decode(data['bdata']),
+                             '<' + data['dtype']).astype(np.float64))
+    return(np.array(data, dtype=np.float64))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""How the focal lengths of the lenses change with the wavelength.
+
+A thin lens' power goes as n(λ) - 1, so a lens with focal length f at
+the design wavelength λ0 has f(λ) = f (n(λ0) - 1) / (n(λ) - 1), with n(λ)
+from the Sellmeier coefficients of its glass (extra_vars.glasses). A lens
+can instead come with a table of (wavelength in nm, focal length in mm) pairs,
+e.g. from a datasheet; it's interpolated and scaled so that it gives f at
+λ0. Lenses without either keep the same focal length at every wavelength.
+
+Wavelengths are in nm here, like in the settings.
+"""
+
+import numpy as np
+
+import extra_vars as exva
+
+
+def glass_coefficients(glass):
+    try:
+        return(exva.glasses[glass.strip().upper()])
+    except KeyError:
+        raise ValueError('Unknown glass ' + glass) from None
+
+
+def refractive_index(glass, wavelengths):
+    # Sellmeier equation, with λ in µm
+    b, c = (np.asarray(values) for values in glass_coefficients(glass))
+    squared = (np.asarray(wavelengths, dtype=float)[..., np.newaxis] *
+               1e-3) ** 2
+    return(np.sqrt(1 + np.sum(b * squared / (squared - c), axis=-1)))
+
+
+def focal_scale(data, wavelengths, design_wavelength):
+    # f(λ) / f(λ0) for one lens, data is a glass name or a table
+    if isinstance(data, str):
+        return((refractive_index(data, design_wavelength) - 1) /
+               (refractive_index(data, wavelengths) - 1))
+    table = np.asarray(data, dtype=float)
+    order = np.argsort(table[:, 0])
+    table_wavelengths, table_focals = table[order, 0], table[order, 1]
+    return(np.interp(wavelengths, table_wavelengths, table_focals) /
+           np.interp(design_wavelength, table_wavelengths, table_focals))
+
+
+def focal_lengths(elements, types, focal_lengths, wavelengths,
+                  design_wavelength, dispersion):
+    # Focal lengths of all elements at all wavelengths, shape (λ, element).
+    # dispersion maps element numbers to a glass name or a table; the
+    # entry under None is for all lenses without their own.
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    scale = np.ones((len(wavelengths), len(elements)))
+    for column, (element, o_type) in enumerate(zip(elements, types)):
+        data = dispersion.get(int(element), dispersion.get(None))
+        if o_type == 1 and data is not None:
+            scale[:, column] = focal_scale(data, wavelengths,
+                                           design_wavelength)
+    return(np.asarray(focal_lengths, dtype=float) * scale)
+
+
+def parse_glasses(text):
+    # "N-BK7" for every lens, "N-BK7, 3: CaF2" with element 3 in CaF2
+    dispersion = {}
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        element, _, glass = entry.rpartition(':')
+        glass_coefficients(glass)
+        if element.strip():
+            try:
+                dispersion[int(element)] = glass.strip()
+            except ValueError:
+                raise ValueError('Not an element number: ' +
+                                 element) from None
+        else:
+            dispersion[None] = glass.strip()
+    return(dispersion)
+
+
+def parse_wavelengths(text, max_count=None):
+    # "780, 800, 820" or "750:850:101" (from:to:count), in nm
+    text = text.strip()
+    try:
+        if ':' in text:
+            start, stop, count = text.split(':')
+            wavelengths = np.linspace(float(start), float(stop), int(count))
+        else:
+            wavelengths = np.array([float(value) for value in text.split(',')
+                                    if value.strip()])
+    except ValueError:
+        raise ValueError('Could not read the wavelengths ' + text) from None
+    if (wavelengths <= 0).any():
+        raise ValueError('Wavelengths have to be positive')
+    if max_count is not None and len(wavelengths) > max_count:
+        raise ValueError('At most {} wavelengths'.format(max_count))
+    return(np.unique(wavelengths))
@@ -1,12 +1,106 @@
 import numpy as np
 
 optics_dtypes = {
-    'Element': np.int16,
+    'Element': np.int32,
     'Position': np.float64,
     'Type': np.int16,
     'FocalLength': np.float64
 }
 
+default_plot_points = 2000
+
+sweep_points = 1000
+
+cache_file = 'aux/cache.sqlite'
+
+cache_max_bytes = 256 * 2 ** 20
+
+# How many recent beam traces calc_trace keeps per process
+trace_cache_size = 8
+
+# Grids with more points than this are never made whole in the app: the
+# plot and the API go through them in blocks (see beam.width_blocks)
+max_grid_points = 2 ** 20
+
+tickets_file = 'aux/tickets.sqlite'
+
+metrics_file = 'aux/metrics.sqlite'
+
+# Where the sessions' state is kept, see sessions.open_store. memory:// only
+# works with a single worker process.
+session_store = 'sqlite:///aux/sessions.sqlite'
+
+# Seconds after its last change that a session is forgotten
+session_max_age = 24 * 3600
+
+# Access log (JSON lines), rotated at log_max_bytes with log_backups old
+# files kept. Records wait at most log_flush_interval s to be written, and
+# are dropped if more than log_queue_size are waiting.
+logfile = 'aux/logfile.txt'
+
+log_max_bytes = 10 * 2 ** 20
+
+log_backups = 5
+
+log_flush_interval = 1.
+
+log_batch_size = 500
+
+log_queue_size = 10000
+
+# Seconds between stack samples of the profiler
+profile_interval = 0.005
+
+# Sellmeier coefficients (B1, B2, B3), (C1, C2, C3) of lens glasses, for λ
+# in µm, see dispersion.py
+glasses = {
+    'N-BK7': ((1.03961212, 0.231792344, 1.01046945),
+              (0.00600069867, 0.0200179144, 103.560653)),
+    'UVFS': ((0.6961663, 0.4079426, 0.8974794),
+             (0.00467914826, 0.0135120631, 97.9340025)),
+    'CAF2': ((0.5675888, 0.4710914, 3.8484723),
+             (0.00252642999, 0.0100783328, 1200.55597)),
+    'N-SF11': ((1.73759695, 0.313747346, 1.89878101),
+               (0.013188707, 0.0623068142, 155.23629)),
+}
+
+# Most wavelengths a spectrum may have, and most of them drawn as lines
+max_wavelengths = 1000
+
+spectrum_lines = 7
+
+spectrum_colors = ['#EF553B', '#00cc96', '#ab63fa', '#FFA15A', '#19d3f3',
+                   '#FF6692', '#B6E880']
+
+spectrum_fill = 'rgba(99, 110, 250, 0.25)'
+
+# How the plotted traces are sent, see codec.encode_trace. Rounded 'json'
+# ends up smallest once compressed, 'f4' is quicker to encode.
+trace_encoding = 'json'
+
+trace_digits = 6
+
+# The compute pool (see workers.py): how many jobs run at once, how many
+# more may wait, and how long (s) a request waits for its job. 'thread' or
+# 'process' workers.
+compute_workers = 4
+
+compute_queue = 8
+
+compute_timeout = 20.
+
+compute_kind = 'thread'
+
+compute_busy_text = '*The server is busy, please try again in a moment.*'
+
+compute_timeout_text = '*This took too long, try a larger z step.*'
+
+# Algorithms Flask-Compress may use for responses, in order of preference
+compress_algorithms = ['br', 'gzip']
+
+# How long (s) a figure update waits for newer ones before it starts
+coalesce_delay = 0.03
+
 report_headline = '## beampage report\n'
 
 report_entry = '''
@@ -25,12 +119,139 @@ minspot = '''
 
 table_headline = '###### Optics overview'
 
+table_header = '''
+| Element | Type | Position (mm) | Focal length (mm) |
+|--------:|:-----|--------------:|------------------:|
+'''
+
+table_row = '| {} | {} | {} | {} |\n'
+
+chromatic_headline = '###### Chromatic focal shift, {:g} to {:g} nm'
+
+chromatic_minspot = '''
+\n\nThe smallest spot is between _z_ = {:3.4f} and {:3.4f} mm, {:3.4f} to
+{:3.4f} mm wide.\n\n
+'''
+
+chromatic_header = '''
+| Element | Focal length (mm) | Focus (mm) | Focus shift (mm) |
+|--------:|------------------:|-----------:|-----------------:|
+'''
+
+chromatic_row = '| {} | {:g} to {:g} | {:3.4f} to {:3.4f} | {:3.4f} |\n'
+
+# HTTP API limits, see api.py
+api_max_systems = 1000
+api_chunk_points = 10000
+
+# Grid points of all systems in one request together (the npy is 8 bytes
+# per point)
+api_max_points = 2 ** 27
+
+# How many element reports and table rows are kept for reuse
+report_cache_size = 4096
+
 elem_title = '###### Element {}: {}\n\n'
 
+optimize_time_limit = 1.0
+
+optimize_headline = '''
+##### Optimize
+
+Finds positions (and, given a set of stock focal lengths, focal lengths)
+of the lenses so that the final focus has the target waist and position.
+'''
+
+optimize_bad_set = '*Could not read the stock focal lengths.*'
+
+optimize_bad_target = ('*The target waist has to be a positive number, and '
+                       'the target position a number.*')
+
+optimize_result = '''
+\n\n**Best system:** waist {:3.4f} mm at _z_ = {:3.4f} mm\n\n
+'''
+
+optimize_history_headline = '###### Improvements'
+
+optimize_entry = ('{:3.3f} s: waist {:3.4f} mm at _z_ = {:3.4f} mm '
+                  '(cost {:.3g})\n\n')
+
+tolerance_headline = '''
+##### Tolerances
+
+How much the final waist and focus position vary with mounting errors of
+the lens positions and the tolerance of the focal lengths. Normal errors
+have the tolerance as their standard deviation, uniform errors go up to
+it either way.
+'''
+
+# Samples of a tolerance analysis, by default and at most
+tolerance_samples = 100000
+
+tolerance_max_samples = 10 ** 7
+
+# Worker processes of a tolerance analysis (None for one per core)
+tolerance_workers = None
+
+# Analyses running at once per worker, and how many more may wait. They
+# have a pool of their own, as they take far longer than the figures.
+tolerance_runs = 2
+
+tolerance_queue = 2
+
+tolerance_percentiles = (5, 50, 95)
+
+# How often (s) a running analysis leaves its progress, and how often (ms)
+# the page asks for it
+tolerance_update_interval = 0.25
+
+tolerance_poll_interval = 500
+
+tolerance_bad_samples = '*Give between 1 and {:,} samples.*'
+
+tolerance_failed = '*The analysis failed: {}*'
+
+tolerance_progress = '**{:,} of {:,} samples**\n\n'
+
+tolerance_row = '| {} | {:.4f} | {:.4f} | {} | {:.4f} | {:.4f} |\n'
+
+tolerance_outside = ('\n\n*{:,} samples fell outside the histogram of the '
+                     '{}.*\n')
+
+catalog_files = ['assets/lens_catalog.csv']
+
+# Roughly how many stock lens combinations a design search tries
+catalog_combinations = 64000
+
+catalog_headline = '''
+##### Stock lenses
+
+Match the lenses in the system to the closest stock lenses, or search for
+the combination of stock lenses (at the current lens positions)
+that gets closest to a target waist.
+'''
+
+catalog_nothing = '*No stock lenses fit.*'
+
+catalog_bad_diameter = '*The lens diameter has to be a positive number.*'
+
+catalog_bad_target = ('*The target waist has to be a positive number, and '
+                      'the target position a number or empty.*')
+
+catalog_design = ('''
+**{}** ({} mm): waist {:3.4f} mm at _z_ = {:3.4f} mm (error {:.3g})\n\n''')
+
+sweep_hover = ('%{x:.3f} mm<br>Final waist: %{y:.4f} mm<br>'
+               'Focus position: %{customdata:.3f} mm<extra></extra>')
+
 checkbox_labels = '''
 Double-sided plotting:
 
 `LOAD OPTICS` button resets ID:
+
+Adaptive sampling:
+
+Drag lenses in the plot:
 '''
 
 about_text = '''
@@ -66,6 +287,11 @@ of the selected element.
 
 ![The leftmost app controls](assets/direct_manipulation.png)
 
+The plot follows the boxes as you type, but the system itself is only
+changed when you press Enter or leave the box.
+With "Drag lenses in the plot" checked in the settings, you can also move
+a lens by dragging its label along the plot.
+
 By pressing the `CREATE ELEMENT` button, you can add an optical element.
 It will have the highest ID number and by default be added
 10 mm after the latest optic.
@@ -104,9 +330,9 @@ through the different elements.
 
 ![Parts 1 and 2 of the report](assets/report1.png)
 
-The first part of the report gives the smallest spot found along the
-_z_ vector, and where it was found. Note that this is a numerically found
-value and thus may differ from what you see in the next part. The next part
+The first part of the report gives the smallest spot between _z_ min and
+_z_ max, and where it is. This is calculated exactly from the beam parameters,
+so it does not depend on the _z_ step. The next part
 shows the input optics in a slightly easier-to-read format.
 
 ![Part 3 of the report](assets/report2.png)
@@ -114,6 +340,37 @@ shows the input optics in a slightly easier-to-read format.
 The last part gives a breakdown of propagation for each optical element,
 showing the focal spot size and depth of focus as calculated at the element.
 
+##### Sweep
+
+The "Sweep" tab shows what happens to the beam after the last element
+when the position or focal length of one element is varied between two values,
+with the rest of the system kept as it is.
+Hover over the curve to also see where the final focus ends up.
+
+##### Optimize
+
+The "Optimize" tab searches for lens positions that put the final focus
+at a target position with a target waist.
+Elements can be kept fixed, and if you give a list of stock focal lengths
+the free lenses are also picked from that list.
+Press `USE RESULT` to load the best system found into the main tab.
+
+##### Tolerances
+
+The "Tolerances" tab draws many random versions of the system, with errors
+on the lens positions and focal lengths, and shows how the final waist and
+focus position are spread (statistics and histograms, updated while the
+analysis runs).
+
+##### Catalog
+
+The "Catalog" tab looks up stock lenses from the catalog files.
+`MATCH STOCK LENSES` lists the closest stock lenses for every lens,
+and `SEARCH DESIGNS` tries combinations of stock lenses at the current
+lens positions and lists the ones closest to the target waist
+(and focus position, if given).
+Only lenses coated for the current wavelength are used.
+
 ##### Settings
 
 The 'settings' tab enables you to change various things about the app such as
@@ -121,6 +378,20 @@ the plot scale, wavelength, and resolution.
 
 ![The 'settings' tab](assets/settings.png)
 
+For a laser with a broad spectrum (or several lines), give its wavelengths
+under "Spectrum", as a list (`780, 800, 820`) or as from:to:count
+(`750:850:101`). The lens glass (`N-BK7`, `UVFS`, `CaF2` or `N-SF11`, with
+`3: CaF2` for element 3 alone) sets how the focal lengths change with the
+wavelength; the focal lengths in the table hold at "Wavelength". The plot
+then shows the band the beam covers, or a few of the wavelengths as lines,
+and the report gives the chromatic focal shift behind every lens.
+
+##### API
+
+The same calculations are available without the interface, by posting
+the optics (as CSV text, or as JSON) and settings to `/api/beam`.
+Answers come as JSON, NDJSON or `.npy`, see `api.py` for the details.
+
 ### Credits and acknowledgements
 Made by [Hampus Wikmark Kreuger](https://github.com/hwikmark) in 2020-2021.
 Dedicated to Knut.
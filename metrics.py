@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Counters, histograms and a sampling profiler.
+
+Every process keeps its own counts and every flush_interval writes them to
+a SQLite file, one row per process, so that render() can add up all the
+workers. Rows are per process start, not per pid, as pids get reused.
+Rows not written for max_age seconds are dropped, and the app drops them
+all (forget_processes) when it's created, so earlier deploys don't count.
+The output is the Prometheus text format. Histograms of something ending
+in _seconds use time buckets, _bytes size buckets.
+
+The profiler samples the stacks of every thread of its process and
+counts them in the "collapsed" format flame graph tools read.
+"""
+
+from collections import Counter
+import contextlib
+import functools
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+time_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                0.5, 1., 2.5, 5., 10.)
+size_buckets = tuple(2 ** power for power in range(8, 25, 2))
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS process_snapshots (
+    process TEXT PRIMARY KEY, data TEXT, written REAL);
+CREATE INDEX IF NOT EXISTS process_snapshots_written
+    ON process_snapshots (written);
+'''
+
+
+def buckets_for(name):
+    return(size_buckets if name.endswith('_bytes') else time_buckets)
+
+
+def make_key(name, labels):
+    # Hashable (and JSON-able) name and labels
+    return(json.dumps([name, sorted((labels or {}).items())]))
+
+
+class Metrics:
+    def __init__(self, path, prefix='beampage', flush_interval=5.,
+                 max_age=24 * 3600):
+        self.path = path
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counters = Counter()
+        self._histograms = {}
+        self._flushed = 0.
+        self._process = None
+        self._process_pid = None
+
+    def connection(self):
+        # One connection per process and thread, as in cache.SharedCache
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            local.connection = sqlite3.connect(self.path, timeout=10,
+                                               isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.executescript(_schema)
+            local.pid = os.getpid()
+        return(local.connection)
+
+    def process(self):
+        # This process' row, made once per process
+        if self._process_pid != os.getpid():
+            self._process = '{}:{!r}'.format(os.getpid(), time.time())
+            self._process_pid = os.getpid()
+        return(self._process)
+
+    def count(self, name, labels=None, value=1):
+        with self._lock:
+            self._counters[make_key(name, labels)] += value
+        self.maybe_flush()
+
+    def observe(self, name, value, labels=None):
+        key = make_key(name, labels)
+        buckets = buckets_for(name)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = {'buckets': [0] * len(buckets),
+                                         'sum': 0., 'count': 0}
+            histogram = self._histograms[key]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+        self.maybe_flush()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - started,
+                         {'stage': stage})
+
+    def snapshot(self):
+        with self._lock:
+            return(json.dumps({'counters': dict(self._counters),
+                               'histograms': self._histograms}))
+
+    def maybe_flush(self):
+        if time.monotonic() - self._flushed > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._flushed = time.monotonic()
+        now = time.time()
+        db = self.connection()
+        db.execute('INSERT OR REPLACE INTO process_snapshots VALUES (?, ?, ?)',
+                   (self.process(), self.snapshot(), now))
+        db.execute('DELETE FROM process_snapshots WHERE written < ?',
+                   (now - self.max_age,))
+
+    def collect(self):
+        # Everything from every process, added up
+        self.flush()
+        counters = Counter()
+        histograms = {}
+        for data, in self.connection().execute(
+                'SELECT data FROM process_snapshots'):
+            data = json.loads(data)
+            counters.update(data['counters'])
+            for key, histogram in data['histograms'].items():
+                if key not in histograms:
+                    histograms[key] = {'buckets': [0] * len(
+                        histogram['buckets']), 'sum': 0., 'count': 0}
+                total = histograms[key]
+                total['buckets'] = [a + b for a, b in zip(
+                    total['buckets'], histogram['buckets'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+        return(counters, histograms)
+
+    def render(self):
+        counters, histograms = self.collect()
+        lines = []
+        typed = set()
+
+        def line(name, kind, suffix, labels, value):
+            name = '{}_{}'.format(self.prefix, name)
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+            text = ','.join('{}="{}"'.format(label, str(label_value).replace(
+                '\\', '\\\\').replace('"', '\\"'))
+                for label, label_value in labels)
+            lines.append('{}{}{{{}}} {}'.format(name, suffix, text, value))
+
+        for key in sorted(counters):
+            name, labels = json.loads(key)
+            line(name, 'counter', '', labels, counters[key])
+        for key in sorted(histograms):
+            name, labels = json.loads(key)
+            histogram = histograms[key]
+            bounds = ['{:g}'.format(bound) for bound in buckets_for(name)]
+            for bound, count in zip(bounds + ['+Inf'],
+                                    histogram['buckets'] +
+                                    [histogram['count']]):
+                line(name, 'histogram', '_bucket', labels + [['le', bound]],
+                     count)
+            line(name, 'histogram', '_sum', labels, histogram['sum'])
+            line(name, 'histogram', '_count', labels, histogram['count'])
+        return('\n'.join(lines) + '\n')
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+        self.forget_processes()
+
+    def forget_processes(self):
+        # Drops every process' row; live processes write theirs again (in
+        # full) with their next flush
+        self.connection().execute('DELETE FROM process_snapshots')
+
+
+def instrument(register, metrics, note=None):
+    # Wraps a callback decorator (app.callback) so that every callback it
+    # registers is timed and counted. note(name) is told which callback is
+    # running, e.g. to label the request it came in with.
+    def callback(*args, **kwargs):
+        def decorator(func):
+            @functools.wraps(func)
+            def timed(*func_args, **func_kwargs):
+                if note is not None:
+                    note(func.__name__)
+                started = time.perf_counter()
+                status = 'ok'
+                try:
+                    return(func(*func_args, **func_kwargs))
+                except Exception as error:
+                    # PreventUpdate ends up here as well
+                    status = type(error).__name__
+                    raise
+                finally:
+                    labels = {'callback': func.__name__}
+                    metrics.observe('callback_seconds',
+                                    time.perf_counter() - started, labels)
+                    metrics.count('callbacks_total',
+                                  dict(labels, status=status))
+            return(register(*args, **kwargs)(timed))
+        return(decorator)
+    return(callback)
+
+
+class Profiler:
+    # Samples the stacks of all threads (but its own) every interval s
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return(self._thread is not None and self._thread.is_alive())
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample,
+                                            name='profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(
+                        os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return(''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.stacks.most_common()))
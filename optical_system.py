@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""The element table as a sorted NumPy structured array.
+
+Rows are always sorted by position (ties keep their insertion order), and
+columns are handed out as views, so the physics can use them without any
+copying. pandas is only imported to read and write CSV and for the
+markdown report.
+"""
+
+import numpy as np
+
+import codec
+import extra_vars as exva
+
+record_dtype = np.dtype([(name, dtype)
+                         for name, dtype in exva.optics_dtypes.items()])
+
+columns = record_dtype.names
+
+
+class OpticalSystem:
+    def __init__(self, records=None):
+        if records is None:
+            records = np.zeros(0, dtype=record_dtype)
+        records = np.asarray(records).astype(record_dtype)
+        order = np.argsort(records['Position'], kind='stable')
+        self.records = records[order]
+        self._rows = None
+
+    @classmethod
+    def coerce(cls, optics):
+        # Lets the calculation functions take DataFrames as well
+        if isinstance(optics, cls):
+            return(optics)
+        return(cls.from_frame(optics))
+
+    @classmethod
+    def from_frame(cls, frame):
+        records = np.empty(len(frame), dtype=record_dtype)
+        try:
+            for name in columns:
+                values = np.asarray(frame[name])
+                records[name] = values.astype(record_dtype[name])
+                # Too big for the column would wrap around silently
+                if (record_dtype[name].kind == 'i' and
+                        np.any(records[name] != values)):
+                    raise ValueError('{} out of range'.format(name))
+        except KeyError:
+            raise ValueError('Optics table needs the columns ' +
+                             ', '.join(columns))
+        return(cls(records))
+
+    @classmethod
+    def from_csv(cls, text):
+        import pandas as pd
+        from io import StringIO
+        # Integers read wide, from_frame checks that they fit
+        dtypes = {name: np.int64 if np.dtype(dtype).kind == 'i' else dtype
+                  for name, dtype in exva.optics_dtypes.items()}
+        return(cls.from_frame(pd.read_csv(StringIO(text), dtype=dtypes)))
+
+    @classmethod
+    def decode(cls, text):
+        return(cls(codec.decode_optics(text)))
+
+    def encode(self):
+        return(codec.encode_optics(self.records))
+
+    def to_frame(self):
+        import pandas as pd
+        return(pd.DataFrame(self.records))
+
+    def to_csv(self):
+        return(self.to_frame().to_csv(columns=list(columns), index=False))
+
+    def copy(self):
+        return(OpticalSystem(self.records.copy()))
+
+    def __len__(self):
+        return(len(self.records))
+
+    def __getitem__(self, column):
+        # A view, writing to it changes the system
+        return(self.records[column])
+
+    def _row_of(self):
+        if self._rows is None:
+            self._rows = {int(element): row for row, element
+                          in enumerate(self.records['Element'])}
+        return(self._rows)
+
+    def row(self, element):
+        # Where an element is in the table, KeyError if it isn't there
+        return(self._row_of()[int(element)])
+
+    def record(self, element):
+        return(self.records[self.row(element)])
+
+    def insert(self, element, position, o_type, focal_length):
+        new = np.array([(element, position, o_type, focal_length)],
+                       dtype=record_dtype)
+        row = np.searchsorted(self.records['Position'], position,
+                              side='right')
+        self.records = np.insert(self.records, row, new)
+        self._rows = None
+
+    def remove(self, element):
+        self.records = np.delete(self.records, self.row(element))
+        self._rows = None
+
+    def move(self, element, position):
+        row = self.row(element)
+        moved = self.records[row].copy()
+        moved['Position'] = position
+        rest = np.delete(self.records, row)
+        new_row = np.searchsorted(rest['Position'], position, side='right')
+        self.records = np.insert(rest, new_row, moved)
+        self._rows = None
+
+    def set_focal_length(self, element, focal_length):
+        self.records['FocalLength'][self.row(element)] = focal_length
+
+    def renumber(self):
+        # Element IDs in z order
+        self.records['Element'] = np.arange(len(self.records))
+        self._rows = None
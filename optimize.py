@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""Finding lens positions and focal lengths that give a wanted focus.
+
+The search is differential evolution (DE/rand-to-best/1/bin) on a few
+islands, one per worker process. Each island evaluates its whole population
+at once with beam.sweep, and the islands swap their best members between
+epochs.
+All lengths are in mm.
+"""
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import os
+import threading
+import time
+
+import numpy as np
+
+import beam
+
+# Everything an island needs to know, kept picklable for the process pool.
+# lower/upper bound the lens positions, free marks lenses that may move and
+# focal_set (if not empty) is the set of focal lengths free lenses may use.
+Problem = namedtuple('Problem', [
+    'positions', 'focal_lengths', 'lower', 'upper', 'free', 'focal_set',
+    'waist', 'wavelength', 'z_waist', 'target_waist', 'target_z',
+    'z_tolerance'])
+
+Candidate = namedtuple('Candidate', [
+    'positions', 'focal_lengths', 'waist', 'z_origin', 'cost'])
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+
+def make_problem(positions, focal_lengths, waist, wavelength, target_waist,
+                 target_z, z_waist=0., bounds=None, fixed=(), focal_set=None,
+                 z_tolerance=1.):
+    # bounds is a (lower, upper) pair for all lenses or one pair per lens,
+    # fixed holds indices of lenses that are left alone
+    if not (np.isfinite(target_waist) and target_waist > 0):
+        raise ValueError('The target waist has to be positive')
+    if not np.isfinite(target_z):
+        raise ValueError('The target position has to be a number')
+    positions = np.asarray(positions, dtype=float)
+    focal_lengths = np.asarray(focal_lengths, dtype=float)
+    if bounds is None:
+        bounds = (z_waist, target_z)
+    lower, upper = np.broadcast_arrays(*np.asarray(bounds, dtype=float).T)
+    free = np.ones(len(positions), dtype=bool)
+    free[list(fixed)] = False
+    if focal_set is None:
+        focal_set = []
+    return(Problem(positions=positions,
+                   focal_lengths=focal_lengths,
+                   lower=np.broadcast_to(lower, positions.shape).copy(),
+                   upper=np.broadcast_to(upper, positions.shape).copy(),
+                   free=free,
+                   focal_set=np.sort(np.asarray(focal_set, dtype=float)),
+                   waist=float(waist),
+                   wavelength=float(wavelength),
+                   z_waist=float(z_waist),
+                   target_waist=float(target_waist),
+                   target_z=float(target_z),
+                   z_tolerance=float(z_tolerance)))
+
+
+def num_variables(problem):
+    # One position per free lens, plus a focal length if there is a set
+    num_free = int(problem.free.sum())
+    return(num_free * (2 if len(problem.focal_set) else 1))
+
+
+def decode(problem, x):
+    # Turn points in the unit hypercube, shape (p, num_variables), into
+    # lens positions and focal lengths, both shape (p, n)
+    num_free = int(problem.free.sum())
+    positions = np.tile(problem.positions, (len(x), 1))
+    focal_lengths = np.tile(problem.focal_lengths, (len(x), 1))
+    lower = problem.lower[problem.free]
+    upper = problem.upper[problem.free]
+    positions[:, problem.free] = lower + x[:, :num_free] * (upper - lower)
+    if len(problem.focal_set):
+        choice = np.minimum((x[:, num_free:] * len(problem.focal_set)),
+                            len(problem.focal_set) - 1).astype(int)
+        focal_lengths[:, problem.free] = problem.focal_set[choice]
+    return(positions, focal_lengths)
+
+
+def encode(problem):
+    # The starting system as a point in the unit hypercube
+    free = problem.free
+    span = problem.upper[free] - problem.lower[free]
+    x = (problem.positions[free] - problem.lower[free]) / np.where(
+        span > 0, span, 1)
+    if len(problem.focal_set):
+        choice = np.searchsorted(problem.focal_set,
+                                 problem.focal_lengths[free])
+        choice = np.clip(choice, 0, len(problem.focal_set) - 1)
+        x = np.concatenate([x, (choice + 0.5) / len(problem.focal_set)])
+    return(np.clip(x, 0, 1))
+
+
+def evaluate(problem, x):
+    positions, focal_lengths = decode(problem, x)
+    result = beam.sweep(positions, focal_lengths, problem.waist,
+                        problem.wavelength, problem.z_waist)
+    cost = (((result.waist - problem.target_waist) /
+             problem.target_waist) ** 2 +
+            ((result.z_origin - problem.target_z) /
+             problem.z_tolerance) ** 2)
+    return(cost, result)
+
+
+def evolve(problem, population, costs, generations, seed,
+           mutation=0.7, crossover=0.9):
+    # DE/rand-to-best/1/bin, with the whole population evaluated at once
+    rng = np.random.default_rng(seed)
+    size, dims = population.shape
+    for generation in range(generations):
+        picks = rng.integers(size, size=(3, size))
+        best = population[np.argmin(costs)]
+        mutant = population[picks[0]] + mutation * (
+            best - population[picks[0]] +
+            population[picks[1]] - population[picks[2]])
+        cross = rng.random((size, dims)) < crossover
+        cross[np.arange(size), rng.integers(dims, size=size)] = True
+        trial = np.clip(np.where(cross, mutant, population), 0, 1)
+        trial_costs = evaluate(problem, trial)[0]
+        better = trial_costs < costs
+        population[better] = trial[better]
+        costs[better] = trial_costs[better]
+    return(population, costs)
+
+
+def get_pool(workers):
+    # The pools are kept between runs, starting processes costs more than a
+    # typical solve. Optimizations (request threads) and tolerance analyses
+    # (their own pool's threads) ask for them at the same time, so one
+    # that may be in use is never shut down: there's one per size.
+    with _pool_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(workers)
+        return(_pools[workers])
+
+
+def candidate(problem, x):
+    cost, result = evaluate(problem, x[np.newaxis])
+    positions, focal_lengths = decode(problem, x[np.newaxis])
+    return(Candidate(positions=positions[0], focal_lengths=focal_lengths[0],
+                     waist=result.waist[0], z_origin=result.z_origin[0],
+                     cost=cost[0]))
+
+
+def solve_iter(problem, workers=None, population_size=128, generations=25,
+               time_limit=1., max_epochs=200, tolerance=1e-12, seed=None):
+    # Yields a Candidate every time the best solution improves, starting
+    # with the system as it was given
+    if workers is None:
+        workers = os.cpu_count() or 1
+    started = time.monotonic()
+    rng = np.random.default_rng(seed)
+    dims = num_variables(problem)
+    best_x = encode(problem)
+    best = candidate(problem, best_x)
+    yield best
+    if dims == 0:
+        return
+    islands = []
+    for island in range(workers):
+        population = rng.random((population_size, dims))
+        population[0] = best_x
+        islands.append((population, evaluate(problem, population)[0]))
+    for epoch in range(max_epochs):
+        seeds = rng.integers(2 ** 32, size=workers)
+        if workers > 1:
+            pool = get_pool(workers)
+            islands = list(pool.map(evolve, [problem] * workers,
+                                    *zip(*islands), [generations] * workers,
+                                    seeds))
+        else:
+            islands = [evolve(problem, *islands[0], generations, seeds[0])]
+        leader = min(range(workers), key=lambda i: islands[i][1].min())
+        population, costs = islands[leader]
+        if costs.min() < best.cost:
+            best_x = population[np.argmin(costs)].copy()
+            best = candidate(problem, best_x)
+            yield best
+        if best.cost < tolerance or time.monotonic() - started > time_limit:
+            return
+        # Migration: everyone gets a copy of the best member so far
+        for population, costs in islands:
+            worst = np.argmax(costs)
+            population[worst] = best_x
+            costs[worst] = best.cost
+
+
+def solve(problem, **kwargs):
+    for best in solve_iter(problem, **kwargs):
+        pass
+    return(best)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""The beam physics of a system with the app's settings, NumPy only.
+
+These are the settings-level wrappers around beam.py, optimize.py,
+tolerance.py and catalog.py that the app, the API and batch.py all go
+through. Settings are the dict of assets/default_settings.json (strings or
+numbers), systems are OpticalSystems (DataFrames work too).
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+import beam
+import catalog
+import dispersion
+import extra_vars as exva
+import optimize
+import tolerance
+from optical_system import OpticalSystem
+
+match_columns = ['Element', 'FocalLength', 'Vendor', 'Part',
+                 'StockFocalLength', 'Diameter']
+
+# A system at many wavelengths (nm): focal lengths and segments have shape
+# (wavelength, element), focus one entry per wavelength
+Spectrum = namedtuple('Spectrum', ['wavelengths', 'focal_lengths',
+                                   'segments', 'focus'])
+
+# The lens catalog is loaded the first time it's used, see get_catalog
+
+stock_lenses = None
+
+
+def set_origin(settings, optical_elements):
+    # The beam always starts at z min, whatever the table says. A copy, the
+    # caller's system is left alone.
+    optical_elements = OpticalSystem.coerce(optical_elements).copy()
+    optical_elements['Position'][0] = float(settings['z_min'])
+    return(optical_elements)
+
+
+def settings_grid(settings):
+    # The z grid that w(z) is computed on
+    return(beam.Grid(float(settings['z_min']), float(settings['z_max']),
+                     float(settings['z_step'])))
+
+
+def calc_segments(settings, optical_elements):
+    optical_elements = set_origin(settings, optical_elements)
+    waist = float(settings['waist'])
+    wavelength = float(settings['wavelength']) * 1e-6
+    segments = beam.propagate(optical_elements['Position'],
+                              optical_elements['Type'],
+                              optical_elements['FocalLength'],
+                              waist, wavelength)
+    return(segments)
+
+
+def calc_focus(settings, segments):
+    focus = beam.min_spot(segments, float(settings['z_min']),
+                          float(settings['z_max']))
+    return(focus)
+
+
+def calc_spectrum(settings, optical_elements, wavelengths=None,
+                  lens_data=None):
+    # The system at all wavelengths at once, with the focal lengths of the
+    # table at the settings' wavelength. By default the wavelengths and
+    # glasses come from the settings (see dispersion.parse_wavelengths and
+    # parse_glasses). Returns None if there are no wavelengths.
+    optical_elements = set_origin(settings, optical_elements)
+    if wavelengths is None:
+        wavelengths = dispersion.parse_wavelengths(
+            settings.get('wavelengths', ''), exva.max_wavelengths)
+    if lens_data is None:
+        lens_data = dispersion.parse_glasses(settings.get('glass', ''))
+    wavelengths = np.asarray(wavelengths, dtype=float)
+    if not len(wavelengths):
+        return(None)
+    focal_lengths = dispersion.focal_lengths(
+        optical_elements['Element'], optical_elements['Type'],
+        optical_elements['FocalLength'], wavelengths,
+        float(settings['wavelength']), lens_data)
+    # Every wavelength is a row of one batch, with the same input waist
+    segments = beam.propagate(optical_elements['Position'],
+                              optical_elements['Type'], focal_lengths,
+                              float(settings['waist']), wavelengths * 1e-6)
+    return(Spectrum(wavelengths=wavelengths, focal_lengths=focal_lengths,
+                    segments=segments, focus=calc_focus(settings, segments)))
+
+
+def sweep_element(settings, optical_elements, element, parameter, values):
+    # Final beam for every value of one lens' position or focal length,
+    # with everything else in the system left as it is
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    is_lens = optical_elements['Type'] == 1
+    positions = np.tile(optical_elements['Position'][is_lens],
+                        (len(values), 1))
+    focal_lengths = np.tile(optical_elements['FocalLength'][is_lens],
+                            (len(values), 1))
+    column = np.flatnonzero(optical_elements['Element'][is_lens] ==
+                            element)[0]
+    if parameter == 'Position':
+        positions[:, column] = values
+    else:
+        focal_lengths[:, column] = values
+    result = beam.sweep(positions, focal_lengths, float(settings['waist']),
+                        float(settings['wavelength']) * 1e-6,
+                        float(settings['z_min']))
+    return(result)
+
+
+def optimize_optics(settings, optical_elements, target_waist, target_z,
+                    fixed=(), focal_set=None, **kwargs):
+    # Runs the optimizer on the lenses of the system and yields the whole
+    # system (as a new OpticalSystem) with every improvement
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    is_lens = optical_elements['Type'] == 1
+    z_min = float(settings['z_min'])
+    problem = optimize.make_problem(
+        optical_elements['Position'][is_lens],
+        optical_elements['FocalLength'][is_lens],
+        float(settings['waist']), float(settings['wavelength']) * 1e-6,
+        target_waist, target_z, z_waist=z_min,
+        bounds=(z_min, max(target_z, z_min)),
+        fixed=np.flatnonzero(np.isin(optical_elements['Element'][is_lens],
+                                     list(fixed))),
+        focal_set=focal_set)
+    for best in optimize.solve_iter(problem, **kwargs):
+        records = optical_elements.records.copy()
+        records['Position'][is_lens] = best.positions
+        records['FocalLength'][is_lens] = best.focal_lengths
+        yield best, OpticalSystem(records)
+
+
+def tolerance_analysis(settings, optical_elements, samples,
+                       position_spread=0., focal_spread=0.,
+                       distribution='normal', **kwargs):
+    # Random errors on the lens positions (mm) and focal lengths (relative)
+    # of the system; yields the number of samples done and the statistics
+    # of the final beam so far, see tolerance.analyze_iter
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    is_lens = optical_elements['Type'] == 1
+    problem = tolerance.make_problem(
+        optical_elements['Position'][is_lens],
+        optical_elements['FocalLength'][is_lens],
+        float(settings['waist']), float(settings['wavelength']) * 1e-6,
+        float(settings['z_min']), position_spread, focal_spread,
+        distribution)
+    return(tolerance.analyze_iter(problem, samples, **kwargs))
+
+
+def get_catalog():
+    # Stock lenses are only loaded the first time anybody asks for them
+    global stock_lenses
+    if stock_lenses is None:
+        stock_lenses = catalog.load_catalogs(exva.catalog_files)
+    return(stock_lenses)
+
+
+def match_stock_lenses(settings, optical_elements, stock, count=3,
+                       diameter=None):
+    # The count closest stock lenses for every lens in the system, rows of
+    # match_columns
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    matches = []
+    wavelength = float(settings['wavelength'])
+    is_lens = optical_elements['Type'] == 1
+    for el_number, focal in zip(optical_elements['Element'][is_lens],
+                                optical_elements['FocalLength'][is_lens]):
+        for part in stock.parts[catalog.nearest(stock, focal, count, diameter,
+                                                wavelength)]:
+            matches.append([el_number, focal, part['Vendor'], part['Part'],
+                            part['FocalLength'], part['Diameter']])
+    return(matches)
+
+
+def search_stock_designs(settings, optical_elements, stock, target_waist,
+                         target_z=None, diameter=None):
+    # Stock lens combinations at the current lens positions. The number of
+    # candidates per lens shrinks with the number of lenses to keep the
+    # number of combinations roughly constant.
+    optical_elements = OpticalSystem.coerce(optical_elements)
+    is_lens = optical_elements['Type'] == 1
+    if not is_lens.any():
+        return([])
+    candidates = max(int(exva.catalog_combinations ** (1 / is_lens.sum())),
+                     2)
+    designs = catalog.search_designs(
+        stock, optical_elements['Position'][is_lens],
+        float(settings['waist']), float(settings['wavelength']) * 1e-6,
+        target_waist, z_waist=float(settings['z_min']), target_z=target_z,
+        focal_lengths=optical_elements['FocalLength'][is_lens],
+        candidates=candidates, diameter=diameter,
+        coating_wavelength=float(settings['wavelength']))
+    return(designs)
+
+
+def lens_marks(optical_elements, segments):
+    # Names and (position, width) of the lenses, for the plot annotations
+    lens_widths = beam.beam_width(segments.start, segments)
+    show_lenses = [[], []]
+    for o_index, (el_number, o_type) in enumerate(zip(
+            optical_elements['Element'], optical_elements['Type'])):
+        if o_type == 1:
+            show_lenses[0].append(str(el_number))
+            show_lenses[1].append([float(segments.start[o_index]),
+                                   float(lens_widths[o_index])])
+    return(show_lenses)
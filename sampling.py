@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Choosing which points of w(z) are worth sending to the browser.
+
+adaptive_grid places points according to the beam itself, while decimate
+thins out an already computed curve to a fixed budget without losing its
+shape.
+"""
+
+import numpy as np
+
+import beam
+
+
+def adaptive_grid(segments, z_min, z_max, num_points=2000):
+    # Points are spaced evenly in Gouy phase, arctan((z - z0) / zR), within
+    # each segment. That gives spacing ~zR around a waist and coarse steps in
+    # the far field where w(z) is practically a straight line. Segment
+    # boundaries (the elements) and the waists are always included.
+    lower = np.maximum(segments.start, z_min)
+    lower[0] = z_min
+    upper = beam.segment_ends(segments, z_max)
+    valid = lower < upper
+    if not valid.any():
+        return(np.array([float(z_min)]))
+    z_origin = segments.z_origin[valid]
+    rayleigh = segments.rayleigh[valid]
+    lower = lower[valid]
+    upper = upper[valid]
+    per_segment = max(num_points // len(lower), 3)
+    theta_lower = np.arctan((lower - z_origin) / rayleigh)
+    theta_upper = np.arctan((upper - z_origin) / rayleigh)
+    steps = np.linspace(0, 1, per_segment)
+    theta = theta_lower[:, np.newaxis] + (
+        theta_upper - theta_lower)[:, np.newaxis] * steps
+    z_grid = z_origin[:, np.newaxis] + rayleigh[:, np.newaxis] * np.tan(theta)
+    z_grid[:, 0] = lower
+    z_grid[:, -1] = upper
+    in_segment = (z_origin > lower) & (z_origin < upper)
+    return(np.unique(np.concatenate([z_grid.ravel(),
+                                     z_origin[in_segment]])))
+
+
+def minmax_indices(y, num_points):
+    # Keep the smallest and largest value of each bucket (plus both ends),
+    # which keeps every peak and dip of the curve.
+    buckets = max((num_points - 2) // 2, 1)
+    inner = len(y) - 2
+    bucket = np.arange(inner) * buckets // inner
+    # Sorted by bucket first and value second, so each bucket's minimum and
+    # maximum end up at its first and last place
+    order = np.lexsort((y[1:-1], bucket)) + 1
+    first = np.searchsorted(bucket, np.arange(buckets))
+    last = np.append(first[1:], inner) - 1
+    return(np.unique(np.concatenate([[0, len(y) - 1], order[first],
+                                     order[last]])))
+
+
+def lttb_indices(x, y, num_points):
+    # Largest-Triangle-Three-Buckets (Steinarsson 2013). Slower than min/max
+    # bucketing since each bucket depends on the point picked before it.
+    buckets = num_points - 2
+    edges = np.linspace(1, len(y) - 1, buckets + 1).astype(int)
+    picked = np.empty(num_points, dtype=int)
+    picked[0] = 0
+    picked[-1] = len(y) - 1
+    for bucket in range(buckets):
+        start, stop = edges[bucket], edges[bucket + 1]
+        if bucket + 1 < buckets:
+            next_x = x[stop:edges[bucket + 2]].mean()
+            next_y = y[stop:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        prev_x, prev_y = x[picked[bucket]], y[picked[bucket]]
+        area = np.abs((prev_x - next_x) * (y[start:stop] - prev_y) -
+                      (prev_x - x[start:stop]) * (next_y - prev_y))
+        picked[bucket + 1] = start + np.argmax(area)
+    return(picked)
+
+
+def decimate(x, y, num_points, method='minmax'):
+    # Thin out (x, y) to at most num_points points (3 at the least). The
+    # input is returned untouched if it is already small enough.
+    num_points = max(num_points, 3)
+    if len(y) <= num_points:
+        return(x, y)
+    if method == 'minmax':
+        keep = minmax_indices(y, num_points)
+    elif method == 'lttb':
+        keep = lttb_indices(x, y, num_points)
+    else:
+        raise ValueError('Unknown decimation method!')
+    return(x[keep], y[keep])
+
+
+def decimate_blocks(blocks, size, num_points):
+    # decimate(x, y, num_points) with the min/max method, for a curve of
+    # size points that comes as (start, x, y) blocks (see
+    # beam.width_blocks). Only the points picked so far are kept.
+    num_points = max(num_points, 3)
+    if size <= num_points:
+        parts = [(x, y) for start, x, y in blocks]
+        if not parts:
+            return(np.empty(0), np.empty(0))
+        return(tuple(np.concatenate(values) for values in zip(*parts)))
+    buckets = max((num_points - 2) // 2, 1)
+    inner = size - 2
+    # Index, x and y of the lowest and the highest point of every bucket,
+    # and of both ends
+    lowest = [np.zeros(buckets, dtype=int), np.zeros(buckets),
+              np.full(buckets, np.inf)]
+    highest = [np.zeros(buckets, dtype=int), np.zeros(buckets),
+               np.full(buckets, -np.inf)]
+    ends = [np.array([0, size - 1]), np.zeros(2), np.zeros(2)]
+    for start, x, y in blocks:
+        index = start + np.arange(len(y))
+        at_end = (index == 0) | (index == size - 1)
+        which = (index[at_end] > 0).astype(int)
+        ends[1][which] = x[at_end]
+        ends[2][which] = y[at_end]
+        inside = (index >= 1) & (index <= inner)
+        index, x, y = index[inside], x[inside], y[inside]
+        if not len(y):
+            continue
+        bucket = (index - 1) * buckets // inner
+        # As in minmax_indices: each bucket's minimum first and maximum
+        # last, the earliest minimum and the latest maximum on ties
+        order = np.lexsort((y, bucket))
+        runs = np.flatnonzero(np.diff(bucket[order])) + 1
+        for picks, better, best in (
+                (order[np.concatenate([[0], runs])], np.less, lowest),
+                (order[np.append(runs, len(order)) - 1], np.greater_equal,
+                 highest)):
+            replace = better(y[picks], best[2][bucket[picks]])
+            picks = picks[replace]
+            for values, new in zip(best, (index, x, y)):
+                values[bucket[picks]] = new[picks]
+    index, x, y = (np.concatenate(values)
+                   for values in zip(lowest, highest, ends))
+    index, keep = np.unique(index, return_index=True)
+    return(x[keep], y[keep])
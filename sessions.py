@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Server-side state of the browser sessions.
+
+Every session (a page load, see serve_layout in app.py) keeps a few named
+text values, like its optics and its settings; results are in the shared
+cache under keys made from those. Session(store, session_id) is the handle
+the app passes around. There are three stores with the same methods:
+
+    MemoryStore  a dict, for a single process
+    SQLiteStore  a SQLite file in WAL mode, shared by the workers of a node
+    RedisStore   anything with the hash commands of redis-py (hget, hset,
+                 expire, delete), shared by any number of nodes
+
+open_store picks one from a URL: memory://, sqlite:///relative/path (four
+slashes for an absolute one) or redis://host:port/db. Sessions that
+haven't been written to in max_age seconds are forgotten.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT, name TEXT, value TEXT, used REAL,
+    PRIMARY KEY (session, name));
+CREATE INDEX IF NOT EXISTS sessions_used ON sessions (used);
+'''
+
+
+class Session:
+    def __init__(self, store, session_id):
+        self.store = store
+        self.session_id = session_id
+
+    def get(self, name, default=None):
+        value = self.store.get(self.session_id, name)
+        return(default if value is None else value)
+
+    def put(self, name, value):
+        self.store.put(self.session_id, name, value)
+
+    def forget(self):
+        self.store.forget(self.session_id)
+
+
+class MemoryStore:
+    def __init__(self, max_age=24 * 3600):
+        self.max_age = max_age
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, name):
+        with self._lock:
+            values, used = self._sessions.get(session, ({}, None))
+            return(values.get(name))
+
+    def put(self, session, name, value):
+        now = time.time()
+        with self._lock:
+            for old in [old for old, (values, used) in self._sessions.items()
+                        if used < now - self.max_age]:
+                del self._sessions[old]
+            values, used = self._sessions.get(session, ({}, now))
+            values[name] = value
+            self._sessions[session] = (values, now)
+
+    def forget(self, session):
+        with self._lock:
+            self._sessions.pop(session, None)
+
+
+class SQLiteStore:
+    def __init__(self, path, max_age=24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+    def connection(self):
+        # One connection per process and thread, as in cache.SharedCache
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            local.connection = sqlite3.connect(self.path, timeout=10,
+                                               isolation_level=None)
+            local.connection.execute('PRAGMA journal_mode=WAL')
+            local.connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection.executescript(_schema)
+            local.pid = os.getpid()
+        return(local.connection)
+
+    def get(self, session, name):
+        row = self.connection().execute(
+            'SELECT value FROM sessions WHERE session = ? AND name = ?',
+            (session, name)).fetchone()
+        return(None if row is None else row[0])
+
+    def put(self, session, name, value):
+        now = time.time()
+        db = self.connection()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM sessions WHERE used < ?',
+                       (now - self.max_age,))
+            db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                       (session, name, value, now))
+            # The whole session lives as long as its newest value
+            db.execute('UPDATE sessions SET used = ? WHERE session = ?',
+                       (now, session))
+
+    def forget(self, session):
+        self.connection().execute('DELETE FROM sessions WHERE session = ?',
+                                  (session,))
+
+
+class RedisStore:
+    # One Redis hash per session, expiring max_age s after the last write
+    def __init__(self, client, max_age=24 * 3600, prefix='beampage:session:'):
+        self.client = client
+        self.max_age = max_age
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, max_age=24 * 3600):
+        import redis
+        return(cls(redis.Redis.from_url(url), max_age))
+
+    def get(self, session, name):
+        value = self.client.hget(self.prefix + session, name)
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        return(value)
+
+    def put(self, session, name, value):
+        key = self.prefix + session
+        self.client.hset(key, name, value)
+        self.client.expire(key, int(self.max_age))
+
+    def forget(self, session):
+        self.client.delete(self.prefix + session)
+
+
+def open_store(url, max_age=24 * 3600):
+    scheme, _, rest = url.partition('://')
+    if scheme == 'memory':
+        return(MemoryStore(max_age))
+    elif scheme == 'sqlite':
+        # sqlite:///aux/sessions.sqlite is relative, like in SQLAlchemy
+        return(SQLiteStore(rest[1:], max_age))
+    elif scheme in ('redis', 'rediss', 'unix'):
+        return(RedisStore.from_url(url, max_age))
+    raise ValueError('Unknown session store ' + url)
@@ -0,0 +1,22 @@
+import os
+import shutil
+import tempfile
+import extra_vars as exva
+
+# The app opens its stores when it's imported, which happens while the
+# tests are collected: point them at a scratch directory before that, so
+# nothing in the repo's aux/ decides a test
+scratch = tempfile.mkdtemp(prefix='beampage-tests-')
+
+
+def pytest_configure(config):
+    exva.cache_file = os.path.join(scratch, 'cache.sqlite')
+    exva.tickets_file = os.path.join(scratch, 'tickets.sqlite')
+    exva.metrics_file = os.path.join(scratch, 'metrics.sqlite')
+    exva.session_store = 'sqlite:///' + os.path.join(scratch,
+                                                     'sessions.sqlite')
+    exva.logfile = os.path.join(scratch, 'logfile.txt')
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(scratch, ignore_errors=True)
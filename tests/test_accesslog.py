@@ -0,0 +1,58 @@
+import json
+import os
+import accesslog
+
+
+def read(path):
+    with open(path) as logfile:
+        return [json.loads(line) for line in logfile]
+
+
+class TestAccessLog:
+    def test_records(self, tmp_path):
+        path = str(tmp_path / 'logs' / 'access.log')
+        logger = accesslog.AccessLog(path, flush_interval=0.01)
+        logger.log('connection', user='anonymous', session='abc')
+        logger.log('request', path='/', seconds=0.1)
+        logger.flush()
+        records = read(path)
+        assert [record['event'] for record in records] == [
+            'connection', 'request']
+        assert records[0]['session'] == 'abc'
+        assert records[1]['seconds'] == 0.1
+        assert records[0]['pid'] == os.getpid()
+        logger.close()
+
+    def test_appends(self, tmp_path):
+        path = str(tmp_path / 'access.log')
+        for event in ('first', 'second'):
+            logger = accesslog.AccessLog(path)
+            logger.log(event)
+            logger.close()
+        assert [record['event'] for record in read(path)] == [
+            'first', 'second']
+
+    def test_rotation(self, tmp_path):
+        path = str(tmp_path / 'access.log')
+        logger = accesslog.AccessLog(path, max_bytes=200, backups=2)
+        for index in range(20):
+            logger.write([{'event': 'request', 'index': index}])
+        names = sorted(os.listdir(str(tmp_path)))
+        assert names == ['access.log', 'access.log.1', 'access.log.2',
+                         'access.log.lock']
+        for name in names[:3]:
+            assert os.path.getsize(str(tmp_path / name)) <= 200
+        # The newest records are kept
+        assert read(path)[-1]['index'] == 19
+
+    def test_drops_when_full(self, tmp_path):
+        path = str(tmp_path / 'access.log')
+        logger = accesslog.AccessLog(path, queue_size=1)
+        # No writer thread, so the queue fills up
+        logger._pid = os.getpid()
+        for index in range(5):
+            logger.log('request', index=index)
+        assert logger.dropped == 4
+        logger._pid = None
+        logger.write([])
+        assert read(path) == [dict(read(path)[0], event='dropped', count=4)]
@@ -0,0 +1,140 @@
+import io
+import json
+import pytest
+import numpy as np
+import api
+import app
+import beam
+import physics
+
+simple_optics = '''Element,Position,Type,FocalLength
+0,-1000,0,0
+1,-250,1,250
+'''
+
+settings = {"wavelength": 800, "waist": 5, "z_min": -1000, "z_max": 1000,
+            "z_step": 1}
+
+
+@pytest.fixture
+def client():
+    return app.create_app().server.test_client()
+
+
+class TestRead:
+    def test_forms(self):
+        rows = [{'Element': 1, 'Position': -250, 'Type': 1,
+                 'FocalLength': 250},
+                {'Element': 0, 'Position': -1000, 'Type': 0,
+                 'FocalLength': 0}]
+        cols = {'Element': [0, 1], 'Position': [-1000, -250],
+                'Type': [0, 1], 'FocalLength': [0, 250]}
+        for data in (simple_optics, rows, cols):
+            system = api.read_system(data)
+            assert list(system['Element']) == [0, 1]
+
+    @pytest.mark.parametrize('data', [
+        [{'Element': 0}], 'Element,Position\n0,1\n',
+        [{'Element': 1, 'Position': 0, 'Type': 1, 'FocalLength': 5}]])
+    def test_bad(self, data):
+        with pytest.raises(ValueError):
+            api.read_system(data)
+
+
+class TestRoutes:
+    def test_json(self, client):
+        answer = client.post('/api/beam', json={'settings': settings,
+                                                'optics': simple_optics})
+        data = answer.get_json()
+        assert len(data['z']) == len(data['w']) == 2000
+        assert data['focus']['z'] == pytest.approx(0, abs=0.01)
+        assert data['report'].startswith('###### Element 0')
+
+    def test_matches_app(self, client):
+        answer = client.post('/api/beam', json={'settings': settings,
+                                                'optics': simple_optics})
+        w_z, show_lenses, report_text = app.calc_gaussian(
+            dict(settings), app.OpticalSystem.from_csv(simple_optics))
+        assert np.allclose(answer.get_json()['w'], w_z)
+
+    def test_batch_npy(self, client):
+        systems = [simple_optics, simple_optics.replace('250\n', '100\n')]
+        answer = client.post('/api/beam?format=npy',
+                             json={'settings': settings, 'systems': systems})
+        rows = np.load(io.BytesIO(answer.data))
+        assert rows.shape == (3, 2000)
+        assert rows[2].min() < rows[1].min()
+
+    def test_npy_float32(self, client):
+        answer = client.post('/api/beam?format=npy&dtype=float32',
+                             json={'settings': settings,
+                                   'systems': [simple_optics] * 2})
+        rows = np.load(io.BytesIO(answer.data))
+        assert rows.dtype == np.float32
+        assert rows.shape == (3, 2000)
+        answer = client.post('/api/beam?format=npy&dtype=int8',
+                             json={'settings': settings,
+                                   'optics': simple_optics})
+        assert answer.status_code == 400
+
+    def test_ndjson(self, client):
+        answer = client.post(
+            '/api/beam?report=0', json={'settings': settings,
+                                        'systems': [simple_optics] * 2},
+            headers={'Accept': 'application/x-ndjson'})
+        lines = [json.loads(line) for line in answer.data.splitlines()]
+        assert [line['system'] for line in lines] == [0, 0, 1, 1]
+        assert lines[0]['report'] is None
+        assert len(lines[1]['w']) == 2000
+
+    def test_csv_body(self, client):
+        answer = client.post('/api/beam', data=simple_optics,
+                             content_type='text/csv')
+        assert answer.status_code == 200
+
+    def test_bad_request(self, client):
+        answer = client.post('/api/beam', json={'settings': settings})
+        assert answer.status_code == 400
+        assert 'error' in answer.get_json()
+
+    @pytest.mark.parametrize('body', [
+        {'settings': settings, 'optics': simple_optics + '2,0,2,50\n'},
+        {'settings': [1], 'optics': simple_optics},
+        {'settings': dict(settings, z_step=0), 'optics': simple_optics},
+        {'settings': dict(settings, z_step=-1), 'optics': simple_optics},
+        {'settings': dict(settings, z_max=-2000), 'optics': simple_optics},
+        {'settings': dict(settings, waist='x'), 'optics': simple_optics},
+        {'settings': dict(settings, wavelength=None),
+         'optics': simple_optics},
+        {'settings': settings, 'systems': simple_optics}])
+    def test_bad_input(self, client, body):
+        for name in api.formats:
+            answer = client.post('/api/beam?format=' + name, json=body)
+            assert answer.status_code == 400
+            assert 'error' in answer.get_json()
+
+    def test_json_budget(self, client, monkeypatch):
+        monkeypatch.setattr(app.exva, 'max_grid_points', 3999)
+        body = {'settings': settings, 'systems': [simple_optics] * 2}
+        answer = client.post('/api/beam', json=body)
+        assert answer.status_code == 400
+        assert 'ndjson or npy' in answer.get_json()['error']
+        answer = client.post('/api/beam?format=ndjson', json=body)
+        assert answer.status_code == 200
+
+    def test_empty_grid(self):
+        segments = physics.calc_segments(settings,
+                                         api.read_system(simple_optics))
+        result = {'grid': beam.Grid(1., 0., 1.),
+                  'focus': physics.calc_focus(settings, segments),
+                  'segments': segments._asdict()}
+        answer = json.loads(api.write_json([result], True))
+        assert answer['z'] == answer['w'] == []
+
+    def test_point_budget(self, client, monkeypatch):
+        monkeypatch.setattr(app.exva, 'api_max_points', 3999)
+        answer = client.post('/api/beam?format=npy',
+                             json={'settings': settings,
+                                   'systems': [simple_optics] * 2})
+        assert answer.status_code == 400
+        assert 'grid points' in answer.get_json()['error']
@@ -1,8 +1,14 @@
 import pytest
 import app
+import physics
+import sessions
 import pandas as pd
 import io
 import numpy as np
+import json
+import subprocess
+import sys
+import threading
 
 simple_optics = '''
 Element,Position,Type,FocalLength
@@ -66,3 +72,364 @@ class TestGaussian:
         settings = test_settings
         w_z, show_lenses, report_text = app.calc_gaussian(settings, optics)
         assert show_lenses[0][0] == '1'
+
+    def test_exact_focus(self):
+        optics = pd.read_csv(io.StringIO(simple_optics))
+        settings = test_settings
+        trace = app.calc_trace(settings, optics)
+        focus = app.calc_focus(settings, trace.segments)
+        w_z, show_lenses, report_text = app.calc_gaussian(settings, optics,
+                                                          trace)
+        assert focus.width <= min(w_z)
+        assert focus.width == pytest.approx(min(w_z), 1e-5)
+
+
+class TestSweep:
+    def test_sweep_focal_length(self):
+        optics = pd.read_csv(io.StringIO(simple_optics))
+        settings = dict(test_settings, wavelength=800)
+        values = np.array([200., 250., 300.])
+        result = app.sweep_element(settings, optics, 1, 'FocalLength', values)
+        segments = physics.calc_segments(settings, optics)
+        assert result.waist[1] == pytest.approx(segments.waist[-1])
+        assert result.z_origin == pytest.approx(values - 250, abs=0.1)
+
+    def test_initial_call(self):
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        for clicks, settings in ((0, json.dumps(test_settings)), (1, '')):
+            with pytest.raises(app.PreventUpdate):
+                app.update_sweep(clicks, 1, 'Position', -300, -100, optics,
+                                 settings)
+
+
+class TestOptimize:
+    def test_optimize_optics(self):
+        optics = pd.read_csv(io.StringIO(simple_optics))
+        settings = dict(test_settings, wavelength=800)
+        moved = optics.copy()
+        moved.at[1, 'Position'] = -150
+        target = physics.calc_segments(settings, moved)
+        for best, new_optics in app.optimize_optics(
+                settings, optics, target.waist[-1], target.z_origin[-1],
+                workers=1, seed=0):
+            pass
+        assert new_optics.record(1)['Position'] == pytest.approx(-150,
+                                                                 abs=1e-3)
+
+
+    def test_busy(self, monkeypatch):
+        pool = app.workers.Pool(max_workers=1, max_queue=0)
+        pool.executor()
+        pool.pending = 1
+        monkeypatch.setattr(app, 'compute_pool', pool)
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        body, result = app.update_optimize(
+            1, 5, 500, [], '', optics, json.dumps(test_settings))
+        assert body.children == app.exva.compute_busy_text
+        assert result is app.dash.no_update
+
+    @pytest.mark.parametrize('target_waist', [None, 0])
+    def test_bad_target(self, target_waist):
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        body, result = app.update_optimize(
+            1, target_waist, 500, [], '', optics, json.dumps(test_settings))
+        assert body.children == app.exva.optimize_bad_target
+        assert result == ''
+
+
+class TestCatalog:
+    @pytest.mark.parametrize('target_waist, target_z', [
+        (None, None), ('', 100), (0, None), (0.1, 'x')])
+    def test_bad_target(self, target_waist, target_z):
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        body, = app.update_designs(1, None, target_waist, target_z, optics,
+                                   json.dumps(test_settings))
+        assert body.children == app.exva.catalog_bad_target
+
+    def test_bad_diameter(self):
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        body, = app.update_matches(1, -1, optics, json.dumps(test_settings))
+        assert body.children == app.exva.catalog_bad_diameter
+
+
+class TestPreview:
+    def test_figure_payload(self):
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        settings = dict(test_settings, wavelength=800, drag=1)
+        payload = json.loads(app.update_figure(optics.encode(),
+                                               json.dumps(settings))[0])
+        preview = payload['preview']
+        assert preview['optics']['positions'] == [-1000, -250]
+        assert preview['annotated'] == [1]
+        assert preview['wavelength'] == pytest.approx(800e-6)
+        assert len(payload['figure']['data']) == 2
+        # The second trace is left to the browser
+        assert 'y' not in payload['figure']['data'][1]
+        assert len(payload['traces']['x']) == len(payload['traces']['y'])
+
+    def test_figure_unchanged(self):
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        settings = json.dumps(dict(test_settings, wavelength=800))
+        key = app.update_figure(optics, settings)[-1]
+        with pytest.raises(app.PreventUpdate):
+            app.update_figure(optics, settings, None, key)
+
+    def test_busy(self, monkeypatch):
+        pool = app.workers.Pool(max_workers=1, max_queue=0)
+        pool.executor()
+        pool.pending = 1
+        monkeypatch.setattr(app, 'compute_pool', pool)
+        monkeypatch.setattr(app, 'use_cache', False)
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        outputs = app.update_figure(optics, json.dumps(test_settings))
+        assert outputs[:5] == [app.dash.no_update] * 5
+        assert outputs[5] == app.exva.compute_busy_text
+        # Not marked as shown, so it's tried again
+        assert outputs[6] is app.dash.no_update
+
+    def test_compressed(self):
+        client = app.create_app().server.test_client()
+        answer = client.post('/api/beam', json={'settings': test_settings,
+                                                'optics': simple_optics},
+                             headers={'Accept-Encoding': 'gzip'})
+        assert answer.headers['Content-Encoding'] == 'gzip'
+
+    def test_drag_commit(self):
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        commit = json.dumps({'element': 1, 'position': -100, 'count': 1})
+        store, *clicks, drag_count = app.move_lenses(
+            None, None, None, None, 0, 0, 0, commit, None, None,
+            optics.encode(), '0', '0', '0', '0', '', '1',
+            json.dumps(test_settings), '')
+        assert app.OpticalSystem.decode(store).record(1)['Position'] == -100
+        assert drag_count == '1'
+
+
+class TestCoalesce:
+    def test_stale_update(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(app, 'tickets', app.coalesce.Tickets(
+            str(tmp_path / 'tickets.sqlite')))
+        ticket = app.take_ticket('session', 'figure')
+        app.check_latest('session', 'figure', ticket)
+        app.tickets.take('session', 'figure')
+        with pytest.raises(app.PreventUpdate):
+            app.check_latest('session', 'figure', ticket)
+
+
+class TestReport:
+    def test_other_tab(self):
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        with pytest.raises(app.PreventUpdate):
+            app.update_report('tab-1', optics.encode(),
+                              json.dumps(test_settings))
+
+    def test_table(self):
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        settings = dict(test_settings, wavelength=800)
+        segments = physics.calc_segments(settings, optics)
+        minspot_text, table, report_text = app.calc_report(settings, optics,
+                                                           segments)
+        assert '| 1 | lens | -250 | 250 |' in table
+        assert report_text.startswith('###### Element 0: the origin')
+
+    def test_table_digits(self):
+        assert app.table_row(1, 1, 123.456789, 1000.0001) == (
+            '| 1 | lens | 123.456789 | 1000.0001 |\n')
+
+    def test_rows_reused(self):
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        settings = dict(test_settings, wavelength=800)
+        app.calc_report(settings, optics,
+                        physics.calc_segments(settings, optics))
+        optics.insert(2, 500, 1, 100)
+        hits = app.element_report.cache_info().hits
+        app.calc_report(settings, optics,
+                        physics.calc_segments(settings, optics))
+        assert app.element_report.cache_info().hits == hits + 2
+
+    def test_chromatic(self):
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        settings = dict(test_settings, wavelength=800,
+                        wavelengths='700:900:11', glass='N-BK7')
+        text = app.calc_chromatic_report(settings, optics)
+        assert text.startswith('###### Chromatic focal shift, 700 to 900')
+        assert '| 1 | 248.885 to 250.874 |' in text
+        assert app.calc_chromatic_report(test_settings, optics) == ''
+
+
+class TestSpectrum:
+    def test_figure(self):
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        settings = dict(test_settings, wavelengths='700:900:101',
+                        glass='N-BK7')
+        for spectrum, traces in (('envelope', 4), ('lines', 14)):
+            payload = json.loads(app.update_figure(optics, json.dumps(dict(
+                settings, spectrum=spectrum)))[0])
+            data = payload['figure']['data']
+            assert len(data) == 2 + traces
+            assert all('x' not in trace and 'y' in trace
+                       for trace in data[2:])
+
+    @pytest.mark.parametrize('points, expected', [
+        (None, app.exva.default_plot_points), (1, 3), (500, 500)])
+    def test_plot_points(self, points, expected):
+        outputs = app.update_settings(
+            1, '1', '1', 800, 5, -1000, 2000, 0.05, points, [])
+        assert json.loads(outputs[0])['plot_points'] == expected
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        settings = dict(test_settings, plot_points=points)
+        payload = json.loads(app.update_figure(optics,
+                                               json.dumps(settings))[0])
+        assert 3 <= len(payload['traces']['x']) <= max(expected, 4)
+
+    def test_bad_settings(self):
+        outputs = app.update_settings(
+            1, '1', '1', 800, 5, -1000, 2000, 0.05, 2000, [], '700:900',
+            'N-BK7', 'envelope')
+        assert outputs[0] is app.dash.no_update
+        assert 'wavelengths' in outputs[1]
+
+
+class TestLongGrid:
+    def test_figure(self, monkeypatch):
+        # Over the limit the figure is made in blocks, and looks the same
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        settings = json.dumps(dict(test_settings, z_step=0.04))
+        whole = json.loads(app.update_figure(optics, settings)[0])
+        monkeypatch.setattr(app.exva, 'max_grid_points', 10000)
+        monkeypatch.setattr(app, 'use_cache', False)
+        w_z, show_lenses, segments = app.calc_results(
+            json.loads(settings), app.OpticalSystem.decode(optics))
+        assert w_z is None
+        blocks = json.loads(app.update_figure(optics, settings)[0])
+        assert blocks['traces'] == whole['traces']
+
+    def test_api_skips_trace(self, monkeypatch):
+        # The API only needs the segments, never the whole w(z)
+        def no_trace(*args):
+            raise AssertionError('traced')
+        monkeypatch.setattr(app, 'calc_trace', no_trace)
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        result = app.beam_result(test_settings, optics)
+        assert result['focus'] == app.calc_focus(
+            test_settings, app.calc_segments(test_settings, optics))
+        assert 'report' in result
+
+
+class TestTolerance:
+    def test_run(self, monkeypatch):
+        monkeypatch.setattr(app, 'run_store', sessions.MemoryStore())
+        monkeypatch.setattr(app.exva, 'tolerance_workers', 1)
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        assert app.poll_tolerance('run', 0)[2] is False
+        app.run_tolerance('run', dict(test_settings, wavelength=800),
+                          optics, 1000, 0.5, 0.01, 'normal')
+        body, figure, finished = app.poll_tolerance('run', 1)
+        assert finished
+        assert '**1,000 of 1,000 samples**' in body.children
+        assert len(figure.data) == 2
+
+    def test_own_pool(self, monkeypatch):
+        # A long analysis doesn't hold up the figures, and only so many run
+        release = threading.Event()
+        monkeypatch.setattr(app, 'run_tolerance',
+                            lambda *args: release.wait(5))
+        monkeypatch.setattr(app, 'tolerance_pool',
+                            app.workers.Pool(max_workers=1, max_queue=0))
+        optics = app.OpticalSystem.from_csv(simple_optics).encode()
+        settings = json.dumps(test_settings)
+        try:
+            run, status = app.start_tolerance(1, 0.5, 1, 'normal', 100,
+                                              optics, settings)
+            assert status == ''
+            assert app.compute_pool.pending == 0
+            run, status = app.start_tolerance(1, 0.5, 1, 'normal', 100,
+                                              optics, settings)
+            assert status == app.exva.compute_busy_text
+        finally:
+            release.set()
+
+    def test_bad_samples(self):
+        run, status = app.start_tolerance(1, 0.5, 1, 'normal', 0, '', '')
+        assert run is app.dash.no_update
+        assert status == app.exva.tolerance_bad_samples.format(
+            app.exva.tolerance_max_samples)
+
+
+class TestMetrics:
+    def test_endpoint(self):
+        client = app.create_app().server.test_client()
+        client.post('/api/beam', json={'settings': test_settings,
+                                       'optics': simple_optics})
+        app.calc_gaussian(dict(test_settings),
+                          app.OpticalSystem.from_csv(simple_optics))
+        text = client.get('/metrics').data.decode()
+        assert 'requests_total{path="/api/beam",status="200"}' in text
+        assert 'stage_seconds_count{stage="calc_gaussian"}' in text
+
+    def test_profiler_not_allowed(self):
+        client = app.create_app().server.test_client()
+        answer = client.post('/metrics/profile?action=start')
+        assert answer.status_code == 403
+
+
+class TestFactory:
+    def test_callbacks(self):
+        dash_app = app.create_app()
+        # The clientside preview as well
+        assert len(dash_app.callback_map) == len(app.callbacks) + 1
+        client = dash_app.server.test_client()
+        assert client.get('/').status_code == 200
+
+    def test_deferred_imports(self):
+        code = ('import sys, app; print(sorted(name for name in '
+                'app.preload_modules if name in sys.modules))')
+        result = subprocess.run([sys.executable, '-c', code],
+                                capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == '[]'
+
+    def test_initial_optics(self):
+        optics = app.initial_optics()
+        assert optics['Element'].tolist() == list(range(len(optics)))
+        assert optics['Type'][0] == 0
+        assert optics['Position'][0] == float(
+            app.read_default_settings()['z_min'])
+        assert np.all(np.diff(optics['Position']) >= 0)
+
+
+class TestSessions:
+    def edit(self, optics, position, session, make=0):
+        store, *rest = app.move_lenses(
+            1, None, None, None, 0, 0, 0, '', position, 250.,
+            optics.encode(), '0', str(make), '0', '0', '', '1',
+            json.dumps(test_settings), '', session)
+        return app.OpticalSystem.decode(store)
+
+    def test_new_element_id(self):
+        optics = app.OpticalSystem.from_csv(
+            'Element,Position,Type,FocalLength\n'
+            '0,-1000,0,0\n5,-250,1,250\n7,100,1,50\n')
+        made = self.edit(optics, None, None, make=1)
+        assert made['Element'].tolist() == [0, 5, 7, 8]
+
+    def test_edits_not_lost(self, monkeypatch):
+        monkeypatch.setattr(app, 'session_store', sessions.MemoryStore())
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        self.edit(optics, -100., 'abc')
+        # The page sent the optics from before the first edit again
+        optics.insert(2, 500, 1, 100)
+        second = self.edit(optics, -50., 'abc')
+        assert second['Position'].tolist() == [-1000, -50]
+        assert app.session_store.get('abc', 'optics') == second.encode()
+
+    def test_stored_settings(self, monkeypatch):
+        monkeypatch.setattr(app, 'session_store', sessions.MemoryStore())
+        app.session_store.put('abc', 'settings', json.dumps(dict(
+            test_settings, reset_index=1)))
+        optics = app.OpticalSystem.from_csv(simple_optics)
+        store, *rest = app.move_lenses(
+            None, None, None, None, 1, 0, 0, '', None, None, optics.encode(),
+            '0', '0', '0', '0', 'Element,Position,Type,FocalLength\n'
+            '0,-1000,0,0\n5,-250,1,250\n', '1',
+            json.dumps(dict(test_settings, reset_index=0)), '', 'abc')
+        assert app.OpticalSystem.decode(store)['Element'].tolist() == [0, 1]
@@ -0,0 +1,58 @@
+import csv
+import json
+import numpy as np
+import batch
+import physics
+from optical_system import OpticalSystem
+
+simple_optics = '''Element,Position,Type,FocalLength
+0,-1000,0,0
+1,-250,1,250
+'''
+
+settings = {"wavelength": 800, "waist": 5, "z_min": -1000, "z_max": 1000,
+            "z_step": 1}
+
+
+def write_systems(tmp_path):
+    (tmp_path / 'a.csv').write_text(simple_optics)
+    (tmp_path / 'b.csv').write_text(simple_optics.replace('250\n', '100\n'))
+    (tmp_path / 'settings.json').write_text(json.dumps(settings))
+
+
+class TestBatch:
+    def test_summary(self, tmp_path):
+        write_systems(tmp_path)
+        output = tmp_path / 'summary.csv'
+        curves = tmp_path / 'curves.npy'
+        status = batch.main([str(tmp_path), '-s',
+                             str(tmp_path / 'settings.json'), '-o',
+                             str(output), '-c', str(curves), '-j', '2'])
+        assert status == 0
+        rows = list(csv.DictReader(output.open()))
+        assert len(rows) == 4
+        assert sorted(row['Row'] for row in rows) == ['0', '0', '1', '1']
+        lens = [row for row in rows
+                if row['Row'] == '0' and row['Element'] == '1'][0]
+        segments = physics.calc_segments(
+            dict(settings), OpticalSystem.from_csv(simple_optics))
+        assert float(lens['FocusZ']) == segments.z_origin[-1]
+        w = np.load(curves)
+        assert w.shape == (3, 2000)
+        assert np.all(w[1:] > 0)
+
+    def test_bad_file(self, tmp_path):
+        write_systems(tmp_path)
+        (tmp_path / 'c.csv').write_text('Element,Position\n0,1\n')
+        status = batch.main([str(tmp_path / '*.csv'), '-s',
+                             str(tmp_path / 'settings.json'), '-o',
+                             str(tmp_path / 'summary.csv'), '-j', '1'])
+        assert status == 1
+
+    def test_no_origin(self, tmp_path):
+        # Read like systems sent to the API
+        path = tmp_path / 'lens.csv'
+        path.write_text(simple_optics.replace('0,-1000,0,0', '0,-1000,1,50'))
+        results = batch.evaluate_files([(0, str(path))], settings)
+        assert results[0][1] is None
+        assert 'origin' in results[0][2]
@@ -0,0 +1,212 @@
+import pytest
+import numpy as np
+import beam
+
+wavelength = 800e-6
+waist = 5
+rayleigh = waist ** 2 * np.pi / wavelength
+
+
+class TestPropagate:
+    def test_free_space(self):
+        segments = beam.propagate([0], [0], [0], waist, wavelength)
+        w_z = beam.beam_width(np.array([0, rayleigh]), segments)
+        assert w_z[0] == pytest.approx(waist)
+        assert w_z[1] == pytest.approx(np.sqrt(2) * waist)
+
+    def test_single_lens(self):
+        # Same numbers as the scalar formulas used before the ABCD engine
+        f = 250
+        z_temp = 750
+        r = rayleigh / (z_temp - f)
+        M = np.abs(f / (z_temp - f)) / np.sqrt(1 + r ** 2)
+        segments = beam.propagate([-1000, -250], [0, 1], [0, f], waist,
+                                  wavelength)
+        assert segments.waist[1] == pytest.approx(M * waist)
+        assert segments.rayleigh[1] == pytest.approx(M ** 2 * rayleigh)
+        assert segments.z_origin[1] == pytest.approx(
+            M ** 2 * (z_temp - f) + f - 250)
+
+    def test_unknown_type(self):
+        with pytest.raises(ValueError):
+            beam.propagate([0, 10], [0, 2], [0, 10], waist, wavelength)
+
+    def test_batch_matches_single(self):
+        positions = np.array([[0, 100, 300], [0, 150, 250]])
+        focals = np.array([[0, 100, -50], [0, 75, 200]])
+        batch = beam.propagate(positions, [0, 1, 1], focals, waist,
+                               wavelength)
+        for i in range(2):
+            single = beam.propagate(positions[i], [0, 1, 1], focals[i],
+                                    waist, wavelength)
+            assert batch.z_origin[i] == pytest.approx(single.z_origin)
+            assert batch.waist[i] == pytest.approx(single.waist)
+
+    def test_widths_match_single(self):
+        focals = np.array([[0, 100, -50], [0, 75, 200]])
+        wavelengths = np.array([500e-6, 1000e-6])
+        batch = beam.propagate([0, 100, 300], [0, 1, 1], focals, waist,
+                               wavelengths)
+        z = np.linspace(-50, 500, 101)
+        widths = beam.beam_widths(z, batch)
+        assert widths.shape == (2, 101)
+        for i in range(2):
+            single = beam.propagate([0, 100, 300], [0, 1, 1], focals[i],
+                                    waist, wavelengths[i])
+            assert widths[i] == pytest.approx(beam.beam_width(z, single))
+
+    def test_many_elements(self):
+        # A chain of 4f relays gives back the input beam
+        n = 64
+        positions = np.concatenate([[0], 100 + 200 * np.arange(n)])
+        types = np.concatenate([[0], np.ones(n, dtype=int)])
+        focals = np.concatenate([[0], np.full(n, 100.)])
+        segments = beam.propagate(positions, types, focals, 0.1, wavelength)
+        assert segments.waist[-1] == pytest.approx(0.1, rel=1e-6)
+        assert segments.z_origin[-1] == pytest.approx(positions[-1] + 100)
+
+
+class TestMinSpot:
+    def test_waist_inside_range(self):
+        segments = beam.propagate([-1000, -250], [0, 1], [0, 250], waist,
+                                  wavelength)
+        focus = beam.min_spot(segments, -1000, 2000)
+        assert focus.segment == 1
+        assert focus.z == pytest.approx(segments.z_origin[1])
+        assert focus.width == pytest.approx(segments.waist[1])
+
+    def test_waist_outside_range(self):
+        # Focus lies past z_max, so the smallest spot is at the edge
+        segments = beam.propagate([-1000, -250], [0, 1], [0, 250], waist,
+                                  wavelength)
+        focus = beam.min_spot(segments, -1000, -100)
+        assert focus.z == -100
+        assert focus.width == pytest.approx(
+            beam.beam_width(np.array([-100.]), segments)[0])
+
+    def test_matches_fine_grid(self):
+        segments = beam.propagate([0, 100, 160, 400], [0, 1, 1, 1],
+                                  [0, 80, -40, 150], 1, wavelength)
+        z_grid = np.linspace(0, 1000, 2000001)
+        w_z = beam.beam_width(z_grid, segments)
+        focus = beam.min_spot(segments, 0, 1000)
+        assert focus.width <= w_z.min()
+        assert focus.width == pytest.approx(w_z.min(), rel=1e-6)
+        assert focus.z == pytest.approx(z_grid[np.argmin(w_z)], abs=1e-3)
+
+
+class TestSweep:
+    def test_matches_propagate(self):
+        rng = np.random.default_rng(1)
+        positions = rng.uniform(0, 300, (50, 3))
+        focals = np.array([50., -30., 120.])
+        result = beam.sweep(positions, focals, waist, wavelength, -500)
+        for i in [0, 17, 49]:
+            order = np.argsort(positions[i])
+            single = beam.propagate(np.r_[-500, positions[i][order]],
+                                    [0, 1, 1, 1], np.r_[0, focals[order]],
+                                    waist, wavelength)
+            assert result.waist[i] == pytest.approx(single.waist[-1])
+            assert result.z_origin[i] == pytest.approx(single.z_origin[-1])
+            assert result.rayleigh[i] == pytest.approx(single.rayleigh[-1])
+
+    def test_broadcast_shape(self):
+        separations = np.linspace(90, 110, 21)
+        wavelengths = np.array([400e-6, 800e-6])[:, np.newaxis]
+        positions = np.stack([np.zeros(21), separations], -1)
+        result = beam.sweep(positions, [50, 50], 1, wavelengths, -200)
+        assert result.waist.shape == (2, 21)
+
+    def test_chunks_agree(self):
+        positions = np.stack([np.zeros(100), np.linspace(50, 150, 100)], -1)
+        whole = beam.sweep(positions, [50, 50], 1, wavelength, -200)
+        chunked = beam.sweep(positions, [50, 50], 1, wavelength, -200,
+                             chunk_size=7)
+        assert chunked.z_origin == pytest.approx(whole.z_origin)
+
+
+class TestRetrace:
+    grid = (-1000., 2000., 0.5)
+    positions = np.array([-1000., -250., -200., 10., 78.])
+    types = np.array([0, 1, 1, 1, 1])
+    focals = np.array([0., 75., -25., -100., 150.])
+
+    def check(self, old, positions, types, focals):
+        new = beam.retrace(old, self.grid, positions, types, focals, waist,
+                           wavelength)
+        full = beam.make_trace(self.grid, positions, types, focals, waist,
+                               wavelength)
+        assert new.w_z == pytest.approx(full.w_z, rel=1e-12)
+        assert new.segments.z_origin == pytest.approx(full.segments.z_origin)
+        return new
+
+    def old(self):
+        return beam.make_trace(self.grid, self.positions, self.types,
+                               self.focals, waist, wavelength)
+
+    def test_move_last(self):
+        old = self.old()
+        w_z = old.w_z.copy()
+        self.check(old, self.positions + [0, 0, 0, 0, 40], self.types,
+                   self.focals)
+        assert np.all(old.w_z == w_z)
+
+    def test_move_past_neighbour(self):
+        self.check(self.old(), [-1000., -250., 20., 10., 78.], self.types,
+                   self.focals)
+
+    def test_focal_length(self):
+        self.check(self.old(), self.positions, self.types,
+                   self.focals + [0, 0, 5, 0, 0])
+
+    def test_remove_and_add(self):
+        self.check(self.old(), self.positions[:-1], self.types[:-1],
+                   self.focals[:-1])
+        self.check(self.old(), np.r_[self.positions, 500],
+                   np.r_[self.types, 1], np.r_[self.focals, 80])
+
+    def test_unchanged(self):
+        old = self.old()
+        assert beam.retrace(old, self.grid, self.positions, self.types,
+                            self.focals, waist, wavelength) is old
+
+    def test_other_grid(self):
+        old = self.old()
+        new = beam.retrace(old, (-1000., 2000., 1.), self.positions,
+                           self.types, self.focals, waist, wavelength)
+        assert len(new.w_z) == 3000
+
+
+class TestBlocks:
+    grid = beam.Grid(-1000., 2000., 0.05)
+    segments = beam.propagate([-1000, -250, -200, 10, 78], [0, 1, 1, 1, 1],
+                              [0, 75, -25, -100, 150], waist, wavelength)
+
+    def test_widths(self):
+        blocks = list(beam.width_blocks(self.grid, self.segments, 7777))
+        assert [start for start, z, w in blocks] == list(range(0, 60000,
+                                                               7777))
+        z_grid = beam.make_grid(*self.grid)
+        assert len(z_grid) == beam.grid_size(self.grid) == 60000
+        assert np.concatenate([z for start, z, w in blocks]) == \
+            pytest.approx(z_grid, rel=0, abs=1e-9)
+        assert np.array_equal(np.concatenate([w for start, z, w in blocks]),
+                              beam.beam_width(z_grid, self.segments))
+
+    def test_float32(self):
+        w = np.concatenate([w for start, z, w in beam.width_blocks(
+            self.grid, self.segments, dtype=np.float32)])
+        assert w.dtype == np.float32
+        assert w == pytest.approx(beam.beam_width(beam.make_grid(*self.grid),
+                                                  self.segments), rel=1e-6)
+
+    def test_extrema(self):
+        z_grid = beam.make_grid(*self.grid)
+        w_z = beam.beam_width(z_grid, self.segments)
+        extrema = beam.grid_extrema(self.grid, self.segments, 5000)
+        assert extrema.width == w_z.min()
+        assert extrema.z == z_grid[np.argmin(w_z)]
+        index = beam.segment_index(z_grid, self.segments)
+        for segment in range(len(self.segments.start)):
+            assert extrema.segment_min[segment] == w_z[index == segment].min()
+            assert extrema.segment_max[segment] == w_z[index == segment].max()
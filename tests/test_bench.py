@@ -0,0 +1,49 @@
+import json
+import app
+import bench
+
+
+def run(median, name='fast'):
+    return {'results': {name: {'median': median, 'min': median,
+                               'repeat': 1}}}
+
+
+class TestBench:
+    def test_measure(self):
+        calls = []
+        benchmark = bench.Benchmark('noop', lambda: calls.append(1),
+                                    None, 3)
+        samples = bench.measure(benchmark, 4)
+        assert len(samples) == 4
+        assert len(calls) == 12
+
+    def test_baseline(self):
+        runs = [run(1.), run(100.), run(2.), run(3.)]
+        assert bench.baseline(runs, 'fast') == 2.5
+        assert bench.baseline(runs, 'fast', depth=1) == 3.
+        assert bench.baseline(runs, 'slow') is None
+
+    def test_regressions(self):
+        runs = [run(1.)]
+        assert bench.regressions(run(1.1)['results'], runs, 0.2) == {}
+        assert bench.regressions(run(1.3)['results'], runs,
+                                 0.2) == {'fast': (1.3, 1.)}
+
+    def test_history(self, tmp_path):
+        history = tmp_path / 'history.jsonl'
+        history.write_text(json.dumps(run(1e-12, 'codec round trip[n=50]')) +
+                           '\n')
+        status = bench.main(['--quick', '-k', 'codec', '-r', '2',
+                             '--history', str(history)])
+        assert status == 1
+        runs = bench.read_history(str(history))
+        assert len(runs) == 2
+        assert 'codec round trip[n=50]' in runs[1]['results']
+
+    def test_scratch_cache(self):
+        use_before, cache_before = app.use_cache, app.result_cache
+        with bench.scratch_cache():
+            app.use_cache = not use_before
+            assert app.result_cache is not cache_before
+        assert app.use_cache is use_before
+        assert app.result_cache is cache_before
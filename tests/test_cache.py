@@ -0,0 +1,77 @@
+import pytest
+import numpy as np
+import cache
+
+settings = {"x_scale": "1", "y_scale": "1", "wavelength": 800, "waist": 5,
+            "z_min": -1000, "z_max": 2000, "z_step": 0.05}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return cache.SharedCache(str(tmp_path / 'cache.sqlite'), 3000)
+
+
+class TestKeys:
+    def test_scales_ignored(self):
+        key = cache.physics_key(settings, [0, 10], [0, 1], [0, 5])
+        other = dict(settings, x_scale='1000', y_scale='0.001')
+        assert cache.physics_key(other, [0, 10], [0, 1], [0, 5]) == key
+
+    def test_physics_counts(self):
+        key = cache.physics_key(settings, [0, 10], [0, 1], [0, 5])
+        other = dict(settings, wavelength='400')
+        assert cache.physics_key(other, [0, 10], [0, 1], [0, 5]) != key
+        assert cache.physics_key(settings, [0, 11], [0, 1], [0, 5]) != key
+
+    def test_versioned(self, monkeypatch):
+        key = cache.make_key('figure', settings)
+        monkeypatch.setattr(cache, 'key_version', cache.key_version + 1)
+        assert cache.make_key('figure', settings) != key
+
+
+class TestPack:
+    def test_round_trip(self):
+        arrays = {'w_z': np.linspace(0, 1, 7), 'index': np.arange(3)}
+        blob = cache.pack(arrays, {'report_text': 'hello'})
+        unpacked, meta = cache.unpack(blob)
+        assert meta == {'report_text': 'hello'}
+        assert np.all(unpacked['w_z'] == arrays['w_z'])
+        assert unpacked['index'].dtype == arrays['index'].dtype
+
+
+class TestSharedCache:
+    def test_hits_and_misses(self, store):
+        assert store.get('a') is None
+        store.put('a', b'value')
+        assert store.get('a') == b'value'
+        stats = store.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+
+    def test_lru_eviction(self, store):
+        store.put('a', b'x' * 1000)
+        store.put('b', b'x' * 1000)
+        store.get('a')
+        store.put('c', b'x' * 1500)
+        assert store.get('b') is None
+        assert store.get('a') is not None
+        assert store.stats()['bytes'] <= 3000
+
+    def test_oversized_refused(self, store):
+        store.put('a', b'x' * 1000)
+        store.put('big', b'x' * 4000)
+        assert store.get('big') is None
+        assert store.get('a') is not None
+
+    def test_shrunk_limit(self, store):
+        store.put('a', b'x' * 1000)
+        store.put('b', b'x' * 1000)
+        store.max_bytes = 500
+        store.put('c', b'x' * 400)
+        assert store.get('c') is not None
+        assert store.stats()['bytes'] == 400
+
+    def test_shared_between_instances(self, store):
+        store.put('a', b'value')
+        other = cache.SharedCache(store.path, store.max_bytes)
+        assert other.get('a') == b'value'
@@ -0,0 +1,79 @@
+import pytest
+import numpy as np
+import beam
+import catalog
+
+wavelength = 800e-6
+
+
+@pytest.fixture
+def stock():
+    rng = np.random.default_rng(0)
+    parts = np.empty(5000, dtype=catalog.part_dtype)
+    parts['Vendor'] = 'Test'
+    parts['Part'] = ['P{}'.format(i) for i in range(len(parts))]
+    focal = np.round(rng.uniform(-500, 500, len(parts)))
+    parts['FocalLength'] = np.where(focal == 0, 1, focal)
+    parts['Diameter'] = rng.choice([12.7, 25.4], len(parts))
+    parts['CoatingMin'] = rng.choice([350, 650], len(parts))
+    parts['CoatingMax'] = parts['CoatingMin'] + 400
+    return catalog.make_catalog(parts)
+
+
+def brute_nearest(stock, focal_length, count, diameter, wavelength):
+    ok = np.flatnonzero(catalog.fits(stock.parts, diameter, wavelength))
+    distance = np.abs(stock.parts['FocalLength'][ok] - focal_length)
+    return np.sort(distance[np.argsort(distance)][:count])
+
+
+class TestLookup:
+    def test_load(self):
+        stock = catalog.load_catalogs(['assets/lens_catalog.csv'])
+        assert np.all(np.diff(stock.parts['FocalLength']) >= 0)
+
+    @pytest.mark.parametrize('focal', [-499.5, -37.2, 0, 123.4, 600])
+    def test_nearest(self, stock, focal):
+        found = catalog.nearest(stock, focal, 5, 20, 800)
+        distance = np.sort(np.abs(stock.parts['FocalLength'][found] - focal))
+        assert distance == pytest.approx(
+            brute_nearest(stock, focal, 5, 20, 800))
+        assert np.all(stock.parts['Diameter'][found] >= 20)
+
+    def test_ranges(self, stock):
+        found = catalog.focal_range(stock, 100, 200)
+        focal = stock.parts['FocalLength']
+        assert len(found) == np.count_nonzero((focal >= 100) & (focal <= 200))
+
+    @pytest.mark.parametrize('focal, diameter, wavelength', [
+        (-37.2, None, None), (123.4, 20, None), (600, None, 500),
+        (0, 20, 1000)])
+    def test_candidate_focals(self, stock, focal, diameter, wavelength):
+        ok = catalog.fits(stock.parts, diameter, wavelength)
+        available = np.unique(stock.parts['FocalLength'][ok])
+        found = catalog.candidate_focals(stock, focal, 8, diameter,
+                                         wavelength)
+        assert len(found) == 8
+        assert np.all(np.isin(found, available))
+        assert np.sort(np.abs(found - focal)) == pytest.approx(
+            np.sort(np.abs(available - focal))[:8])
+
+    def test_spread_focals(self, stock):
+        found = catalog.candidate_focals(stock, count=5, diameter=20)
+        assert len(found) == 5
+        assert found[0] == stock.parts['FocalLength'][
+            catalog.fits(stock.parts, 20)].min()
+        assert np.all(np.isin(found, stock.parts['FocalLength']))
+
+
+class TestDesigns:
+    def test_finds_exact_design(self, stock):
+        focals = stock.parts['FocalLength'][[100, 2600, 4000]]
+        positions = [-900., -600., -100.]
+        target = beam.sweep(positions, focals, 5, wavelength, -1000)
+        designs = catalog.search_designs(stock, positions, 5, wavelength,
+                                         target.waist, z_waist=-1000,
+                                         target_z=target.z_origin,
+                                         focal_lengths=focals + [3, -2, 5])
+        assert designs[0].focal_lengths == pytest.approx(focals)
+        assert designs[0].error == pytest.approx(0, abs=1e-9)
+        assert designs[0].error <= designs[-1].error
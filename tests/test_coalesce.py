@@ -0,0 +1,35 @@
+import pytest
+import coalesce
+
+
+@pytest.fixture
+def tickets(tmp_path):
+    return coalesce.Tickets(str(tmp_path / 'tickets.sqlite'))
+
+
+class TestTickets:
+    def test_take(self, tickets):
+        assert tickets.take('a', 'figure') == 1
+        assert tickets.take('a', 'figure') == 2
+        assert tickets.latest('a', 'figure') == 2
+
+    def test_stale(self, tickets):
+        first = tickets.take('a', 'figure')
+        assert not tickets.is_stale('a', 'figure', first)
+        second = tickets.take('a', 'figure')
+        assert tickets.is_stale('a', 'figure', first)
+        assert not tickets.settle('a', 'figure', first, 0)
+        assert tickets.settle('a', 'figure', second, 0)
+
+    def test_independent(self, tickets):
+        first = tickets.take('a', 'figure')
+        tickets.take('b', 'figure')
+        tickets.take('a', 'sweep')
+        assert not tickets.is_stale('a', 'figure', first)
+
+    def test_forget(self, tmp_path):
+        tickets = coalesce.Tickets(str(tmp_path / 'tickets.sqlite'),
+                                   max_age=-1)
+        tickets.take('a', 'figure')
+        tickets.take('b', 'figure')
+        assert tickets.latest('a', 'figure') == 0
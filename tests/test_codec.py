@@ -0,0 +1,59 @@
+import pytest
+import numpy as np
+import pandas as pd
+import codec
+
+optics = pd.DataFrame({'Element': [0, 1, 2], 'Position': [-1000, -250, 0.5],
+                       'Type': [0, 1, 1], 'FocalLength': [0, 250, -33.3]})
+
+
+class TestOptics:
+    def test_round_trip(self):
+        records = codec.decode_optics(codec.encode_optics(optics))
+        for name in codec.optics_dtype.names:
+            assert np.all(records[name] == optics[name].to_numpy())
+
+    def test_versioned(self):
+        assert codec.encode_optics(optics).startswith('bpo2:')
+        old = codec.decode_optics(codec.encode_optics(optics, 1))
+        assert old.dtype == codec.optics_dtype
+        assert np.all(old['Element'] == optics['Element'].to_numpy())
+
+    def test_large_elements(self):
+        many = dict(optics, Element=[0, 40000, 2 ** 31 - 1])
+        records = codec.decode_optics(codec.encode_optics(many))
+        assert list(records['Element']) == [0, 40000, 2 ** 31 - 1]
+        with pytest.raises(ValueError):
+            codec.encode_optics(many, 1)
+
+    def test_writable(self):
+        records = codec.decode_optics(codec.encode_optics(optics))
+        records['Position'][1] = 12
+        assert records['Position'][1] == 12
+
+    def test_incompressible(self):
+        rng = np.random.default_rng(0)
+        many = {'Element': np.arange(50), 'Position': rng.random(50),
+                'Type': np.ones(50), 'FocalLength': rng.random(50)}
+        records = codec.decode_optics(codec.encode_optics(many))
+        assert np.all(records['FocalLength'] == many['FocalLength'])
+
+    @pytest.mark.parametrize('text', [optics.to_json(), 'bpo99:AAAA', ''])
+    def test_not_encoded(self, text):
+        with pytest.raises(ValueError):
+            codec.decode_optics(text)
+
+
+class TestTrace:
+    @pytest.mark.parametrize('encoding', codec.trace_encodings)
+    def test_round_trip(self, encoding):
+        values = np.random.default_rng(0).uniform(-3, 3, 500)
+        decoded = codec.decode_trace(codec.encode_trace(values, encoding))
+        assert decoded == pytest.approx(values, rel=1e-5)
+
+    def test_digits(self):
+        assert codec.encode_trace([1 / 3], 'json', 3) == [0.333]
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            codec.encode_trace([1.], 'f2')
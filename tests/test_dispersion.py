@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+import dispersion
+
+
+class TestDispersion:
+    def test_refractive_index(self):
+        # n_d of the glasses, at the helium d line
+        assert dispersion.refractive_index('N-BK7', 587.56) == pytest.approx(
+            1.5168, abs=1e-4)
+        assert dispersion.refractive_index('uvfs', 587.56) == pytest.approx(
+            1.4585, abs=1e-4)
+
+    def test_focal_lengths(self):
+        table = [(600, 99.), (1000, 101.)]
+        focals = dispersion.focal_lengths(
+            [0, 1, 2, 3], [0, 1, 1, 1], [0, 100, 200, -50], [600, 800, 1000],
+            800, {None: 'N-BK7', 2: table, 3: 'CaF2'})
+        assert focals.shape == (3, 4)
+        assert np.all(focals[:, 0] == 0)
+        assert focals[1] == pytest.approx([0, 100, 200, -50])
+        assert focals[:, 2] == pytest.approx([198, 200, 202])
+        # A negative lens gets weaker the same way
+        assert focals[0, 3] > -50 > focals[2, 3]
+
+    def test_parse(self):
+        assert dispersion.parse_glasses('N-BK7, 3: CaF2') == {
+            None: 'N-BK7', 3: 'CaF2'}
+        assert dispersion.parse_glasses('') == {}
+        with pytest.raises(ValueError):
+            dispersion.parse_glasses('unobtainium')
+        assert list(dispersion.parse_wavelengths('700:900:3')) == [
+            700, 800, 900]
+        assert list(dispersion.parse_wavelengths('820, 780')) == [780, 820]
+        assert len(dispersion.parse_wavelengths('')) == 0
+        with pytest.raises(ValueError):
+            dispersion.parse_wavelengths('700:900:3000', max_count=1000)
+        with pytest.raises(ValueError):
+            dispersion.parse_wavelengths('red')
@@ -0,0 +1,83 @@
+import json
+import time
+import pytest
+import metrics
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return metrics.Metrics(str(tmp_path / 'metrics.sqlite'))
+
+
+class TestMetrics:
+    def test_histogram(self, registry):
+        for value in (0.0001, 0.003, 100.):
+            registry.observe('stage_seconds', value, {'stage': 'a'})
+        text = registry.render()
+        assert '# TYPE beampage_stage_seconds histogram' in text
+        assert 'beampage_stage_seconds_bucket{stage="a",le="0.001"} 1' in text
+        assert 'beampage_stage_seconds_bucket{stage="a",le="10"} 2' in text
+        assert 'beampage_stage_seconds_bucket{stage="a",le="+Inf"} 3' in text
+        assert 'beampage_stage_seconds_count{stage="a"} 3' in text
+
+    def test_size_buckets(self, registry):
+        registry.observe('callback_response_bytes', 1000)
+        assert 'beampage_callback_response_bytes_bucket{le="1024"} 1' in \
+            registry.render()
+
+    def test_other_processes(self, registry):
+        registry.count('requests_total', {'path': '/'})
+        other = {'counters': {metrics.make_key('requests_total',
+                                               {'path': '/'}): 2},
+                 'histograms': {}}
+        registry.connection().execute(
+            'INSERT INTO process_snapshots VALUES (?, ?, ?)',
+            ('other', json.dumps(other), time.time()))
+        assert 'beampage_requests_total{path="/"} 3' in registry.render()
+
+    def test_old_processes(self, registry):
+        registry.count('requests_total', {'path': '/'})
+        other = {'counters': {metrics.make_key('requests_total',
+                                               {'path': '/'}): 2},
+                 'histograms': {}}
+        registry.connection().execute(
+            'INSERT INTO process_snapshots VALUES (?, ?, ?)',
+            ('dead', json.dumps(other), time.time() - 2 * registry.max_age))
+        assert 'beampage_requests_total{path="/"} 1' in registry.render()
+        registry.connection().execute(
+            'INSERT INTO process_snapshots VALUES (?, ?, ?)',
+            ('earlier', json.dumps(other), time.time()))
+        registry.forget_processes()
+        assert 'beampage_requests_total{path="/"} 1' in registry.render()
+
+    def test_instrument(self, registry):
+        registered = []
+
+        def register(*args):
+            return lambda func: registered.append(func) or func
+
+        notes = []
+
+        @metrics.instrument(register, registry, notes.append)()
+        def failing():
+            raise KeyError
+
+        with pytest.raises(KeyError):
+            failing()
+        assert notes == ['failing']
+        text = registry.render()
+        assert 'callbacks_total{callback="failing",status="KeyError"} 1' in \
+            text
+        assert 'callback_seconds_count{callback="failing"} 1' in text
+
+
+class TestProfiler:
+    def test_samples(self):
+        profiler = metrics.Profiler(interval=0.001)
+        profiler.start()
+        started = time.time()
+        while time.time() - started < 0.1:
+            sum(range(1000))
+        profiler.stop()
+        assert not profiler.running
+        assert 'test_samples' in profiler.collapsed()
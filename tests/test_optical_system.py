@@ -0,0 +1,53 @@
+import pytest
+import numpy as np
+import pandas as pd
+from optical_system import OpticalSystem
+
+optics = pd.DataFrame({'Element': [0, 1, 2], 'Position': [-1000, -250, 0.5],
+                       'Type': [0, 1, 1], 'FocalLength': [0, 250, -33.3]})
+
+
+class TestOpticalSystem:
+    def test_sorted(self):
+        system = OpticalSystem.coerce(optics.iloc[::-1])
+        assert list(system['Element']) == [0, 1, 2]
+
+    def test_insert(self):
+        system = OpticalSystem.coerce(optics)
+        system.insert(3, -500, 1, 100)
+        assert list(system['Element']) == [0, 3, 1, 2]
+        assert system.record(3)['FocalLength'] == 100
+
+    def test_move(self):
+        system = OpticalSystem.coerce(optics)
+        system.move(1, 10)
+        assert list(system['Element']) == [0, 2, 1]
+        assert system.row(1) == 2
+
+    def test_view(self):
+        system = OpticalSystem.coerce(optics)
+        system['Position'][0] = -2000
+        assert system.records['Position'][0] == -2000
+
+    def test_missing(self):
+        with pytest.raises(KeyError):
+            OpticalSystem.coerce(optics).row(7)
+
+    def test_bad_csv(self):
+        with pytest.raises(ValueError):
+            OpticalSystem.from_csv('Element,Position\n0,1\n')
+
+    def test_round_trip(self):
+        system = OpticalSystem.coerce(optics)
+        again = OpticalSystem.decode(system.encode())
+        assert np.all(again.records == system.records)
+        again = OpticalSystem.from_csv(system.to_csv())
+        assert np.all(again.records == system.records)
+
+    def test_large_elements(self):
+        text = 'Element,Position,Type,FocalLength\n0,0,0,0\n40000,5,1,50\n'
+        system = OpticalSystem.from_csv(text)
+        assert list(OpticalSystem.decode(system.encode())['Element']) == [
+            0, 40000]
+        with pytest.raises(ValueError):
+            OpticalSystem.from_csv(text.replace('40000', str(2 ** 32)))
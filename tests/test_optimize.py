@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import numpy as np
+import beam
+import optimize
+
+wavelength = 800e-6
+focal_lengths = np.array([100., -50., 200.])
+positions = np.array([-600., -400., 100.])
+
+
+@pytest.fixture
+def target():
+    return beam.sweep(positions, focal_lengths, 5, wavelength, -1000)
+
+
+def make(target, start, **kwargs):
+    return optimize.make_problem(start, focal_lengths, 5, wavelength,
+                                 target.waist, target.z_origin,
+                                 z_waist=-1000, bounds=(-1000, 300), **kwargs)
+
+
+class TestSolve:
+    def test_finds_target(self, target):
+        problem = make(target, positions + [50, -80, 60])
+        best = optimize.solve(problem, workers=1, seed=0, time_limit=5)
+        assert best.waist == pytest.approx(target.waist, rel=1e-4)
+        assert best.z_origin == pytest.approx(target.z_origin, abs=1e-3)
+
+    def test_improves_monotonically(self, target):
+        problem = make(target, positions + [50, -80, 60])
+        costs = [best.cost for best in optimize.solve_iter(
+            problem, workers=1, seed=0, time_limit=5)]
+        assert costs[0] > costs[-1]
+        assert np.all(np.diff(costs) < 0)
+
+    def test_fixed_lens(self, target):
+        problem = make(target, positions + [0, -80, 60], fixed=[0])
+        best = optimize.solve(problem, workers=1, seed=0, time_limit=5)
+        assert best.positions[0] == positions[0]
+
+    def test_focal_set(self, target):
+        stock = [-75, -50, 50, 100, 150, 200, 250]
+        problem = make(target, positions + [50, -80, 60], focal_set=stock)
+        best = optimize.solve(problem, workers=1, seed=0, time_limit=5)
+        assert np.isin(best.focal_lengths, stock).all()
+        assert best.cost < 1e-6
+
+    def test_process_pool(self, target):
+        problem = make(target, positions + [50, -80, 60])
+        best = optimize.solve(problem, workers=2, seed=0, time_limit=5)
+        assert best.cost < 1e-6
+
+    @pytest.mark.parametrize('waist, z', [(0, 100), (-1, 100),
+                                          (np.nan, 100), (1, np.inf)])
+    def test_bad_target(self, waist, z):
+        with pytest.raises(ValueError):
+            optimize.make_problem(positions, focal_lengths, 5, wavelength,
+                                  waist, z)
+
+    def test_shared_pool(self):
+        # Asked for from many threads at once, every size is made once
+        with ThreadPoolExecutor(8) as threads:
+            pools = list(threads.map(optimize.get_pool, [1, 2] * 8))
+        assert len({id(pool) for pool in pools[::2]}) == 1
+        assert len({id(pool) for pool in pools[1::2]}) == 1
+        assert pools[0] is not pools[1]
@@ -0,0 +1,56 @@
+import numpy as np
+import physics
+from optical_system import OpticalSystem
+
+simple_optics = '''Element,Position,Type,FocalLength
+0,-1000,0,0
+1,-250,1,250
+2,300,1,-100
+'''
+
+settings = {"wavelength": 800, "waist": 5, "z_min": -500, "z_max": 1000,
+            "z_step": 1}
+
+
+class TestPhysics:
+    def test_origin_at_z_min(self):
+        optics = OpticalSystem.from_csv(simple_optics)
+        segments = physics.calc_segments(settings, optics)
+        assert segments.start[0] == -500
+        assert optics.record(0)['Position'] == -1000
+
+    def test_lens_marks(self):
+        optics = OpticalSystem.from_csv(simple_optics)
+        segments = physics.calc_segments(settings, optics)
+        names, places = physics.lens_marks(optics, segments)
+        assert names == ['1', '2']
+        assert [place[0] for place in places] == [-250, 300]
+
+    def test_matches(self):
+        optics = OpticalSystem.from_csv(simple_optics)
+        matches = physics.match_stock_lenses(settings, optics,
+                                             physics.get_catalog(), count=2)
+        assert len(matches) == 4
+        assert all(len(row) == len(physics.match_columns)
+                   for row in matches)
+        assert np.all(np.array([row[0] for row in matches]) == [1, 1, 2, 2])
+
+    def test_designs_without_lenses(self):
+        optics = OpticalSystem.from_csv(simple_optics.split('1,-250')[0])
+        assert physics.search_stock_designs(
+            settings, optics, physics.get_catalog(), 1) == []
+
+    def test_spectrum(self):
+        optics = OpticalSystem.from_csv(simple_optics)
+        spectrum = physics.calc_spectrum(
+            dict(settings, wavelengths='700, 800, 900', glass='N-BK7'),
+            optics)
+        assert spectrum.segments.waist.shape == (3, 3)
+        # The table's focal lengths hold at the settings' wavelength
+        single = physics.calc_segments(settings, optics)
+        assert np.allclose(spectrum.focal_lengths[1], optics['FocalLength'])
+        assert np.allclose(spectrum.segments.z_origin[1], single.z_origin)
+        # Normal dispersion: longer focal lengths at longer wavelengths
+        assert spectrum.focal_lengths[2, 1] > 250 > spectrum.focal_lengths[
+            0, 1]
+        assert physics.calc_spectrum(settings, optics) is None
@@ -0,0 +1,90 @@
+import pytest
+import numpy as np
+import beam
+import sampling
+
+wavelength = 800e-6
+
+
+@pytest.fixture
+def segments():
+    return beam.propagate([-1000, -250, -200, 10, 78], [0, 1, 1, 1, 1],
+                          [0, 75, -25, -100, 150], 5, wavelength)
+
+
+class TestAdaptiveGrid:
+    def test_bounded(self, segments):
+        z_grid = sampling.adaptive_grid(segments, -1000, 2000, 500)
+        assert len(z_grid) <= 500 + len(segments.start)
+        assert z_grid[0] == -1000
+        assert z_grid[-1] == 2000
+
+    def test_contains_elements_and_waists(self, segments):
+        z_grid = sampling.adaptive_grid(segments, -1000, 2000, 500)
+        assert np.isin(segments.start[1:], z_grid).all()
+        assert segments.z_origin[4] in z_grid
+
+    def test_follows_curve(self, segments):
+        z_grid = sampling.adaptive_grid(segments, -1000, 2000, 2000)
+        z_fine = np.arange(-1000, 2000, 0.05)
+        w_fine = beam.beam_width(z_fine, segments)
+        w_interp = np.interp(z_fine, z_grid, beam.beam_width(z_grid, segments))
+        assert np.max(np.abs(w_interp - w_fine)) < 1e-3
+
+
+class TestDecimate:
+    @pytest.mark.parametrize('method', ['minmax', 'lttb'])
+    def test_budget(self, segments, method):
+        z_fine = np.arange(-1000, 2000, 0.05)
+        w_fine = beam.beam_width(z_fine, segments)
+        z_plot, w_plot = sampling.decimate(z_fine, w_fine, 1000, method)
+        assert len(z_plot) <= 1000
+        assert z_plot[0] == z_fine[0]
+        assert z_plot[-1] == z_fine[-1]
+        assert np.all(np.diff(z_plot) > 0)
+
+    def test_keeps_extrema(self, segments):
+        z_fine = np.arange(-1000, 2000, 0.05)
+        w_fine = beam.beam_width(z_fine, segments)
+        z_plot, w_plot = sampling.decimate(z_fine, w_fine, 1000)
+        assert w_plot.min() == w_fine.min()
+        assert w_plot.max() == w_fine.max()
+
+    @pytest.mark.parametrize('block_size', [777, 60000, 2 ** 16])
+    def test_blocks(self, segments, block_size):
+        grid = beam.Grid(-1000., 2000., 0.05)
+        z_fine = beam.make_grid(*grid)
+        w_fine = beam.beam_width(z_fine, segments)
+        z_plot, w_plot = sampling.decimate_blocks(
+            beam.width_blocks(grid, segments, block_size), len(z_fine), 1000)
+        z_whole, w_whole = sampling.decimate(z_fine, w_fine, 1000)
+        assert np.array_equal(z_plot, z_whole)
+        assert np.array_equal(w_plot, w_whole)
+
+    @pytest.mark.parametrize('num_points', [0, 2])
+    def test_tiny_budget(self, segments, num_points):
+        z_fine = np.arange(-1000, 2000, 0.05)
+        w_fine = beam.beam_width(z_fine, segments)
+        z_plot, w_plot = sampling.decimate(z_fine, w_fine, num_points)
+        assert 3 <= len(z_plot) <= 4
+        assert w_plot.min() == w_fine.min()
+
+    @pytest.mark.parametrize('num_points', [0, 2])
+    def test_tiny_block_budget(self, segments, num_points):
+        grid = beam.Grid(-1000., 2000., 0.05)
+        z_fine = beam.make_grid(*grid)
+        w_fine = beam.beam_width(z_fine, segments)
+        z_plot, w_plot = sampling.decimate_blocks(
+            beam.width_blocks(grid, segments, 4096), len(z_fine), num_points)
+        assert np.array_equal(
+            w_plot, sampling.decimate(z_fine, w_fine, num_points)[1])
+
+    def test_small_input_untouched(self):
+        x = np.arange(10.)
+        z_plot, w_plot = sampling.decimate(x, x, 100)
+        assert z_plot is x
+
+    def test_unknown_method(self):
+        x = np.arange(10.)
+        with pytest.raises(ValueError):
+            sampling.decimate(x, x, 5, method='fourier')
@@ -0,0 +1,74 @@
+import pytest
+import sessions
+
+
+class StandInRedis:
+    # The few hash commands RedisStore uses
+    def __init__(self):
+        self.hashes = {}
+        self.ttl = {}
+
+    def hget(self, key, name):
+        value = self.hashes.get(key, {}).get(name)
+        return(None if value is None else value.encode())
+
+    def hset(self, key, name, value):
+        self.hashes.setdefault(key, {})[name] = value
+
+    def expire(self, key, seconds):
+        self.ttl[key] = seconds
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return sessions.MemoryStore()
+    elif request.param == 'sqlite':
+        return sessions.SQLiteStore(str(tmp_path / 'sessions.sqlite'))
+    return sessions.RedisStore(StandInRedis())
+
+
+class TestStores:
+    def test_put_get(self, store):
+        state = sessions.Session(store, 'a')
+        assert state.get('optics') is None
+        assert state.get('optics', 'default') == 'default'
+        state.put('optics', 'bpo1:abc')
+        state.put('optics', 'bpo1:def')
+        assert state.get('optics') == 'bpo1:def'
+        assert sessions.Session(store, 'b').get('optics') is None
+
+    def test_forget(self, store):
+        state = sessions.Session(store, 'a')
+        state.put('settings', '{}')
+        state.forget()
+        assert state.get('settings') is None
+
+    def test_expiry(self, tmp_path):
+        for store in (sessions.MemoryStore(max_age=-1),
+                      sessions.SQLiteStore(str(tmp_path / 's.sqlite'),
+                                           max_age=-1)):
+            store.put('a', 'optics', 'x')
+            store.put('b', 'optics', 'y')
+            assert store.get('a', 'optics') is None
+
+    def test_redis_expire(self):
+        client = StandInRedis()
+        store = sessions.RedisStore(client, max_age=60)
+        store.put('a', 'optics', 'x')
+        assert client.ttl[store.prefix + 'a'] == 60
+
+
+class TestOpen:
+    def test_urls(self, tmp_path):
+        assert isinstance(sessions.open_store('memory://'),
+                          sessions.MemoryStore)
+        store = sessions.open_store('sqlite:///' + str(tmp_path / 's.sqlite'))
+        assert store.path == str(tmp_path / 's.sqlite')
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            sessions.open_store('ftp://somewhere')
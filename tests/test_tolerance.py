@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import tolerance
+
+problem = tolerance.make_problem([-250., 100.], [250., 50.], 5, 800e-6,
+                                 -1000., position_spread=0.5,
+                                 focal_spread=0.01)
+
+
+class TestTolerance:
+    def test_merge(self):
+        values = np.random.default_rng(0).normal(3, 2, 1000)
+        edges = np.linspace(-5, 11, 33)
+        whole = tolerance.make_stats(values, edges)
+        merged = tolerance.merge(tolerance.make_stats(values[:300], edges),
+                                 tolerance.make_stats(values[300:], edges))
+        assert merged.mean == pytest.approx(whole.mean)
+        assert tolerance.std(merged) == pytest.approx(values.std(ddof=1))
+        assert np.all(merged.counts == whole.counts)
+        assert merged.counts.sum() == 1000
+
+    def test_percentiles(self):
+        for done, stats in tolerance.analyze_iter(problem, 100000, workers=1,
+                                                  chunk_size=10000, seed=0):
+            pass
+        assert done == 100000
+        values = tolerance.evaluate(problem, np.random.default_rng(1),
+                                    100000)
+        for name in tolerance.quantities:
+            summary = tolerance.summarize(stats[name])
+            width = np.diff(summary['edges'][:2])[0]
+            assert summary['count'] == 100000
+            assert summary['percentiles'] == pytest.approx(
+                np.percentile(values[name], [5, 50, 95]), abs=2 * width)
+            assert summary['std'] == pytest.approx(values[name].std(),
+                                                   rel=0.05)
+
+    def test_streams(self):
+        dones = [done for done, stats in tolerance.analyze_iter(
+            problem, 25, workers=1, chunk_size=10, seed=0)]
+        assert dones == [10, 20, 25]
+
+    def test_uniform(self):
+        fixed = problem._replace(focal_spread=np.zeros(2),
+                                 distribution='uniform')
+        positions, focal_lengths = tolerance.draw(
+            fixed, np.random.default_rng(0), 1000)
+        assert np.all(np.abs(positions - fixed.positions) <= 0.5)
+        assert np.all(focal_lengths == fixed.focal_lengths)
+
+    def test_workers_agree(self):
+        results = []
+        for workers in (1, 2):
+            for done, stats in tolerance.analyze_iter(
+                    problem, 5000, workers=workers, chunk_size=1000, seed=0):
+                pass
+            results.append(stats['waist'])
+        assert results[0].mean == pytest.approx(results[1].mean)
+        assert np.all(results[0].counts == results[1].counts)
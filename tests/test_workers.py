@@ -0,0 +1,43 @@
+import threading
+import pytest
+import workers
+
+
+def wait(event):
+    event.wait(5)
+    return('done')
+
+
+class TestPool:
+    def test_run(self):
+        pool = workers.Pool(max_workers=2)
+        assert pool.run(sum, [1, 2, 3]) == 6
+        with pytest.raises(ZeroDivisionError):
+            pool.run(divmod, 1, 0)
+        pool.shutdown()
+        assert pool.pending == 0
+
+    def test_busy(self):
+        pool = workers.Pool(max_workers=1, max_queue=1)
+        event = threading.Event()
+        running = [pool.submit(wait, event) for job in range(2)]
+        with pytest.raises(workers.Busy):
+            pool.submit(wait, event)
+        event.set()
+        assert [future.result() for future in running] == ['done', 'done']
+        # Room again once they are done
+        assert pool.run(wait, event) == 'done'
+        pool.shutdown()
+
+    def test_timeout(self):
+        pool = workers.Pool(max_workers=1, timeout=0.01)
+        event = threading.Event()
+        with pytest.raises(workers.Timeout):
+            pool.run(wait, event)
+        event.set()
+        pool.shutdown()
+
+    def test_processes(self):
+        pool = workers.Pool(max_workers=1, kind='process')
+        assert pool.run(pow, 2, 10) == 1024
+        pool.shutdown()
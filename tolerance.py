@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Monte Carlo tolerance analysis of the lens positions and focal lengths.
+
+Every sample is the system with random errors added: the positions get
+position_spread (mm) times a random number, the focal lengths are scaled by
+1 + focal_spread times one. The random numbers are standard normal, or
+uniform on [-1, 1] for distribution='uniform'. The samples are drawn and
+evaluated with beam.sweep in chunks, spread over worker processes, and
+only statistics of the final waist and focus position are kept: count,
+mean and spread (merged as in Chan et al.), extremes and a histogram, so
+memory doesn't grow with the number of samples. The histogram bins are set
+from a first chunk; samples outside them are counted in an under- and an
+overflow bin, and percentiles are read off the histogram (so they are good
+to about a bin width).
+All lengths are in mm.
+"""
+
+from collections import namedtuple
+import concurrent.futures
+import os
+
+import numpy as np
+
+import beam
+import optimize
+
+# Picklable, like optimize.Problem. The spreads broadcast against the
+# lenses.
+Problem = namedtuple('Problem', [
+    'positions', 'focal_lengths', 'position_spread', 'focal_spread',
+    'distribution', 'waist', 'wavelength', 'z_waist'])
+
+# Running statistics of one quantity. counts has the underflow bin first
+# and the overflow bin last, around the bins between the edges.
+Stats = namedtuple('Stats', ['count', 'mean', 'm2', 'minimum', 'maximum',
+                             'edges', 'counts'])
+
+quantities = ('waist', 'z_origin')
+
+
+def make_problem(positions, focal_lengths, waist, wavelength, z_waist=0.,
+                 position_spread=0., focal_spread=0., distribution='normal'):
+    if distribution not in ('normal', 'uniform'):
+        raise ValueError('Unknown distribution ' + distribution)
+    positions = np.asarray(positions, dtype=float)
+    return(Problem(
+        positions=positions,
+        focal_lengths=np.asarray(focal_lengths, dtype=float),
+        position_spread=np.broadcast_to(
+            np.asarray(position_spread, dtype=float), positions.shape),
+        focal_spread=np.broadcast_to(
+            np.asarray(focal_spread, dtype=float), positions.shape),
+        distribution=distribution, waist=float(waist),
+        wavelength=float(wavelength), z_waist=float(z_waist)))
+
+
+def draw(problem, rng, size):
+    # size perturbed systems, positions and focal lengths of shape
+    # (size, lenses)
+    shape = (size, len(problem.positions))
+    if problem.distribution == 'uniform':
+        errors = rng.uniform(-1, 1, (2,) + shape)
+    else:
+        errors = rng.standard_normal((2,) + shape)
+    return(problem.positions + problem.position_spread * errors[0],
+           problem.focal_lengths * (1 + problem.focal_spread * errors[1]))
+
+
+def evaluate(problem, rng, size):
+    positions, focal_lengths = draw(problem, rng, size)
+    result = beam.sweep(positions, focal_lengths, problem.waist,
+                        problem.wavelength, problem.z_waist)
+    return({name: getattr(result, name) for name in quantities})
+
+
+def make_stats(values, edges):
+    index = np.searchsorted(edges, values, side='right')
+    # The last edge belongs to the last bin, not the overflow
+    index[values == edges[-1]] -= 1
+    counts = np.bincount(index, minlength=len(edges) + 1)
+    mean = values.mean()
+    return(Stats(count=len(values), mean=mean,
+                 m2=np.sum((values - mean) ** 2), minimum=values.min(),
+                 maximum=values.max(), edges=edges, counts=counts))
+
+
+def merge(a, b):
+    count = a.count + b.count
+    delta = b.mean - a.mean
+    return(Stats(count=count, mean=a.mean + delta * b.count / count,
+                 m2=a.m2 + b.m2 + delta ** 2 * a.count * b.count / count,
+                 minimum=min(a.minimum, b.minimum),
+                 maximum=max(a.maximum, b.maximum), edges=a.edges,
+                 counts=a.counts + b.counts))
+
+
+def std(stats):
+    return(np.sqrt(stats.m2 / max(stats.count - 1, 1)))
+
+
+def percentile(stats, q):
+    # Linear within the bins; the under- and overflow bins reach out to
+    # the extremes
+    bounds = np.concatenate([[min(stats.minimum, stats.edges[0])],
+                             stats.edges,
+                             [max(stats.maximum, stats.edges[-1])]])
+    cumulative = np.concatenate([[0], np.cumsum(stats.counts)])
+    return(float(np.clip(np.interp(q / 100 * stats.count, cumulative,
+                                   bounds), stats.minimum, stats.maximum)))
+
+
+def make_edges(values, bins):
+    # Bins over the middle 99 % of the first chunk, and half as much again
+    # on either side. Not the whole range, a few systems near collimation
+    # can put the focus kilometres away.
+    low, high = np.percentile(values, [0.5, 99.5])
+    pad = (high - low) / 2 or abs(high) * 1e-9 or 1e-12
+    return(np.linspace(low - pad, high + pad, bins + 1))
+
+
+def chunk_stats(problem, edges, size, seed):
+    # What a worker does with one chunk
+    values = evaluate(problem, np.random.default_rng(seed), size)
+    return({name: make_stats(values[name], edges[name])
+            for name in quantities})
+
+
+def analyze_iter(problem, samples, workers=None, chunk_size=2 ** 16,
+                 bins=100, seed=None):
+    # Yields the number of samples done and the statistics so far (a dict
+    # of Stats by quantity) after every chunk. At most two chunks per
+    # worker are out at a time.
+    if workers is None:
+        workers = os.cpu_count() or 1
+    seeds = np.random.SeedSequence(seed)
+    sizes = [min(chunk_size, samples - start)
+             for start in range(0, samples, chunk_size)]
+    first = evaluate(problem, np.random.default_rng(seeds.spawn(1)[0]),
+                     sizes[0])
+    edges = {name: make_edges(first[name], bins) for name in quantities}
+    stats = {name: make_stats(first[name], edges[name])
+             for name in quantities}
+    done = sizes[0]
+    yield done, stats
+    rest = iter(zip(sizes[1:], seeds.spawn(len(sizes) - 1)))
+    if workers == 1:
+        for size, chunk_seed in rest:
+            chunk = chunk_stats(problem, edges, size, chunk_seed)
+            stats = {name: merge(stats[name], chunk[name])
+                     for name in quantities}
+            done += size
+            yield done, stats
+        return
+    pool = optimize.get_pool(workers)
+    pending = {}
+
+    def submit():
+        for size, chunk_seed in rest:
+            future = pool.submit(chunk_stats, problem, edges, size,
+                                 chunk_seed)
+            pending[future] = size
+            if len(pending) >= 2 * workers:
+                return
+
+    submit()
+    while pending:
+        finished, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            chunk = future.result()
+            stats = {name: merge(stats[name], chunk[name])
+                     for name in quantities}
+            done += pending.pop(future)
+        submit()
+        yield done, stats
+
+
+def summarize(stats, percentiles=(5, 50, 95)):
+    # Plain numbers (for JSON) of one Stats
+    return({'count': int(stats.count), 'mean': float(stats.mean),
+            'std': float(std(stats)), 'minimum': float(stats.minimum),
+            'maximum': float(stats.maximum),
+            'percentiles': [percentile(stats, q) for q in percentiles],
+            'edges': stats.edges.tolist(),
+            'counts': stats.counts[1:-1].tolist(),
+            'outside': int(stats.counts[0] + stats.counts[-1])})
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""A bounded pool for the heavy work of the callbacks.
+
+The request threads hand the physics, figure and report work to a pool of
+max_workers threads (or processes) and wait for it. At most max_queue more
+jobs may wait for a free worker; beyond that run() raises Busy straight
+away instead of piling up requests, and a job that isn't done in timeout
+seconds raises Timeout. Either way the request thread is free again and
+can tell the page so.
+
+Threads are the default: NumPy lets go of the GIL in the big array
+operations, and nothing has to be pickled. With kind='process' the
+function and its arguments have to be picklable (module level functions,
+plain data). The executor is made on first use in every process, so it
+isn't shared across a fork (gunicorn --preload).
+"""
+
+import concurrent.futures
+import os
+import threading
+
+
+class Busy(Exception):
+    pass
+
+
+class Timeout(Exception):
+    pass
+
+
+class Pool:
+    def __init__(self, max_workers=4, max_queue=8, timeout=20.,
+                 kind='thread'):
+        if kind not in ('thread', 'process'):
+            raise ValueError('Unknown pool kind ' + kind)
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.kind = kind
+        self.pending = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self.kind == 'process':
+                        executor = concurrent.futures.ProcessPoolExecutor(
+                            self.max_workers)
+                    else:
+                        executor = concurrent.futures.ThreadPoolExecutor(
+                            self.max_workers, thread_name_prefix='compute')
+                    self._executor = executor
+                    self.pending = 0
+                    self._pid = os.getpid()
+        return(self._executor)
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def submit(self, func, *args, **kwargs):
+        executor = self.executor()
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                raise Busy
+            self.pending += 1
+        try:
+            future = executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return(future)
+
+    def run(self, func, *args, **kwargs):
+        # func(*args, **kwargs) in the pool; its exceptions are raised here
+        future = self.submit(func, *args, **kwargs)
+        try:
+            return(future.result(self.timeout))
+        except concurrent.futures.TimeoutError:
+            # A job that has started can't be stopped, it only stops being
+            # waited for (and still counts as pending until it's done)
+            future.cancel()
+            raise Timeout
+
+    def shutdown(self):
+        if self._pid == os.getpid() and self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._pid = None